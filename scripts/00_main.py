@@ -1,12 +1,16 @@
 import subprocess
 import time
 import os
+import argparse
+
+import metrics
+from stage_cache import add_cache_arguments
 
 # List of Python script filenames to run sequentially
 scripts = [
             "01_audio_detach.py",
             "02_transcribe.py",
-#            "03_reblocks.py",
+#            "03_reblock.py",
 #            "04_verbalize.py",
 #            "05_translate.py"
 ]
@@ -14,23 +18,67 @@ scripts = [
 # Directory where the scripts are located (adjust if needed)
 scripts_dir = "."
 
-for script in scripts:
-    script_path = os.path.join(scripts_dir, script)
-    
-    try:
-        print(f"\nStarting script: {script}")
-        start_time = time.time()
-        
-        # Run the script with Python 3 and wait for it to complete
-        process = subprocess.Popen(["python3", script_path], cwd=scripts_dir)
-        process.wait()
-        
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Script {script} completed in {elapsed_time:.2f} seconds.\n")
-    
-    except Exception as e:
-        print(f"An error occurred while running {script}: {e}")
-        break  # Stop execution if an error occurs
-
-print("All scripts have finished running.\n\n")
\ No newline at end of file
+# Pipeline stage of each script, for the --in_process mode
+script_stages = {
+    "01_audio_detach.py": "extract",
+    "02_transcribe.py": "transcribe",
+    "03_reblock.py": "reblock",
+    "04_verbalize.py": "verbalize",
+    "05_translate.py": "translate",
+}
+
+# Main function to run the pipeline
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline scripts one after another.")
+    add_cache_arguments(parser)
+    parser.add_argument("--in_process", action="store_true",
+                        help="Run the listed stages in this process, moving each file on as soon as its previous stage is done")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.in_process and not args.dry_run:
+        metrics.configure_from_args('pipeline', args)
+        import pipeline
+        stages = [script_stages[script] for script in scripts]
+        pipeline.run_pipeline(stages[0], stages[-1], incremental=args.incremental, force=args.force)
+        return
+
+    # Every stage understands the incremental options, so they are simply passed on
+    script_args = []
+    if args.incremental:
+        script_args.append("--incremental")
+    if args.force:
+        script_args.append("--force")
+    # Every stage appends to the same trace and writes its own textfile
+    if args.trace:
+        script_args += ["--trace", os.path.abspath(args.trace)]
+    if args.metrics_dir:
+        script_args += ["--metrics_dir", os.path.abspath(args.metrics_dir)]
+    if args.dry_run:
+        script_args.append("--dry_run")
+        print("Dry run: each stage lists what it would process with the files as they are now.\n"
+              "Inputs that an earlier stage would rewrite show up as 'would run' only once that stage has run.")
+
+    for script in scripts:
+        script_path = os.path.join(scripts_dir, script)
+
+        try:
+            print(f"\nStarting script: {script}")
+            start_time = time.time()
+
+            # Run the script with Python 3 and wait for it to complete
+            process = subprocess.Popen(["python3", script_path] + script_args, cwd=scripts_dir)
+            process.wait()
+
+            end_time = time.time()
+            elapsed_time = end_time - start_time
+            print(f"Script {script} completed in {elapsed_time:.2f} seconds.\n")
+
+        except Exception as e:
+            print(f"An error occurred while running {script}: {e}")
+            break  # Stop execution if an error occurs
+
+    print("All scripts have finished running.\n\n")
+
+if __name__ == "__main__":
+    main()
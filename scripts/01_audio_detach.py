@@ -1,51 +1,57 @@
 # -*- coding: utf-8 -*-
 import time
 import os
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import subprocess
 
-# Start time tracking
-start_time = time.time()
+import metrics
+import pcm_audio
+from stage_cache import StageCache, add_cache_arguments
 
 # Paths to directories
 base_dir = Path(__file__).resolve().parent.parent
 video_dir = base_dir / 'data' / 'input'
 audio_output_dir = base_dir / 'data' / 'input'
 
+# Number of ffmpeg processes to run at the same time (1 = one file after another)
+max_workers = os.cpu_count() or 1
+
+# Output format: 'mp3' for the classic intermediate, 'pcm' for a raw 16 kHz float32 cache
+# that 02_transcribe.py memory-maps without decoding or resampling again
+output_format = 'mp3'
+
 # Create the output directory for audio files if it doesn't exist
 os.makedirs(audio_output_dir, exist_ok=True)
 
+# Names already handed out in this run. Parallel jobs only create their output file
+# when ffmpeg starts writing, so checking os.path.exists alone could give two jobs the same _vN name.
+reserved_names = set()
+reserved_names_lock = threading.Lock()
+
 # Function to generate a unique filename
 def get_unique_filename(base_name, extension, directory):
-    counter = 1
-    unique_name = f"{base_name}.{extension}"
-    while os.path.exists(os.path.join(directory, unique_name)):
-        unique_name = f"{base_name}_v{counter}.{extension}"
-        counter += 1
+    with reserved_names_lock:
+        counter = 1
+        unique_name = f"{base_name}.{extension}"
+        while unique_name in reserved_names or os.path.exists(os.path.join(directory, unique_name)):
+            unique_name = f"{base_name}_v{counter}.{extension}"
+            counter += 1
+        reserved_names.add(unique_name)
     return unique_name
 
 # List all video files (supporting multiple extensions)
 supported_extensions = ('.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm')  # Add other formats as needed
-video_files = [f for f in os.listdir(video_dir) if f.lower().endswith(supported_extensions)]
-
-# Process each video file
-for index, filename in enumerate(video_files):
-    # Calculate progress percentage
-    progress = (index + 1) / len(video_files) * 100
-
-    # Full path to the video file
-    video_path = os.path.join(video_dir, filename)
-
-    # Determine the name of the output audio file
-    base_name = os.path.splitext(filename)[0]
-    output_filename = get_unique_filename(base_name, 'mp3', audio_output_dir)
-    output_path = os.path.join(audio_output_dir, output_filename)
 
-    # Extract audio using ffmpeg with noise reduction
-    print(f"Extracting and cleaning audio from {filename}... ({progress:.2f}% completed)")
+def list_video_files(directory):
+    """Returns the video files in a directory, sorted by name."""
+    return sorted(f for f in os.listdir(directory) if f.lower().endswith(supported_extensions))
 
-    # Build the ffmpeg command with the afftdn filter
-    command = [
+# Function to build the ffmpeg command for one video
+def build_ffmpeg_command(video_path, output_path):
+    return [
         'ffmpeg',
         '-i', video_path,
         '-vn',
@@ -67,21 +73,135 @@ for index, filename in enumerate(video_files):
         output_path
     ]
 
-    try:
-        # Run the ffmpeg command to extract and clean the audio
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"Cleaned audio extracted and saved as: {output_filename}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error processing {filename}: {e.stderr.decode('utf-8')}")
+# Function to extract the audio of a single video file, given by its name in video_dir or by a full path.
+# Returns (filename, output_filename, elapsed_seconds, error); error is None on success.
+def extract_audio(filename, audio_format=output_format, cache=None):
+    file_start_time = time.time()
+    cache = cache or StageCache('extract', {})
 
-    print(f"Progress: {progress:.2f}%")
-
-print("\nAll video files have been processed.")
+    # Full path to the video file (join keeps a path that is already absolute)
+    video_path = os.path.join(video_dir, filename)
 
-# End time tracking
-end_time = time.time()
+    # Determine the name of the output audio file. An incremental re-run overwrites its previous output.
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    extension = pcm_audio.PCM_EXTENSION if audio_format == 'pcm' else 'mp3'
+    previous_outputs = cache.previous_outputs(video_path)
+    if previous_outputs and previous_outputs[0].suffix == f".{extension}":
+        output_filename = previous_outputs[0].name
+    else:
+        output_filename = get_unique_filename(base_name, extension, audio_output_dir)
+    output_path = os.path.join(audio_output_dir, output_filename)
+    input_hash = cache.input_hash(video_path)
 
-# Calculate and print the elapsed time
-elapsed_time = end_time - start_time
-minutes, seconds = divmod(elapsed_time, 60)
-print(f"Time taken for processing: {int(minutes)} minutes and {seconds:.2f} seconds\n")
+    try:
+        with metrics.span('extract.ffmpeg', file=filename, format=audio_format) as span:
+            if audio_format == 'pcm':
+                # Decode once to the sample rate Whisper uses, no lossy encode in between
+                pcm_audio.extract_pcm_cache(video_path, output_path)
+            else:
+                # Run the ffmpeg command to extract and clean the audio
+                command = build_ffmpeg_command(video_path, output_path)
+                subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            span.set(output_bytes=os.path.getsize(output_path))
+        error = None
+        with metrics.span('extract.record', file=filename):
+            cache.record(video_path, input_hash, [output_path])
+    except subprocess.CalledProcessError as e:
+        error = e.stderr.decode('utf-8', errors='replace')
+    except (OSError, RuntimeError) as e:
+        error = str(e)
+    metrics.increment('extract_files', status='ok' if error is None else 'failed')
+
+    return filename, output_filename, time.time() - file_start_time, error
+
+# Function to describe everything that changes the extracted audio, for the incremental mode
+def stage_params(audio_format):
+    if audio_format == 'pcm':
+        return {'format': audio_format, 'command': pcm_audio.ffmpeg_pcm_command('<input>', '<output>')}
+    return {'format': audio_format, 'command': build_ffmpeg_command('<input>', '<output>')}
+
+# Function to extract audio from all videos using a bounded pool of ffmpeg processes
+def process_directory(workers, audio_format=output_format, cache=None):
+    cache = cache or StageCache('extract', stage_params(audio_format))
+    video_files = [f for f in list_video_files(video_dir) if cache.should_process(os.path.join(video_dir, f))]
+    cache.print_summary()
+    if not video_files:
+        print("No video files to process.")
+        return []
+
+    workers = max(1, min(workers, len(video_files)))
+    print(f"Extracting audio from {len(video_files)} files with {workers} worker(s)...")
+
+    timings = []
+    completed = 0
+    written_bytes = 0
+    # ffmpeg does the work in its own process, so threads are enough to keep the cores busy
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract_audio, filename, audio_format, cache) for filename in video_files]
+        for future in as_completed(futures):
+            filename, output_filename, elapsed, error = future.result()
+            completed += 1
+            # Progress counts finished jobs, since they complete out of order
+            progress = completed / len(video_files) * 100
+
+            if error is None:
+                print(f"Cleaned audio extracted from {filename} and saved as: {output_filename} ({elapsed:.2f} s)")
+            else:
+                print(f"Error processing {filename}: {error}")
+            print(f"Progress: {progress:.2f}% ({completed}/{len(video_files)})")
+
+            timings.append((filename, elapsed, error is None))
+
+            if error is None and audio_format == 'pcm':
+                written_bytes += os.path.getsize(os.path.join(audio_output_dir, output_filename))
+
+    if written_bytes:
+        # A PCM cache holds exactly 4 bytes per sample, which gives the audio duration for free
+        audio_seconds = written_bytes / (pcm_audio.SAMPLE_RATE * pcm_audio.BYTES_PER_SAMPLE)
+        busy_time = sum(elapsed for _, elapsed, _ in timings)
+        pcm_audio.print_savings_report("PCM cache", audio_seconds, busy_time, written_bytes)
+
+    return timings
+
+# Function to print the per-file timings and totals
+def print_report(timings, wall_time):
+    if not timings:
+        return
+    print("\nPer-file timings:")
+    for filename, elapsed, ok in sorted(timings, key=lambda t: t[1], reverse=True):
+        status = "ok" if ok else "FAILED"
+        print(f"  {elapsed:8.2f} s  {status:6}  {filename}")
+
+    failed = sum(1 for _, _, ok in timings if not ok)
+    busy_time = sum(elapsed for _, elapsed, _ in timings)
+    print(f"Files: {len(timings)} ({failed} failed)")
+    print(f"Sum of per-file times: {busy_time:.2f} s, wall time: {wall_time:.2f} s "
+          f"(x{busy_time / wall_time if wall_time > 0 else 0:.2f} concurrency)")
+
+# Main function to run the script
+def main():
+    parser = argparse.ArgumentParser(description="Extract mono audio tracks from the video files in the input directory.")
+    parser.add_argument("--workers", type=int, default=max_workers, help="Number of ffmpeg processes to run in parallel (default: number of CPU cores)")
+    parser.add_argument("--format", dest="audio_format", choices=('mp3', 'pcm'), default=output_format,
+                        help="'mp3' writes the classic MP3 intermediate, 'pcm' writes a raw 16 kHz float32 cache for 02_transcribe.py")
+    add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('extract', args)
+
+    # Start time tracking
+    start_time = time.time()
+
+    cache = StageCache.from_args('extract', stage_params(args.audio_format), args)
+    timings = process_directory(args.workers, args.audio_format, cache)
+
+    print("\nAll video files have been processed.")
+
+    # Calculate and print the elapsed time
+    elapsed_time = time.time() - start_time
+    print_report(timings, elapsed_time)
+    minutes, seconds = divmod(elapsed_time, 60)
+    print(f"Time taken for processing: {int(minutes)} minutes and {seconds:.2f} seconds\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,155 @@
 # -*- coding: utf-8 -*-
 import time
 import os
-import whisper
-from pathlib import Path
-
-# Start time tracking
-start_time = time.time()
-
-# Paths to directories
-base_dir = Path(__file__).resolve().parent.parent
-audio_dir = base_dir / 'data' / 'input'
-srt_dir = base_dir / 'data' / 'output'
-txt_dir = base_dir / 'data' / 'output'
-
-# Ensure the output directories exist
-os.makedirs(srt_dir, exist_ok=True)
-os.makedirs(txt_dir, exist_ok=True)
-
-# Load the Whisper model
-# You can choose "tiny", "base", "small", "medium", "large" based on your needs for version 2
-# For version 3 use large-v3
-model = whisper.load_model("large")  
-
-#context = (
-#    "Мы будем траскрибировать лекции по математике (алгебра и геометрия старших классов)."
-#)
-
-# Function to generate a unique filename
-def get_unique_filename(base_name, extension, directory):
-    counter = 1
-    unique_name = f"{base_name}.{extension}"
-    while os.path.exists(os.path.join(directory, unique_name)):
-        unique_name = f"{base_name}_v{counter}.{extension}"
-        counter += 1
-    return unique_name
-
-# Custom function to convert results to SRT format with adjusted start time for the first segment
-def result_to_srt(result, initial_shift=6):
-    srt_content = []
-    for i, segment in enumerate(result['segments']):
-        # Shift only the start time of the first segment
-        start = segment['start'] + initial_shift if i == 0 else segment['start']
-        end = segment['end']
-        text = segment['text'].strip()
-        srt_content.append(f"{i + 1}")
-        srt_content.append(f"{format_time(start)} --> {format_time(end)}")
-        srt_content.append(text)
-        srt_content.append("")
-    return "\n".join(srt_content)
-
-def format_time(seconds):
-    total_seconds = float(seconds)
-    hours = int(total_seconds // 3600)
-    minutes = int((total_seconds % 3600) // 60)
-    secs = int(total_seconds % 60)
-    milliseconds = int(round((total_seconds - int(total_seconds)) * 1000))
-    return f"{hours:02}:{minutes:02}:{secs:02},{milliseconds:03}"
-
-# List all audio files (handling multiple extensions)
-supported_extensions = ('.wav', '.mp3', '.m4a', '.flac', '.ogg', '.aac')  # Add other supported formats as needed
-audio_files = [f for f in os.listdir(audio_dir) if f.lower().endswith(supported_extensions)]
-
-# Process each audio file
-for index, filename in enumerate(audio_files):
-    # Calculate progress percentage
-    progress = (index + 1) / len(audio_files) * 100
-    
-    # Full path to the audio file
-    audio_path = os.path.join(audio_dir, filename)
-    
-    # Transcribe the audio file with explicit Russian language setting
-    print(f"\n\nTranscribing {filename}... ({progress:.2f}% completed)")
-    result = model.transcribe(
-        audio_path,
-        language="ru",
-#        initial_prompt=context,
-        task="transcribe",
-        beam_size=5,
-        best_of=5,
-        temperature=0.1,
-        fp16=True,
-        condition_on_previous_text=False,
-        verbose=True
-    )
-    
-    # Save the raw text output before any further processing
-    raw_text_filename = get_unique_filename(os.path.splitext(filename)[0], 'txt', txt_dir)
-    with open(os.path.join(txt_dir, raw_text_filename), 'w', encoding='utf-8') as raw_text_file:
-        raw_text_file.write(result['text'])
-    print(f"Saved raw text file: {raw_text_filename}")
-    
-    # Determine output file type
-    if 'segments' in result:  # This indicates the presence of time codes
-        output_extension = 'srt'
-        srt_content = result_to_srt(result)
-        base_name = os.path.splitext(filename)[0]
-        output_filename = get_unique_filename(base_name, output_extension, srt_dir)
-        
-        # Write the .srt file
-        with open(os.path.join(srt_dir, output_filename), 'w', encoding='utf-8') as srt_file:
-            srt_file.write(srt_content)
-        print(f"Saved SRT file: {output_filename}")
-    
-    print(f"Progress: {progress:.2f}%")
-
-print("\nAll audio files have been transcribed.")
-
-# End time tracking
-end_time = time.time()
-
-# Calculate and print the elapsed time
-elapsed_time = end_time - start_time
-minutes, seconds = divmod(elapsed_time, 60)
-print(f"Time taken for transcription: {int(minutes)} minutes and {seconds:.2f} seconds\n\n")
+import argparse
+
+import cascade
+import cpu_backend
+import hallucination
+import metrics
+import pcm_audio
+import transcribe_worker
+from stage_cache import StageCache, add_cache_arguments
+from transcription import (audio_dir, model_name, supported_extensions, video_extensions, list_media_files, load_model,
+                           transcribe_file, previous_output_names, output_paths, print_run_report, stage_params)
+
+# Function to list the media files that need transcribing
+def list_pending_files(direct, cache):
+    # The direct mode reads the videos themselves; ffmpeg's PCM output goes straight into memory
+    media_files = list_media_files(audio_dir, video_extensions if direct else supported_extensions)
+    pending = [f for f in media_files if cache.should_process(os.path.join(audio_dir, f))]
+    cache.print_summary()
+    return pending
+
+# Function to transcribe every media file of the input directory in this process
+def process_directory(model, media_files, cache, direct=False, use_vad=False, shards=1, word_timestamps=False,
+                      repair=False):
+    stats_list = []
+
+    # Process each audio file
+    for index, filename in enumerate(media_files):
+        # Calculate progress percentage
+        progress = (index + 1) / len(media_files) * 100
+
+        # Full path to the audio file
+        audio_path = os.path.join(audio_dir, filename)
+        input_hash = cache.input_hash(audio_path)
+
+        print(f"\n\nTranscribing {filename}... ({progress:.2f}% completed)")
+        outputs, stats = transcribe_file(model, audio_path, use_vad=use_vad, shards=shards,
+                                         output_names=previous_output_names(cache, audio_path),
+                                         word_timestamps=word_timestamps, repair=repair)
+        stats_list.append(stats)
+        cache.record(audio_path, input_hash, output_paths(outputs))
+
+        print(f"Progress: {progress:.2f}%")
+
+    print_run_report(stats_list, use_vad=use_vad)
+    if direct:
+        # Nothing is written to disk between the video and the model
+        pcm_audio.print_savings_report("Direct PCM", sum(stats['audio_seconds'] for stats in stats_list),
+                                       sum(stats['decode_seconds'] for stats in stats_list), 0)
+
+# Function to hand every media file to the running transcription worker and wait for the results
+def process_directory_with_worker(media_files, cache, use_vad=False, shards=1, word_timestamps=False, repair=False):
+    # Submit everything first, so the worker never waits for the next job
+    jobs = []
+    for filename in media_files:
+        audio_path = os.path.join(audio_dir, filename)
+        input_hash = cache.input_hash(audio_path)
+        job_id = transcribe_worker.submit_job(audio_path, use_vad=use_vad, shards=shards,
+                                              output_names=previous_output_names(cache, audio_path),
+                                              word_timestamps=word_timestamps, repair=repair)
+        jobs.append((filename, input_hash, job_id))
+    print(f"Submitted {len(jobs)} file(s) to the transcription worker")
+
+    stats_list = []
+    for index, (filename, input_hash, job_id) in enumerate(jobs):
+        progress = (index + 1) / len(jobs) * 100
+        result = transcribe_worker.wait_for_job(job_id)
+        metrics.observe('worker_job_latency_seconds', result['latency_seconds'])
+        if result['status'] == 'ok':
+            print(f"Transcribed {filename} -> {', '.join(result['outputs'])}")
+            print(f"  queued {result['queued_seconds']:.2f} s, transcribed in {result['transcribe_seconds']:.2f} s, "
+                  f"latency {result['latency_seconds']:.2f} s (model load {result['model_load_seconds']:.2f} s, paid once by the worker)")
+            stats_list.append(result)
+            cache.record(os.path.join(audio_dir, filename), input_hash, output_paths(result['outputs']))
+        else:
+            print(f"Error transcribing {filename}: {result['error']}")
+        print(f"Progress: {progress:.2f}%")
+
+    print_run_report(stats_list, use_vad=use_vad)
+
+# Main function to run the script
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe the audio files in the input directory with Whisper.")
+    parser.add_argument("--direct", action="store_true",
+                        help="Decode the video files straight into memory instead of reading extracted audio files")
+    parser.add_argument("--local", action="store_true",
+                        help="Load the model in this process even if a transcription worker is running")
+    parser.add_argument("--vad", action="store_true",
+                        help="Detect speech first and decode only the speech regions (timestamps stay on the original timeline)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Cut each file at pauses into this many shards and transcribe them in parallel processes (CPU nodes; 1 = serial)")
+    parser.add_argument("--word_timestamps", action="store_true",
+                        help="Record the time of every word next to the SRT, so 03_reblock.py can cut blocks between words")
+    parser.add_argument("--backend", choices=cpu_backend.backends, default=cpu_backend.default_backend,
+                        help="int8: quantize the linear layers for CPU nodes (compare them with benchmark_backends.py)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch (default: all cores)")
+    parser.add_argument("--cascade", action="store_true",
+                        help=f"Transcribe with '{cascade.fast_model_name}' first and re-decode only the low-confidence parts with '{model_name}' (runs locally)")
+    parser.add_argument("--repair", action="store_true",
+                        help="Find repetition loops and text over silence after decoding and re-decode only those windows")
+    add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('transcribe', args)
+    if args.cascade and args.shards > 1:
+        parser.error("--cascade cannot be combined with --shards")
+
+    # Start time tracking
+    start_time = time.time()
+
+    # The worker keeps only one model, so the cascade always runs in this process
+    use_worker = not args.local and not args.cascade and transcribe_worker.worker_is_alive()
+    name = transcribe_worker.worker_model_name() if use_worker else model_name
+    backend = transcribe_worker.worker_backend() if use_worker else args.backend
+    cascade_params = cascade.params() if args.cascade else None
+    repair_params = hallucination.params() if args.repair else None
+    cache = StageCache.from_args('transcribe', stage_params(name, args.vad, args.word_timestamps, backend, cascade_params,
+                                                            repair_params), args)
+    media_files = list_pending_files(args.direct, cache)
+
+    if not media_files:
+        print("No audio files to transcribe.")
+    elif use_worker:
+        # A warm worker already has the model in memory
+        print("Using the running transcription worker"
+              + (" (still loading its model, the jobs wait in the queue)" if transcribe_worker.worker_is_loading() else ""))
+        process_directory_with_worker(media_files, cache, use_vad=args.vad, shards=args.shards,
+                                      word_timestamps=args.word_timestamps, repair=args.repair)
+    elif args.cascade:
+        # The large model is loaded only when the first window is escalated
+        model, _ = cascade.load(model_name, args.backend, args.threads)
+        process_directory(model, media_files, cache, direct=args.direct, use_vad=args.vad,
+                          word_timestamps=args.word_timestamps, repair=args.repair)
+        model.print_report()
+    else:
+        # Load the Whisper model
+        model, model_load_seconds = load_model(model_name, args.backend, args.threads)
+        print(f"Loaded Whisper model '{model_name}' ({args.backend}) in {model_load_seconds:.2f} s")
+        process_directory(model, media_files, cache, direct=args.direct, use_vad=args.vad, shards=args.shards,
+                          word_timestamps=args.word_timestamps, repair=args.repair)
+
+    print("\nAll audio files have been transcribed.")
+
+    # End time tracking
+    end_time = time.time()
+
+    # Calculate and print the elapsed time
+    elapsed_time = end_time - start_time
+    minutes, seconds = divmod(elapsed_time, 60)
+    print(f"Time taken for transcription: {int(minutes)} minutes and {seconds:.2f} seconds\n\n")
+
+if __name__ == "__main__":
+    main()
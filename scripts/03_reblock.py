@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 import pysrt
 import os
+import argparse
 from datetime import timedelta
 from pathlib import Path
 
+import numpy as np
+
+import metrics
+import srt_engine
+import transcript_store
+import transcription
+import word_timestamps
+from stage_cache import StageCache, add_cache_arguments
+
 # Paths to directories
 base_dir = Path(__file__).resolve().parent.parent
 input_dir = base_dir / 'data' / 'output'
@@ -15,6 +25,9 @@ os.makedirs(output_dir, exist_ok=True)
 # Variable to control the number of seconds for word grouping
 SECONDS_PER_BLOCK = 21  # You can change this value manually to control block length
 
+# Translations written by 05_translate.py live next to the sources and are not reblocked again
+translated_suffixes = transcription.translated_suffixes
+
 def add_time(start_time, delta_ms):
     """Adds milliseconds to a SubRipTime object and returns a new SubRipTime object."""
     total_ms = (start_time.hours * 3600 + start_time.minutes * 60 + start_time.seconds) * 1000 + start_time.milliseconds + delta_ms
@@ -58,7 +71,35 @@ def calculate_words_per_block(subs):
     return words_per_block
 
 def process_srt_file(input_file, output_file):
-    """Processes an SRT file, splitting or merging subtitle blocks and saving the result."""
+    """Processes an SRT file, splitting or merging subtitle blocks and saving the result.
+    Uses the array-backed engine in srt_engine.py, which writes the same output as process_srt_file_pysrt.
+    If the file is still the export of its transcript store, the blocks are read from the store and
+    replaced there, and blocks are cut between words at pauses when the store has word timestamps."""
+    with metrics.span('reblock.file', file=os.path.basename(input_file)) as span:
+        store, column = transcript_store.open_for_srt(input_file)
+        if store is None:
+            srt_engine.reblock_file(input_file, output_file, SECONDS_PER_BLOCK)
+            span.set(source='srt')
+            return
+
+        table = store.srt_table(column)
+        words = word_timestamps.load_matching(store, table.words)
+        if words is not None:
+            blocks = list(srt_engine.reblock_words(words, SECONDS_PER_BLOCK))
+        else:
+            blocks = list(srt_engine.reblock(table, SECONDS_PER_BLOCK))
+
+        # The store keeps the times the SRT shows: whole milliseconds, rounded down
+        store.write_table('blocks', {
+            'start_ms': np.floor([start for start, _, _ in blocks]).astype(np.int64),
+            'end_ms': np.floor([end for _, end, _ in blocks]).astype(np.int64),
+            column: [text for _, _, text in blocks],
+        })
+        store.export_srt(output_file, column)
+        span.set(source='store', word_cuts=words is not None, blocks_in=len(table), blocks_out=len(blocks))
+
+def process_srt_file_pysrt(input_file, output_file):
+    """Reference implementation of process_srt_file on pysrt objects, kept for benchmark_reblock.py."""
     subs = pysrt.open(input_file)
     
     # Automatically calculate the value of WORDS_PER_BLOCK
@@ -101,15 +142,41 @@ def process_srt_file(input_file, output_file):
     
     new_subs.save(output_file, encoding='utf-8')
 
+# Function to describe everything that changes the reblocked output, for the incremental mode
+def stage_params():
+    return {'seconds_per_block': SECONDS_PER_BLOCK,
+            'word_cuts': [srt_engine.PAUSE_SECONDS, srt_engine.LONG_PAUSE_SECONDS, srt_engine.MIN_FRACTION, srt_engine.MAX_FRACTION]}
+
 # Process all SRT files in the input directory
-for filename in os.listdir(input_dir):
-    if filename.endswith('.srt'):
-        input_file = input_dir / filename
-        
-        # Change name if requiered
-        output_filename = filename.replace('.srt', '.srt')
-        output_file = output_dir / output_filename
-        
-        print(f"Processing {input_file}...")
-        process_srt_file(input_file, output_file)
-        print(f"Processed {input_file} -> {output_file}\n\n")
+def process_directory(input_dir, output_dir, cache=None):
+    cache = cache or StageCache('reblock', stage_params())
+    for filename in sorted(os.listdir(input_dir)):
+        if filename.endswith('.srt') and not filename.endswith(translated_suffixes):
+            input_file = input_dir / filename
+
+            # Change name if requiered
+            output_filename = filename.replace('.srt', '.srt')
+            output_file = output_dir / output_filename
+
+            if not cache.should_process(input_file):
+                continue
+            input_hash = cache.input_hash(input_file)
+
+            print(f"Processing {input_file}...")
+            process_srt_file(input_file, output_file)
+            cache.record(input_file, input_hash, [output_file])
+            print(f"Processed {input_file} -> {output_file}\n\n")
+    cache.print_summary()
+
+# Main function to run the script
+def main():
+    parser = argparse.ArgumentParser(description="Regroup the subtitle blocks of the SRT files into blocks of about SECONDS_PER_BLOCK seconds.")
+    add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('reblock', args)
+
+    process_directory(input_dir, output_dir, StageCache.from_args('reblock', stage_params(), args))
+
+if __name__ == "__main__":
+    main()
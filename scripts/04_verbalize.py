@@ -1,18 +1,41 @@
 # -*- coding: utf-8 -*-
 import re
 import os
+import threading
+import time
 from openai import OpenAI
 
 import pysrt
-from num2words import num2words
 import argparse
 from pathlib import Path
 
+import batching
+import journal
+import metrics
+import transcript_store
+import transcription
+import translation_memory
+import verbalizer
+from stage_cache import StageCache, add_cache_arguments
+
 # Paths to directories
 base_dir = Path(__file__).resolve().parent.parent
 input_dir =  base_dir / 'data' / 'output'
 output_dir = base_dir / 'data' / 'output'
-blocks_per_request = 10  # Number of subtitle blocks to send in one request
+
+# Blocks are packed into a request up to a token budget
+input_tokens_per_request = batching.input_tokens_per_request  # Subtitle text per request, without the instructions
+max_blocks_per_request = batching.max_blocks_per_request
+output_ratio = 2.0  # Expected answer tokens per input token: letters, operators and leftover numbers are spelled out
+
+# New models are "o1-preview" and "o1-mini".
+# gpt-4o-2024-08-06:    approximately   $0.030 per 15 min srt file
+# o1-mini:              approximately   $0.036 per 15 min srt file
+# o1-preview:           approximately   $0.18 per 15 min srt file
+openai_model = "gpt-4o-2024-08-06"
+
+# Translations written by 05_translate.py live next to the sources and must not be verbalized
+translated_suffixes = transcription.translated_suffixes
 
 # Ensure the output directories exist
 os.makedirs(output_dir, exist_ok=True)
@@ -30,114 +53,253 @@ client = OpenAI(api_key=get_api_key())
 def replace_numbers(text):
     def num_to_word(match):
         number = int(match.group())
-        # Convert number to Russian text with correct forms
-        try:
-            return num2words(number, lang='ru')
-        except NotImplementedError:
-            return str(number)
+        # Convert number to Russian text with correct forms (memoized, lectures repeat the same numbers)
+        return verbalizer.number_words(number) or str(number)
 
     # Find and replace all numbers in the text
     return re.sub(r'\b\d+\b', num_to_word, text)
 
+# Instructions for OpenAI, sent before every batch
+separator = "<|SUB_SEPARATOR|>"  # Unique separator unlikely to appear in subtitles
+system_messages = [
+    {"role": "system", "content": "You are a language assistant specializing in text preprocessing for speech synthesis. Your task is to process Russian subtitles from mathematics lectures to prepare them for text-to-speech conversion."},
+    {"role": "system", "content": "In the text, replace all mathematical variables (such as 'x', 'y', 'z', 'π', and any other letters, including Greek letters like 'α', 'β', 'γ', 'Ω') with their Russian word equivalents (e.g., 'икс', 'игрек', 'зет', 'пи', 'альфа', 'бета', 'гамма', 'омега'), ensuring proper grammatical case and agreement in the context."},
+    {"role": "system", "content": "For sequences of uppercase letters representing geometric figures or designations (e.g., 'OA', 'ABCD'), transform each letter to its Russian uppercase equivalent in Cyrillic, separated by hyphens. For example, 'отрезок OA' becomes 'отрезок О-А', 'фигура ABCD' becomes 'фигура А-Б-Ц-Д'."},
+    {"role": "system", "content": "All such letters that should be read separately as mathematical symbols or designations should be printed in uppercase Cyrillic letters."},
+    {"role": "system", "content": "Replace all numbers with their word equivalents in Russian, using correct grammar and case. This includes cardinal numbers, ordinal numbers, and numbers in mathematical expressions."},
+    {"role": "system", "content": "Replace any mathematical symbols or operators (like '+', '-', '*', '/', '=', '>', '<', '≥', '≤') with their word equivalents in Russian, ensuring correct grammatical usage."},
+    {"role": "system", "content": "Do not alter any other content. Preserve any punctuation, formatting, or separators (like '<|SUB_SEPARATOR|>') exactly as they are."},
+    {"role": "system", "content": "Examples:"},
+    {"role": "system", "content": "'x = 10' -> 'икс равно десять'"},
+    {"role": "system", "content": "'3.14' -> 'три целых четырнадцать сотых'"},
+    {"role": "system", "content": "'5 в степени x' -> 'пять в степени икс'"},
+    {"role": "system", "content": "'x > 0' -> 'икс больше нуля'"},
+    {"role": "system", "content": "'н = 0' -> 'игрек равен нулю'"},
+    {"role": "system", "content": "'cos 2x' -> 'косинус двух икс'"},
+    {"role": "system", "content": "'sin 3y' -> 'синус трёх игрек'"},
+    {"role": "system", "content": "'отрезок OA' -> 'отрезок О-А'"},
+    {"role": "system", "content": "'фигура ABCD' -> 'фигура А-Б-Ц-Д'"},
+    {"role": "system", "content": f"Process the following text accordingly, ensuring all instances of '{separator}' are preserved exactly as they are."},
+]
+
+# Blocks the rule-based verbalizer resolves completely are not sent to OpenAI
+use_local_verbalizer = True
+
+# Finished batches are journaled, so a run that dies midway resumes where it stopped
+use_journal = True
+
+# Answers already paid for are kept in the translation memory and not requested again
+use_translation_memory = True
+memory = None
+memory_lock = threading.Lock()
+
+# Function to open the translation memory once per process (None if it is switched off)
+def get_memory():
+    global memory
+    with memory_lock:
+        if memory is None and use_translation_memory:
+            memory = translation_memory.TranslationMemory({'task': 'verbalize', 'model': openai_model, 'messages': system_messages})
+        return memory
+
 # Function to interact with OpenAI using the chat-completions API and explain the task of replacing variables and numbers
-def use_openai_for_replacements(text_batch):
+def use_openai_for_replacements(text_batch, stats=None, blocks=1, rerequest=False):
     # Create instruction for OpenAI
-    separator = "<|SUB_SEPARATOR|>"
-    messages = [
-        {"role": "system", "content": "You are a language assistant specializing in text preprocessing for speech synthesis. Your task is to process Russian subtitles from mathematics lectures to prepare them for text-to-speech conversion."},
-        {"role": "system", "content": "In the text, replace all mathematical variables (such as 'x', 'y', 'z', 'π', and any other letters, including Greek letters like 'α', 'β', 'γ', 'Ω') with their Russian word equivalents (e.g., 'икс', 'игрек', 'зет', 'пи', 'альфа', 'бета', 'гамма', 'омега'), ensuring proper grammatical case and agreement in the context."},
-        {"role": "system", "content": "For sequences of uppercase letters representing geometric figures or designations (e.g., 'OA', 'ABCD'), transform each letter to its Russian uppercase equivalent in Cyrillic, separated by hyphens. For example, 'отрезок OA' becomes 'отрезок О-А', 'фигура ABCD' becomes 'фигура А-Б-Ц-Д'."},
-        {"role": "system", "content": "All such letters that should be read separately as mathematical symbols or designations should be printed in uppercase Cyrillic letters."},
-        {"role": "system", "content": "Replace all numbers with their word equivalents in Russian, using correct grammar and case. This includes cardinal numbers, ordinal numbers, and numbers in mathematical expressions."},
-        {"role": "system", "content": "Replace any mathematical symbols or operators (like '+', '-', '*', '/', '=', '>', '<', '≥', '≤') with their word equivalents in Russian, ensuring correct grammatical usage."},
-        {"role": "system", "content": "Do not alter any other content. Preserve any punctuation, formatting, or separators (like '<|SUB_SEPARATOR|>') exactly as they are."},
-        {"role": "system", "content": "Examples:"},
-        {"role": "system", "content": "'x = 10' -> 'икс равно десять'"},
-        {"role": "system", "content": "'3.14' -> 'три целых четырнадцать сотых'"},
-        {"role": "system", "content": "'5 в степени x' -> 'пять в степени икс'"},
-        {"role": "system", "content": "'x > 0' -> 'икс больше нуля'"},
-        {"role": "system", "content": "'н = 0' -> 'игрек равен нулю'"},
-        {"role": "system", "content": "'cos 2x' -> 'косинус двух икс'"},
-        {"role": "system", "content": "'sin 3y' -> 'синус трёх игрек'"},
-        {"role": "system", "content": "'отрезок OA' -> 'отрезок О-А'"},
-        {"role": "system", "content": "'фигура ABCD' -> 'фигура А-Б-Ц-Д'"},
-        {"role": "system", "content": f"Process the following text accordingly, ensuring all instances of '{separator}' are preserved exactly as they are."},
+    messages = system_messages + [
         {"role": "user", "content": text_batch}
     ]
+    max_tokens = batching.max_tokens_for(batching.count_tokens(text_batch, openai_model), openai_model, output_ratio)
 
     # Use the ChatCompletion endpoint
-    # New models are "o1-preview" and "o1-mini".
-    # gpt-4o-2024-08-06:    approximately   $0.030 per 15 min srt file
-    # o1-mini:              approximately   $0.036 per 15 min srt file
-    # o1-preview:           approximately   $0.18 per 15 min srt file
-    response = client.chat.completions.create(model="gpt-4o-2024-08-06",
-    messages=messages,
-    max_tokens=1500,
-    temperature=0.3)
+    request_start = time.time()
+    with metrics.span('verbalize.api_call', blocks=blocks, rerequest=rerequest):
+        response = client.chat.completions.create(model=openai_model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.3)
+    if stats is not None and response.usage is not None:
+        stats.record(blocks, response.usage.prompt_tokens, response.usage.completion_tokens, time.time() - request_start, rerequest)
+    if response.choices[0].finish_reason == 'length':
+        print(f"Warning: the answer was cut off at max_tokens={max_tokens}")
+        metrics.increment('llm_truncated_answers', stage='verbalize')
 
     # Return the processed text from OpenAI
     return response.choices[0].message.content
 
+# Function to verbalize a list of block texts in one request. If the answer does not split into one part
+# per block, the blocks are bisected and only the halves are requested again, down to single blocks.
+def verbalize_blocks(texts, stats=None, rerequest=False):
+    # Concatenate the texts using the unique separator
+    batch_text = separator.join(texts)
+
+    # First, replace numbers with words in the entire batch
+    modified_batch_text = replace_numbers(batch_text)
+
+    # Then, use OpenAI to intelligently replace Latin variables and adjust grammar
+    modified_batch_text = use_openai_for_replacements(modified_batch_text, stats, len(texts), rerequest)
+
+    # Split the modified text back into individual subtitle blocks using the unique separator
+    answers = batching.split_answer(modified_batch_text, separator, len(texts))
+    if answers is not None:
+        memory = get_memory()
+        if memory:
+            memory.put_batch(texts, answers, separator)
+        return answers
+
+    if stats is not None:
+        stats.record_mismatch(len(texts), len(modified_batch_text.split(separator)))
+    middle = len(texts) // 2
+    return (verbalize_blocks(texts[:middle], stats, rerequest=True)
+            + verbalize_blocks(texts[middle:], stats, rerequest=True))
+
 # Function to process a single SRT file using pysrt
 def process_srt_file(input_file, output_file):
-    subs = pysrt.open(input_file, encoding='utf-8')
+    journal_file = journal.Journal.open('verbalize', input_file, stage_params()) if use_journal else None
+    try:
+        with metrics.span('verbalize.file', file=os.path.basename(input_file)):
+            _process_srt_file(input_file, output_file, journal_file)
+    finally:
+        if journal_file:
+            journal_file.close()
+
+def _process_srt_file(input_file, output_file, journal_file=None):
+    # An SRT that is still the export of its transcript store is read from the store's blocks
+    store, column = transcript_store.open_for_srt(input_file)
+    subs = store.subrip(column) if store else pysrt.open(input_file, encoding='utf-8')
     total_subs = len(subs)  # Get the total number of subtitle blocks
     modified_subs = []  # List to store modified subtitles
-    separator = "<|SUB_SEPARATOR|>"  # Unique separator unlikely to appear in subtitles
+    stats = batching.RequestStats('verbalize')
 
-    # Process subtitles in batches
-    for start in range(0, total_subs, blocks_per_request):
-        end = min(start + blocks_per_request, total_subs)
-        batch = subs[start:end]
+    # Verbalize locally first; only the blocks the rules cannot fully resolve go to OpenAI
+    remote_subs = []
+    remote_indexes = []  # Positions of the remote blocks in the file, the keys of the journal
+    for index, sub in enumerate(subs):
+        text, resolved = verbalizer.verbalize(sub.text) if use_local_verbalizer else (sub.text, False)
+        if resolved:
+            sub.text = text
+            modified_subs.append(sub)
+        else:
+            remote_subs.append(sub)
+            remote_indexes.append(index)
+    local_count = total_subs - len(remote_subs)
+    remote_count = len(remote_subs)
+    metrics.increment('verbalize_blocks', local_count, resolved='local')
+    metrics.increment('verbalize_blocks', len(remote_subs), resolved='llm')
+    print(f"Verbalized {local_count} of {total_subs} blocks locally, sending {len(remote_subs)} to OpenAI")
+
+    # Blocks a previous run finished are taken from the journal
+    if journal_file and journal_file.done:
+        pending = [k for k, index in enumerate(remote_indexes) if index not in journal_file.done]
+        for sub, index in zip(remote_subs, remote_indexes):
+            if index in journal_file.done:
+                sub.text = journal_file.done[index]
+        remote_subs = [remote_subs[k] for k in pending]
+        remote_indexes = [remote_indexes[k] for k in pending]
+        print(journal_file.summary(total_subs))
 
-        # Concatenate the text of the current batch of subtitles using the unique separator
-        batch_text = separator.join([sub.text for sub in batch])
+    # Pack the blocks into requests by the token counts of the text that is sent
+    prompt_tokens = sum(batching.count_tokens(message['content'], openai_model) for message in system_messages)
+    batches = batching.plan_batches([replace_numbers(sub.text) for sub in remote_subs], openai_model, separator,
+                                    input_tokens_per_request, max_blocks_per_request, output_ratio, prompt_tokens)
 
-        # First, replace numbers with words in the entire batch
-        modified_batch_text = replace_numbers(batch_text)
+    # Process subtitles in batches
+    for start, end in batches:
+        batch = remote_subs[start:end]
 
-        # Then, use OpenAI to intelligently replace Latin variables and adjust grammar
-        modified_batch_text = use_openai_for_replacements(modified_batch_text)
+        texts = [sub.text for sub in batch]
 
-        # Split the modified text back into individual subtitle blocks using the unique separator
-        modified_batch_texts = modified_batch_text.split(separator)
+        # Look the batch and its blocks up in the translation memory; only the unknown blocks are sent
+        memory = get_memory()
+        modified_batch_texts = memory.get_blocks(texts, separator) if memory else [None] * len(texts)
+        missing = [i for i, text in enumerate(modified_batch_texts) if text is None]
 
-        # Check if the lengths match
-        if len(modified_batch_texts) != len(batch):
-            print(f"Warning: Mismatch in lengths. Expected {len(batch)}, got {len(modified_batch_texts)}.")
-            # Handle the mismatch if necessary
-            continue  # Skip this batch or handle accordingly
+        if missing:
+            with metrics.span('verbalize.batch', first_block=start + 1, blocks=len(missing)):
+                answers = verbalize_blocks([texts[i] for i in missing], stats)
+            for i, answer in zip(missing, answers):
+                modified_batch_texts[i] = answer
 
         # Update each subtitle block with the modified text
         for i, sub in enumerate(batch):
             sub.text = modified_batch_texts[i]
             modified_subs.append(sub)
+        if journal_file:
+            journal_file.append(remote_indexes[start:end], modified_batch_texts)
 
         # Print the progress of processing subtitle blocks in batches
-        print(f"Verbalized blocks {start + 1} to {end} of {total_subs}...")
+        cached = len(batch) - len(missing)
+        print(f"Verbalized blocks {start + 1} to {end} of {len(remote_subs)} sent to OpenAI..."
+              + (f" ({cached} from translation memory)" if cached else ""))
+
+    if total_subs:
+        print(f"Blocks handled locally: {local_count} ({local_count / total_subs:.0%}), "
+              f"remotely: {remote_count} ({remote_count / total_subs:.0%})")
+    print(stats.summary())
+    memory = get_memory()
+    if memory:
+        print(memory.summary())
+        memory.evict()
 
     # Save the modified subtitles to the output file
-    subs.save(output_file, encoding='utf-8')
+    if store:
+        store.set_column('blocks', 'verbalized', [sub.text for sub in subs])
+        store.export_srt(output_file, 'verbalized')
+    else:
+        journal.save_subs_atomic(subs, output_file)
+    if journal_file:
+        journal_file.complete()
+
+# Function to describe everything that changes the verbalized output, for the incremental mode
+def stage_params():
+    return {'model': openai_model, 'messages': system_messages,
+            'input_tokens_per_request': input_tokens_per_request, 'max_blocks_per_request': max_blocks_per_request,
+            'local_rules': verbalizer.rules_version if use_local_verbalizer else None}
 
 # Function to process all SRT files in the specified directory
-def process_directory(input_dir, output_dir):
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.srt'):
+def process_directory(input_dir, output_dir, cache=None):
+    cache = cache or StageCache('verbalize', stage_params())
+    for filename in sorted(os.listdir(input_dir)):
+        if filename.endswith('.srt') and not filename.endswith(translated_suffixes):
             input_file = os.path.join(input_dir, filename)
             # Change name if requiered
             output_file = os.path.join(output_dir, filename.replace('.srt', '.srt'))
 
+            if not cache.should_process(input_file):
+                continue
+            input_hash = cache.input_hash(input_file)
+
             print(f"\nProcessing {input_file}...")
-            process_srt_file(input_file, output_file)
+            try:
+                process_srt_file(input_file, output_file)
+            except journal.JournalLocked as e:
+                print(f"Skipped: {e}")
+                continue
+            cache.record(input_file, input_hash, [output_file])
             print(f"Processed {input_file} -> {output_file}")
+    cache.print_summary()
 
 # Main function to run the script
 def main():
+    global use_translation_memory, use_journal, use_local_verbalizer, input_tokens_per_request, max_blocks_per_request
+
     parser = argparse.ArgumentParser(description="Process SRT files in a directory to replace numbers with words and Latin variables with their equivalents, using OpenAI.")
     parser.add_argument("--input_dir", default=input_dir, help="Path to the input directory containing SRT files")
     parser.add_argument("--output_dir", default=output_dir, help="Path to the output directory (optional, defaults to input directory)")
+    parser.add_argument("--batch_tokens", type=int, default=input_tokens_per_request, help="Subtitle tokens packed into one request")
+    parser.add_argument("--max_blocks", type=int, default=max_blocks_per_request, help="Most subtitle blocks in one request")
+    parser.add_argument("--llm_only", action="store_true", help="Send every block to OpenAI, without the rule-based verbalizer")
+    parser.add_argument("--no_memory", action="store_true", help="Do not use or fill the translation memory")
+    parser.add_argument("--no_journal", action="store_true", help="Do not journal finished batches (a crashed run starts over)")
+    add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    metrics.configure_from_args('verbalize', args)
+
+    use_translation_memory = not args.no_memory
+    use_journal = not args.no_journal
+    use_local_verbalizer = not args.llm_only
+    input_tokens_per_request = max(1, args.batch_tokens)
+    max_blocks_per_request = max(1, args.max_blocks)
 
     # Check if the input directory exists
     if not os.path.exists(args.input_dir):
@@ -145,7 +307,9 @@ def main():
         return
 
     # Process all SRT files in the directory
-    process_directory(args.input_dir, args.output_dir)
+    process_directory(args.input_dir, args.output_dir, StageCache.from_args('verbalize', stage_params(), args))
+    if memory:
+        memory.close()
     print("All files verbalized.\n\n")
 
 if __name__ == "__main__":
@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
 
+import asyncio
+import json
 import os
 import pysrt
 import sys
+import threading
 import time
+import argparse
 from pathlib import Path
 
+import batching
+import journal
+import metrics
+import rate_limit
+import transcript_store
+import transcription
+import translation_memory
+from stage_cache import StageCache, add_cache_arguments
+
 # Paths to directories
 base_dir = Path(__file__).resolve().parent.parent
 input_dir = base_dir / 'data' / 'output'
@@ -17,37 +31,74 @@ os.makedirs(output_dir, exist_ok=True)
 
 # Getting the API key from the file
 def get_api_key():
-    """Reads the OpenAI API key from a file."""
+    """Reads the OpenAI API key from a file. Raises RuntimeError if there is none."""
     try:
         with open('api_key.txt', 'r') as f:
-            api_key = f.read().strip()
-        return api_key
+            return f.read().strip()
     except FileNotFoundError:
-        print("Error: 'api_key.txt' not found. Please ensure the file exists.")
-        sys.exit(1)
+        raise RuntimeError("'api_key.txt' not found. Please ensure the file exists.")
+
+# The key is read once, by main() or the pipeline, before any file is translated
+api_key = None
+
+def load_api_key():
+    global api_key
+    if api_key is None:
+        api_key = get_api_key()
 
-client = OpenAI(api_key=get_api_key())
+# API endpoint; None uses OpenAI (or OPENAI_BASE_URL). Point it at stub_openai_server.py for local tests.
+openai_base_url = None
 
-# Configuration for batch processing
-blocks_per_request = 10  # Number of subtitle blocks to send in one request
+# Configuration for batch processing: blocks are packed into a request up to a token budget
+input_tokens_per_request = batching.input_tokens_per_request  # Subtitle text per request, without the prompt
+max_blocks_per_request = batching.max_blocks_per_request
+output_ratio = 1.5  # Expected answer tokens per input token, with headroom (Ukrainian runs a little longer than Russian)
 separator = "<|SUB_SEPARATOR|>"  # Unique separator to join subtitle texts
 
-# Function to translate a batch of texts using OpenAI GPT-4
+# Concurrency and rate budget, replacing the fixed pause between requests
+max_concurrent_requests = 8
+requests_per_minute = 500
+tokens_per_minute = 30000
+
+# One budget for every file translated by this process, also when files are translated from several threads
+limiter = rate_limit.RateLimiter(requests_per_minute, tokens_per_minute)
+
+# Function to create the API client. Async clients belong to one event loop, so every file run gets its own.
+def make_client():
+    # Retries are done by request_translation, which also honors Retry-After
+    load_api_key()
+    return AsyncOpenAI(api_key=api_key, base_url=openai_base_url, max_retries=0)
+
 # New models are "o1-preview" and "o1-mini".
 # gpt-4o-2024-08-06:    approximately   $0.030 per 15 min srt file
 # o1-mini:              approximately   $0.036 per 15 min srt file
 # o1-preview:           approximately   $0.18 per 15 min srt file
-def translate_text_batch(text_batch, source_language="ru", target_language="uk"):
-    try:
-        response = client.chat.completions.create(model="gpt-4o-2024-08-06",
-        messages=[
-            {
-                "role": "system", "content": (
-                    f"""You are a translator. Translate the following text from {source_language} to {target_language}.
-The text is from a mathematical lecture (algebra and geometry), so please use the correct mathematical terminology in {target_language}.
-Important: Do not replace letter representations of mathematical symbols with the symbols themselves or use mathematical notation.
-Instead, replace the {source_language} letters representing mathematical symbols with {target_language} letters or letter combinations that convey the same pronunciation, considering the nuances of the {target_language} language.
-For example:
+openai_model = "gpt-4o-2024-08-06"
+source_language = "ru"
+
+# Every target language gets its own output, <name>_<language>.srt. The file is read and batched once, and the
+# requests of all languages run side by side under the one rate budget.
+target_languages = ["uk"]
+supported_languages = transcription.translation_languages  # Shared with 03 and 04, which skip their outputs
+
+# Several languages per request: one structured-output call answers a batch in every language, so the
+# instructions and the subtitle text are sent once instead of once per language
+combined_requests = False
+
+# Finished batches are journaled, so a run that dies midway resumes where it stopped
+use_journal = True
+
+# Answers already paid for are kept in the translation memory and not requested again
+use_translation_memory = True
+memories = {}  # One per target language, and one per language and language set of the combined requests
+memory_lock = threading.Lock()
+
+# Translations live next to their sources; they are not translated again
+translated_suffixes = transcription.translated_suffixes
+
+# Examples and terminology preferences for a target language, part of the translator instructions
+language_notes = {
+    'uk': """For example:
 - Replace 'икс' with 'ікс'.
 - Replace 'аШ' with 'аШ'.
 - Replace 'С-один' with 'С-один'.
@@ -63,84 +114,499 @@ For example:
 - Use 'точка' instead of 'крапка'.
 - Use 'степінь' (masculine) instead of 'ступінь' (feminine).
 - Use 'додатні' instead of 'позитивні'.
-Please ensure that multiple subtitle blocks are separated by the unique separator "<|SUB_SEPARATOR|>" and translate each block individually while preserving the separator."""
-                )
-            },
-            {"role": "user", "content": f"{text_batch}"}
-        ],
-        max_tokens=1500 * blocks_per_request,  # Adjust max_tokens based on batch size
-        temperature=0.3)
-        translated_text = response.choices[0].message.content.strip()
-        return translated_text
-    except Exception as e:
-        print(f"Error during batch translation: {e}")
-        return text_batch.replace(separator, '\n')  # Return the original text in case of an error
+""",
+}
+default_notes = """- Do not introduce mathematical symbols or Greek letters in the translation. Write every designation the way it is pronounced in {target_language}.
+"""
+
+def notes_for(target_language):
+    return language_notes.get(target_language, default_notes).format(target_language=target_language)
+
+# Function to build the translator instructions for a language pair
+def translation_prompt(source_language, target_language):
+    return (f"""You are a translator. Translate the following text from {source_language} to {target_language}.
+The text is from a mathematical lecture (algebra and geometry), so please use the correct mathematical terminology in {target_language}.
+Important: Do not replace letter representations of mathematical symbols with the symbols themselves or use mathematical notation.
+Instead, replace the {source_language} letters representing mathematical symbols with {target_language} letters or letter combinations that convey the same pronunciation, considering the nuances of the {target_language} language.
+""" + notes_for(target_language)
+            + """Please ensure that multiple subtitle blocks are separated by the unique separator "<|SUB_SEPARATOR|>" and translate each block individually while preserving the separator.""")
+
+# Function to build the instructions of a request that translates into several languages at once
+def combined_prompt(source_language, target_languages):
+    languages = ', '.join(target_languages)
+    return (f"""You are a translator. Translate the following text from {source_language} into each of these languages: {languages}.
+The text is from a mathematical lecture (algebra and geometry), so please use the correct mathematical terminology in every language.
+Important: Do not replace letter representations of mathematical symbols with the symbols themselves or use mathematical notation.
+Instead, replace the {source_language} letters representing mathematical symbols with letters or letter combinations of the target language that convey the same pronunciation.
+""" + ''.join(f"For {language}:\n{notes_for(language)}" for language in target_languages)
+            + f"""The subtitle blocks of the text are separated by the unique separator "{separator}". Translate each block individually.
+Answer with a JSON object with one key per language code ({languages}). The value of a key is the list of the translated blocks
+in that language: exactly one list item per subtitle block, in the original order.""")
+
+# Structured-output schema of a combined request: one list of blocks per language
+def combined_response_format(target_languages):
+    return {'type': 'json_schema', 'json_schema': {'name': 'translations', 'strict': True, 'schema': {
+        'type': 'object',
+        'properties': {language: {'type': 'array', 'items': {'type': 'string'}} for language in target_languages},
+        'required': list(target_languages),
+        'additionalProperties': False,
+    }}}
+
+# Function to open the translation memory of a language once per process (None if it is switched off)
+# Answers of combined requests come from another prompt than those of single-language requests, so they are
+# kept apart: combined_languages is the language set of the combined request, None for a single language.
+def get_memory(language, combined_languages=None):
+    key = (language, tuple(combined_languages) if combined_languages else None)
+    with memory_lock:
+        if key not in memories and use_translation_memory:
+            params = {
+                'task': 'translate',
+                'model': openai_model,
+                'prompt': translation_prompt(source_language, language),
+                'source_language': source_language,
+                'target_language': language,
+            }
+            if combined_languages:
+                params.update(prompt=combined_prompt(source_language, combined_languages), languages=list(combined_languages))
+            memories[key] = translation_memory.TranslationMemory(params)
+        return memories.get(key)
+
+# Function to send one translation request.
+# Waits for the rate budget, retries rate limits, timeouts and server errors with backoff, and
+# returns None if the batch cannot be translated. languages is the number of languages in the answer.
+async def request_translation(client, prompt, text_batch, stats=None, blocks=1, rerequest=False, languages=1,
+                              response_format=None, label=''):
+    input_tokens = batching.count_tokens(text_batch, openai_model)
+    max_tokens = batching.max_tokens_for(input_tokens * languages, openai_model, output_ratio)
+    # Budget the prompt plus the longest answer we allow
+    estimated_tokens = batching.count_tokens(prompt, openai_model) + input_tokens + max_tokens
+    options = {'response_format': response_format} if response_format else {}
+
+    for attempt in range(rate_limit.max_retries + 1):
+        await limiter.acquire(estimated_tokens)
+        request_start = time.time()
+        try:
+            with metrics.span('translate.api_call', blocks=blocks, attempt=attempt, rerequest=rerequest, languages=languages):
+                response = await client.chat.completions.create(model=openai_model,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": f"{text_batch}"}
+                ],
+                max_tokens=max_tokens,
+                temperature=0.3,
+                **options)
+            translated_text = response.choices[0].message.content.strip()
+            if response.usage is not None:
+                limiter.refund(estimated_tokens, response.usage.total_tokens)
+                prompt_tokens, completion_tokens = response.usage.prompt_tokens, response.usage.completion_tokens
+            else:
+                prompt_tokens, completion_tokens = estimated_tokens - max_tokens, batching.count_tokens(translated_text, openai_model)
+            if stats is not None:
+                stats.record(blocks, prompt_tokens, completion_tokens, time.time() - request_start, rerequest, label=label)
+            if response.choices[0].finish_reason == 'length':
+                print(f"Warning: the answer was cut off at max_tokens={max_tokens}")
+                metrics.increment('llm_truncated_answers', stage='translate')
+            metrics.observe('llm_retries', attempt, stage='translate')
+            return translated_text
+        except openai.RateLimitError as e:
+            # Everyone waits as long as the server asks; without a header, back off
+            delay = rate_limit.retry_after_seconds(e) or rate_limit.backoff_delay(attempt)
+            limiter.pause(delay)
+            metrics.increment('llm_retried_errors', stage='translate', error='rate_limit')
+            print(f"Rate limited, retrying in {delay:.1f} s (attempt {attempt + 1})")
+        except (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError) as e:
+            delay = rate_limit.backoff_delay(attempt)
+            metrics.increment('llm_retried_errors', stage='translate', error=e.__class__.__name__)
+            print(f"Request failed ({e.__class__.__name__}), retrying in {delay:.1f} s (attempt {attempt + 1})")
+        except Exception as e:
+            print(f"Error during batch translation: {e}")
+            break
+        await asyncio.sleep(delay)
+
+    metrics.increment('llm_failed_requests', stage='translate')
+    return None
+
+# Function to translate a batch of texts into one language using OpenAI GPT-4.
+async def translate_text_batch(client, text_batch, source_language="ru", target_language="uk", stats=None, blocks=1, rerequest=False):
+    return await request_translation(client, translation_prompt(source_language, target_language), text_batch, stats,
+                                     blocks, rerequest, label=language_label(target_language))
 
-# Function to process a single SRT file with batch translation
-def process_srt_file(input_file, output_file):
+# Function to translate a batch of texts into several languages in one structured-output request
+async def translate_text_batch_combined(client, text_batch, source_language, target_languages, stats=None, blocks=1, rerequest=False):
+    return await request_translation(client, combined_prompt(source_language, target_languages), text_batch, stats, blocks,
+                                     rerequest, languages=len(target_languages),
+                                     response_format=combined_response_format(target_languages),
+                                     label=f"[{','.join(target_languages)}] ")
+
+# Prefix of the progress lines of a language, only needed when there is more than one
+def language_label(language):
+    return f"[{language}] " if len(target_languages) > 1 else ""
+
+# Function to translate a list of block texts into one language in one request. If the answer does not split into
+# one part per block, the blocks are bisected and only the halves are requested again, down to single blocks.
+# Returns the answers, with None for the blocks whose request failed.
+async def translate_blocks(client, semaphore, texts, language, stats=None, rerequest=False):
+    batch_text = separator.join(texts)
+    queued_at = time.perf_counter()
+    async with semaphore:
+        metrics.observe('llm_queue_seconds', time.perf_counter() - queued_at, stage='translate')
+        translated_batch_text = await translate_text_batch(client, batch_text, source_language=source_language, target_language=language,
+                                                           stats=stats, blocks=len(texts), rerequest=rerequest)
+    if translated_batch_text is None:
+        return [None] * len(texts)
+
+    # Split the translated text back into individual subtitle blocks using the unique separator
+    answers = batching.split_answer(translated_batch_text, separator, len(texts))
+    if answers is not None:
+        memory = get_memory(language)
+        if memory:
+            memory.put_batch(texts, answers, separator)
+        return answers
+
+    if stats is not None:
+        stats.record_mismatch(len(texts), len(translated_batch_text.split(separator)))
+    middle = len(texts) // 2
+    first, second = await asyncio.gather(translate_blocks(client, semaphore, texts[:middle], language, stats, rerequest=True),
+                                         translate_blocks(client, semaphore, texts[middle:], language, stats, rerequest=True))
+    return first + second
+
+# Function to split the JSON answer of a combined request into {language: one answer per block}.
+# Returns None if the answer is not valid or a language has the wrong number of blocks.
+def split_combined_answer(answer, languages, blocks):
     try:
-        subs = pysrt.open(input_file, encoding='utf-8')
-    except Exception as e:
-        print(f"Error loading subtitle file '{input_file}': {e}")
-        return  # Exit the function if loading fails
+        data = json.loads(answer)
+    except ValueError:
+        return None
+    answers = {}
+    for language in languages:
+        values = data.get(language) if isinstance(data, dict) else None
+        if not isinstance(values, list):
+            return None
+        if blocks == 1:
+            # A single block cannot be misaligned
+            values = [' '.join(str(value) for value in values)]
+        if len(values) != blocks:
+            return None
+        answers[language] = [str(value).replace(separator, ' ').strip() for value in values]
+    return answers
 
-    total_subs = len(subs)  # Get the total number of subtitle blocks
+# Function to translate a list of block texts into several languages in one request, with the same bisection
+# as translate_blocks. A single block whose combined answer is unusable is requested once per language.
+# Returns {language: answers}, with None for the blocks whose request failed.
+async def translate_blocks_combined(client, semaphore, texts, languages, stats=None, rerequest=False):
+    batch_text = separator.join(texts)
+    queued_at = time.perf_counter()
+    async with semaphore:
+        metrics.observe('llm_queue_seconds', time.perf_counter() - queued_at, stage='translate')
+        answer = await translate_text_batch_combined(client, batch_text, source_language, languages, stats=stats,
+                                                     blocks=len(texts), rerequest=rerequest)
+    if answer is None:
+        return {language: [None] * len(texts) for language in languages}
 
-    # Process subtitles in batches
-    for start in range(0, total_subs, blocks_per_request):
-        end = min(start + blocks_per_request, total_subs)
-        batch = subs[start:end]
+    answers = split_combined_answer(answer, languages, len(texts))
+    if answers is not None:
+        for language in languages:
+            memory = get_memory(language, languages)
+            if memory:
+                memory.put_batch(texts, answers[language], separator)
+        return answers
 
-        # Concatenate the text of the current batch of subtitles using the unique separator
-        batch_text = separator.join([sub.text.replace('\n', ' ') for sub in batch])  # Replace newlines to maintain block integrity
+    if stats is not None:
+        stats.record_mismatch(len(texts), 0)
+    if len(texts) == 1:
+        results = await asyncio.gather(*(translate_blocks(client, semaphore, texts, language, stats, rerequest=True)
+                                         for language in languages))
+        return dict(zip(languages, results))
+    middle = len(texts) // 2
+    first, second = await asyncio.gather(translate_blocks_combined(client, semaphore, texts[:middle], languages, stats, rerequest=True),
+                                         translate_blocks_combined(client, semaphore, texts[middle:], languages, stats, rerequest=True))
+    return {language: first[language] + second[language] for language in languages}
 
-        # Translate the concatenated batch text
-        translated_batch_text = translate_text_batch(batch_text, source_language="ru", target_language="uk")
+# Function to put the answers of a batch into the translations of one language, and into its journal.
+# Blocks whose request failed keep their original text. Returns True if every block was translated.
+def apply_answers(indexes, answers, translations, journal_file=None):
+    done = []
+    for index, answer in zip(indexes, answers):
+        if answer is None:
+            print(f"Skipping translation for subtitle {index + 1}: the request failed.")
+            continue
+        translations[index] = answer.strip()
+        done.append(index)
+    if journal_file and done:
+        # Blocks whose request failed are not journaled, so the next run sends them again
+        journal_file.append(done, [translations[i] for i in done])
+    return len(done) == len(indexes)
 
-        # Split the translated text back into individual subtitle blocks using the unique separator
-        translated_texts = translated_batch_text.split(separator)
+# Function to look a batch up in the translation memory of a language. Returns the answers, None where unknown.
+def memory_answers(texts, language, combined_languages=None):
+    memory = get_memory(language, combined_languages)
+    return memory.get_blocks(texts, separator) if memory else [None] * len(texts)
+
+# Function to translate one batch of subtitle blocks into one language. indexes are the positions of the blocks
+# in the file. Returns {language: True if every block was translated}.
+async def translate_batch(client, semaphore, texts, indexes, language, translations, stats=None, journal_file=None):
+    request_texts = [texts[i].replace('\n', ' ') for i in indexes]  # Replace newlines to maintain block integrity
+    with metrics.span('translate.batch', first_block=indexes[0] + 1, blocks=len(indexes), language=language) as span:
+        # Only the blocks missing from the translation memory are sent
+        answers = memory_answers(request_texts, language)
+        missing = [k for k, answer in enumerate(answers) if answer is None]
+        if missing:
+            results = await translate_blocks(client, semaphore, [request_texts[k] for k in missing], language, stats)
+            for k, answer in zip(missing, results):
+                answers[k] = answer
+        complete = apply_answers(indexes, answers, translations, journal_file)
+        cached = len(indexes) - len(missing)
+        span.set(cached_blocks=cached, complete=complete)
+
+    # Print the progress of processing subtitle blocks in batches
+    print(f"{language_label(language)}Translated subtitles {indexes[0] + 1} to {indexes[-1] + 1} of {len(texts)}..."
+          + (f" ({cached} from translation memory)" if cached else ""))
+    return {language: complete}
+
+# Function to translate one batch of subtitle blocks into every language that still needs some of its blocks,
+# with combined requests. pending maps a language to the positions it still needs.
+async def translate_batch_combined(client, semaphore, texts, indexes, pending, translations, stats=None, journals=None):
+    languages = [language for language in target_languages if any(i in pending[language] for i in indexes)]
+    request_texts = [texts[i].replace('\n', ' ') for i in indexes]
+    with metrics.span('translate.batch', first_block=indexes[0] + 1, blocks=len(indexes), language=','.join(languages)) as span:
+        answers = {language: memory_answers(request_texts, language, languages) for language in languages}
+        # A block is sent if one of the languages that need it does not have it in its memory
+        missing = [k for k, index in enumerate(indexes)
+                   if any(index in pending[language] and answers[language][k] is None for language in languages)]
+        if missing:
+            results = await translate_blocks_combined(client, semaphore, [request_texts[k] for k in missing], languages, stats)
+            for language in languages:
+                for k, answer in zip(missing, results[language]):
+                    if answers[language][k] is None:
+                        answers[language][k] = answer
+        complete = {}
+        for language in languages:
+            own = [k for k, index in enumerate(indexes) if index in pending[language]]
+            complete[language] = apply_answers([indexes[k] for k in own], [answers[language][k] for k in own],
+                                               translations[language], journals.get(language))
+        span.set(cached_blocks=len(indexes) - len(missing), complete=all(complete.values()))
+
+    print(f"[{','.join(languages)}] Translated subtitles {indexes[0] + 1} to {indexes[-1] + 1} of {len(texts)}..."
+          + (f" ({len(indexes) - len(missing)} from translation memory)" if len(missing) < len(indexes) else ""))
+    return complete
+
+# Function to translate all batches of a file into every target language concurrently. Blocks already in a
+# language's journal are not sent again for it. Returns {language: texts} (blocks whose request failed keep
+# the original text) and the results of the batches.
+async def translate_subs(texts, stats=None, journals=None):
+    journals = journals or {}
+    translations = {}
+    pending = {}
+    for language in target_languages:
+        translations[language] = list(texts)
+        pending[language] = set(range(len(texts)))
+        journal_file = journals.get(language)
+        if journal_file and journal_file.done:
+            for i, text in journal_file.done.items():
+                translations[language][i] = text
+            pending[language] -= journal_file.done.keys()
+            print(language_label(language) + journal_file.summary(len(texts)))
+    # Blocks needed by any language; they are batched once for all languages
+    needed = sorted(set().union(*pending.values()))
+    if not needed:
+        return translations, []
+
+    combined = combined_requests and len(target_languages) > 1
+    client = make_client()
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    try:
+        # Pack the blocks into requests by their token counts; a combined answer is as long as all languages together
+        request_texts = [texts[i].replace('\n', ' ') for i in needed]
+        if combined:
+            prompt_tokens = batching.count_tokens(combined_prompt(source_language, target_languages), openai_model)
+            ratio = output_ratio * len(target_languages)
+        else:
+            prompt_tokens = max(batching.count_tokens(translation_prompt(source_language, language), openai_model)
+                                for language in target_languages)
+            ratio = output_ratio
+        batches = batching.plan_batches(request_texts, openai_model, separator, input_tokens_per_request, max_blocks_per_request,
+                                        ratio, prompt_tokens)
+        tasks = []
+        for start, end in batches:
+            indexes = needed[start:end]
+            if combined:
+                tasks.append(translate_batch_combined(client, semaphore, texts, indexes, pending, translations, stats, journals))
+                continue
+            # Batch after batch, every language in turn, so all languages make progress together
+            for language in target_languages:
+                language_indexes = [i for i in indexes if i in pending[language]]
+                if language_indexes:
+                    tasks.append(translate_batch(client, semaphore, texts, language_indexes, language,
+                                                 translations[language], stats, journals.get(language)))
+        return translations, await asyncio.gather(*tasks)
+    finally:
+        await client.close()
 
-        # Check if the number of translated texts matches the number of original blocks
-        if len(translated_texts) != len(batch):
-            print(f"Warning: Mismatch in number of translated blocks. Expected {len(batch)}, got {len(translated_texts)}.")
-            # Handle the mismatch by skipping this batch
-            for sub in batch:
-                print(f"Skipping translation for subtitle starting at {sub.start} due to mismatch.")
-            continue  # Skip this batch
+# Function to name the outputs of an input SRT: one per target language
+def output_paths(input_file, directory=None):
+    name = Path(input_file).name
+    return {language: Path(directory or output_dir) / name.replace('.srt', f'_{language}.srt') for language in target_languages}
 
-        # Assign the translated texts back to the subtitle blocks
-        for i, sub in enumerate(batch):
-            sub.text = translated_texts[i].strip()
+# Function to open the journals of every target language. Raises JournalLocked if another worker holds one.
+def open_journals(input_file):
+    journals = {}
+    try:
+        for language in target_languages:
+            journals[language] = journal.Journal.open('translate', input_file, language_params(language))
+    except journal.JournalLocked:
+        close_journals(journals)
+        raise
+    return journals
 
-        # Print the progress of processing subtitle blocks in batches
-        print(f"Translated subtitles {start + 1} to {end} of {total_subs}...")
+def close_journals(journals):
+    for journal_file in journals.values():
+        journal_file.close()
 
-        # Add a delay between API requests to avoid hitting rate limits
-        time.sleep(0.5)  # Adjust the sleep duration as needed
+# Function to process a single SRT file with batch translation. output_files maps a language to its output.
+def process_srt_file(input_file, output_files):
+    journals = open_journals(input_file) if use_journal else {}
+    try:
+        with metrics.span('translate.file', file=os.path.basename(input_file), target_languages=','.join(target_languages)):
+            _process_srt_file(input_file, output_files, journals)
+    finally:
+        close_journals(journals)
 
-    # Save the translated file while preserving the timestamps
+def _process_srt_file(input_file, output_files, journals=None):
+    journals = journals or {}
     try:
-        subs.save(output_file, encoding='utf-8')
+        # An SRT that is still the export of its transcript store is read from the store's blocks
+        store, column = transcript_store.open_for_srt(input_file)
+        subs = store.subrip(column) if store else pysrt.open(input_file, encoding='utf-8')
     except Exception as e:
-        print(f"Error saving subtitle file '{output_file}': {e}")
+        print(f"Error loading subtitle file '{input_file}': {e}")
+        return  # Exit the function if loading fails
+
+    start_time = time.time()
+    stats = batching.RequestStats('translate')
+    translations, results = asyncio.run(translate_subs([sub.text for sub in subs], stats, journals))
+    elapsed = time.time() - start_time
+    print(f"Translated {sum(all(result.values()) for result in results)} of {len(results)} batches "
+          f"into {', '.join(target_languages)} in {elapsed:.2f} s ({max_concurrent_requests} concurrent requests at most)")
+    print(stats.summary())
+    for (language, _), memory in list(memories.items()):
+        if memory and language in target_languages:
+            print(language_label(language) + memory.summary())
+    if memories:
+        # All languages share one database
+        next(iter(memories.values())).evict()
+
+    for language in target_languages:
+        output_file = output_files[language]
+        # Save the translated file while preserving the timestamps
+        try:
+            if store:
+                store.set_column('blocks', f'translated_{language}', translations[language])
+                store.export_srt(output_file, f'translated_{language}')
+            else:
+                for sub, text in zip(subs, translations[language]):
+                    sub.text = text
+                journal.save_subs_atomic(subs, output_file)
+        except Exception as e:
+            print(f"Error saving subtitle file '{output_file}': {e}")
+            continue
+        # With failed blocks the journal stays, and the next run only sends those
+        journal_file = journals.get(language)
+        if journal_file and all(result.get(language, True) for result in results):
+            journal_file.complete()
+
+# Function to describe everything that changes the translation into one language
+def language_params(language):
+    params = {
+        'model': openai_model,
+        'prompt': translation_prompt(source_language, language),
+        'source_language': source_language,
+        'target_language': language,
+        'input_tokens_per_request': input_tokens_per_request,
+        'max_blocks_per_request': max_blocks_per_request,
+    }
+    if combined_requests and len(target_languages) > 1:
+        # The journal of a language must not hand answers of combined requests to a single-language run
+        params['combined_prompt'] = combined_prompt(source_language, target_languages)
+    return params
+
+# Function to describe everything that changes the translation, for the incremental mode.
+# A single language keeps the parameters of the single-language stage, so its cached results stay valid.
+def stage_params():
+    if len(target_languages) == 1:
+        return language_params(target_languages[0])
+    return {
+        'languages': [language_params(language) for language in target_languages],
+        'combined_requests': combined_requests,
+    }
 
 # Function to process all SRT files in the input directory
-def process_directory(input_dir, output_dir):
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.srt'):
+def process_directory(input_dir, output_dir, cache=None):
+    cache = cache or StageCache('translate', stage_params())
+    for filename in sorted(os.listdir(input_dir)):
+        if filename.endswith('.srt') and not filename.endswith(translated_suffixes):
             input_file = input_dir / filename
 
-            # Remove 'verbalized' from the filename and add '_uk' before the extension
-            output_filename = filename.replace('.srt', '_uk.srt')
-            output_file = output_dir / output_filename
+            # One output per language, with '_<language>' before the extension
+            output_files = output_paths(input_file, output_dir)
+
+            if not cache.should_process(input_file):
+                continue
+            input_hash = cache.input_hash(input_file)
 
             print(f"Processing {input_file}...")
-            process_srt_file(input_file, output_file)
-            print(f"Processed {input_file} -> {output_file}\n\n")
+            try:
+                process_srt_file(input_file, output_files)
+            except journal.JournalLocked as e:
+                print(f"Skipped: {e}")
+                continue
+            written = [path for path in output_files.values() if path.exists()]
+            if written:
+                cache.record(input_file, input_hash, written)
+            print(f"Processed {input_file} -> {', '.join(path.name for path in output_files.values())}\n\n")
+    cache.print_summary()
 
 # Main function to run the script
 def main():
-    process_directory(input_dir, output_dir)
+    global openai_base_url, max_concurrent_requests, limiter, use_translation_memory, use_journal, input_tokens_per_request, max_blocks_per_request
+    global target_languages, combined_requests
+
+    parser = argparse.ArgumentParser(description="Translate the SRT files in the output directory with OpenAI.")
+    parser.add_argument("--base_url", default=openai_base_url, help="OpenAI-compatible API endpoint, e.g. a local stub server")
+    parser.add_argument("--target_languages", nargs='+', choices=supported_languages, default=target_languages,
+                        help="Languages to translate into, each with its own output file (default: %(default)s)")
+    parser.add_argument("--combined", action="store_true",
+                        help="Translate into all target languages with one structured-output request per batch (needs a model with JSON schema support)")
+    parser.add_argument("--concurrency", type=int, default=max_concurrent_requests, help="Maximum number of requests in flight")
+    parser.add_argument("--rpm", type=int, default=requests_per_minute, help="Requests per minute budget")
+    parser.add_argument("--tpm", type=int, default=tokens_per_minute, help="Tokens per minute budget")
+    parser.add_argument("--batch_tokens", type=int, default=input_tokens_per_request, help="Subtitle tokens packed into one request")
+    parser.add_argument("--max_blocks", type=int, default=max_blocks_per_request, help="Most subtitle blocks in one request")
+    parser.add_argument("--no_memory", action="store_true", help="Do not use or fill the translation memory")
+    parser.add_argument("--no_journal", action="store_true", help="Do not journal finished batches (a crashed run starts over)")
+    add_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('translate', args)
+
+    openai_base_url = args.base_url
+    target_languages = list(dict.fromkeys(args.target_languages))
+    combined_requests = args.combined
+    max_concurrent_requests = max(1, args.concurrency)
+    limiter = rate_limit.RateLimiter(args.rpm, args.tpm)
+    use_translation_memory = not args.no_memory
+    use_journal = not args.no_journal
+    input_tokens_per_request = max(1, args.batch_tokens)
+    max_blocks_per_request = max(1, args.max_blocks)
+
+    try:
+        load_api_key()
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    process_directory(input_dir, output_dir, StageCache.from_args('translate', stage_params(), args))
+    for memory in memories.values():
+        memory.close()
     print("All files processed.\n\n")
 
 if __name__ == "__main__":
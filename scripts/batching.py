@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Token-budget batching for the LLM stages (04_verbalize.py, 05_translate.py).
+#
+# Subtitle blocks are packed into one request until the input reaches a token budget, instead of
+# a fixed number of blocks. Short blocks then share the large system prompt in fewer requests, and
+# long blocks no longer push a reply past max_tokens, which truncates it and breaks the separator count.
+# max_tokens of every request follows from its input and the model's output limit.
+import threading
+
+import metrics
+import rate_limit
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Context window and output limit of the models we use, by name prefix (the longest matching prefix wins)
+model_limits = {
+    'gpt-4o': (128000, 16384),
+    'gpt-4o-mini': (128000, 16384),
+    'gpt-4-turbo': (128000, 4096),
+    'gpt-4': (8192, 4096),
+    'gpt-3.5-turbo': (16385, 4096),
+    'o1-mini': (128000, 65536),
+    'o1-preview': (128000, 32768),
+}
+default_limits = (8192, 4096)
+
+# Default budgets
+input_tokens_per_request = 1500  # Subtitle text per request, without the system prompt
+max_blocks_per_request = 40      # Long replies with many separators are more likely to be miscounted
+output_margin = 64               # Extra answer tokens on top of the estimate
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+def model_limit(model):
+    """Returns (context window, output limit) of a model."""
+    matches = [prefix for prefix in model_limits if model.startswith(prefix)]
+    return model_limits[max(matches, key=len)] if matches else default_limits
+
+def get_encoder(model):
+    """tiktoken encoder of the model, or None if tiktoken or its encoding files are not available."""
+    with _encoders_lock:
+        if model not in _encoders:
+            encoder = None
+            if tiktoken is not None:
+                try:
+                    encoder = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    try:
+                        encoder = tiktoken.get_encoding('o200k_base')
+                    except Exception:
+                        encoder = None
+                except Exception:
+                    # The encoding files are downloaded on first use; offline we count approximately
+                    encoder = None
+            if encoder is None:
+                print(f"tiktoken is not available for {model}, token counts are estimated from the text length")
+            _encoders[model] = encoder
+        return _encoders[model]
+
+def count_tokens(text, model):
+    encoder = get_encoder(model)
+    if encoder is None:
+        return rate_limit.estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+def plan_batches(texts, model, separator, input_budget=input_tokens_per_request, max_blocks=max_blocks_per_request,
+                 output_ratio=1.5, prompt_tokens=0):
+    """Splits the blocks into (start, end) ranges whose text fits the input budget, and whose
+    expected answer (output_ratio times the input) fits the model's output limit and context window.
+    A block larger than the budget gets a request of its own."""
+    context_window, output_limit = model_limit(model)
+    input_budget = min(input_budget,
+                       int((output_limit - output_margin) / output_ratio),
+                       int((context_window - prompt_tokens - output_margin) / (1 + output_ratio)))
+    separator_tokens = count_tokens(separator, model)
+
+    batches = []
+    start = 0
+    used = 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text, model) + (separator_tokens if i > start else 0)
+        if i > start and (used + tokens > input_budget or i - start >= max_blocks):
+            batches.append((start, i))
+            start = i
+            tokens -= separator_tokens
+            used = 0
+        used += tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+def max_tokens_for(input_tokens, model, output_ratio=1.5):
+    """max_tokens for a request: the expected answer plus a margin, within the model's output limit."""
+    return min(model_limit(model)[1], int(input_tokens * output_ratio) + output_margin)
+
+class RequestStats:
+    """Tokens and latency of every request of a run, for tuning the budgets, and the cost of
+    recovering batches whose answer did not split into one part per block. Every request also goes
+    to the metrics histograms of its stage."""
+
+    def __init__(self, stage=None):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.blocks = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        self.mismatches = 0
+        self.rerequests = 0
+        self.extra_tokens = 0
+
+    def record(self, blocks, prompt_tokens, completion_tokens, seconds, rerequest=False, label=''):
+        with self.lock:
+            self.requests += 1
+            self.blocks += blocks
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.seconds += seconds
+            if rerequest:
+                self.rerequests += 1
+                self.extra_tokens += prompt_tokens + completion_tokens
+        metrics.observe('llm_request_seconds', seconds, stage=self.stage)
+        metrics.observe('llm_prompt_tokens', prompt_tokens, stage=self.stage)
+        metrics.observe('llm_completion_tokens', completion_tokens, stage=self.stage)
+        metrics.observe('llm_request_blocks', blocks, stage=self.stage)
+        if rerequest:
+            metrics.increment('llm_rerequest_tokens', prompt_tokens + completion_tokens, stage=self.stage)
+        kind = "Re-request" if rerequest else "Request"
+        print(f"{label}{kind}: {blocks} blocks, {prompt_tokens} prompt + {completion_tokens} completion tokens, {seconds:.2f} s")
+
+    def record_mismatch(self, expected, got):
+        with self.lock:
+            self.mismatches += 1
+        metrics.increment('llm_mismatches', stage=self.stage)
+        metrics.observe('llm_mismatch_blocks', expected, stage=self.stage)
+        print(f"Warning: Mismatch in number of blocks. Expected {expected}, got {got}; splitting the batch in two.")
+
+    def summary(self):
+        if not self.requests:
+            return "No requests sent"
+        return (f"{self.requests} requests, {self.blocks / self.requests:.1f} blocks per request, "
+                f"{self.prompt_tokens} prompt + {self.completion_tokens} completion tokens, "
+                f"{self.seconds / self.requests:.2f} s average latency, "
+                f"{self.completion_tokens / self.seconds if self.seconds > 0 else 0:.0f} completion tokens/s"
+                + (f"; {self.mismatches} mismatches recovered with {self.rerequests} re-requests "
+                   f"({self.extra_tokens} extra tokens)" if self.mismatches else ""))
+
+def split_answer(answer, separator, blocks):
+    """Splits an answer into one part per block, or returns None if the part count is wrong.
+    A single block cannot be misaligned, so separators the model put into its answer are dropped."""
+    if blocks == 1:
+        return [answer.replace(separator, ' ').strip()]
+    parts = [part.strip() for part in answer.split(separator)]
+    return parts if len(parts) == blocks else None
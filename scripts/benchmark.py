@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# Offline benchmark suite for the audio and subtitle stages, to catch performance regressions.
+#
+# Fixtures are synthetic and reproducible from the seed, and are kept in data/benchmark/fixtures between runs:
+#   audio  tone, noise and speech-like WAV files (noise shaped by a syllable-rate envelope, with pauses),
+#          and the same audio in an .mkv container as input of the extract stage
+#   srt    Whisper-like SRT files with a given number of blocks
+# Every case runs in a forked process, so its peak memory (ffmpeg included) is measured alone.
+# The best of --repeat runs is kept.
+#
+#   python3 benchmark.py --preset quick --output data/benchmark/latest.json
+#   python3 benchmark.py --preset quick --compare data/benchmark/baseline.json   # exit code 1 on a regression
+#   python3 benchmark.py --preset full --save_baseline data/benchmark/baseline.json
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+
+import pcm_audio
+import srt_engine
+import transcript_store
+import transcription
+import vad
+from stub_model import StubModel, vocabulary
+
+# Paths to directories
+base_dir = Path(__file__).resolve().parent.parent
+benchmark_dir = base_dir / 'data' / 'benchmark'
+fixtures_dir = benchmark_dir / 'fixtures'
+
+# Fixture sizes of the presets
+presets = {
+    'quick': {'audio_minutes': [1], 'audio_kinds': ['speech'], 'srt_blocks': [10, 1000, 10000]},
+    'full': {'audio_minutes': [1, 10, 60, 180], 'audio_kinds': ['tone', 'noise', 'speech'], 'srt_blocks': [10, 1000, 10000, 100000]},
+}
+suites = ('extract', 'pcm', 'vad', 'transcribe', 'reblock', 'srt_io')
+
+# Compare mode: a case is a regression when it is this much slower (or bigger) than the baseline
+time_tolerance = 0.15
+memory_tolerance = 0.20
+min_seconds_difference = 0.05  # Below this the timer noise of short cases dominates
+
+# A case whose process runs longer than this is killed and recorded as failed
+case_timeout = 4 * 3600  # seconds
+poll_interval = 1.0
+
+# ----- Fixtures -----
+
+def synthetic_chunk(kind, start_sample, length, rng):
+    t = (start_sample + np.arange(length)) / pcm_audio.SAMPLE_RATE
+    if kind == 'tone':
+        return (0.3 * np.sin(2 * np.pi * 220 * t) + 0.1 * np.sin(2 * np.pi * 660 * t)).astype(np.float32)
+    noise = rng.standard_normal(length).astype(np.float32)
+    if kind == 'noise':
+        return 0.03 * noise
+    # Speech-like: low-passed noise at a syllable rate of about 4 Hz, in phrases of a few seconds with pauses
+    voiced = np.convolve(noise, np.ones(6, dtype=np.float32) / 6, mode='same')
+    envelope = np.abs(np.sin(2 * np.pi * 4.0 * t)) ** 2
+    phrase = (np.sin(2 * np.pi * t / 7.0) + 0.3 * np.sin(2 * np.pi * t / 2.3)) > -0.4
+    return (0.2 * voiced * envelope * phrase + 0.002 * noise).astype(np.float32)
+
+def make_wav(path, seconds, kind, seed, chunk_seconds=60):
+    """Writes a 16 kHz mono 16-bit WAV chunk by chunk, so hours of audio never sit in memory."""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * pcm_audio.SAMPLE_RATE)
+    chunk = chunk_seconds * pcm_audio.SAMPLE_RATE
+    partial_path = f"{path}.part"
+    with wave.open(partial_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(pcm_audio.SAMPLE_RATE)
+        for start in range(0, total, chunk):
+            samples = synthetic_chunk(kind, start, min(chunk, total - start), rng)
+            f.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+    os.replace(partial_path, path)
+
+def make_video(wav_path, video_path):
+    """Wraps the WAV in a Matroska container, the input format of the extract stage."""
+    subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', str(wav_path), '-c:a', 'pcm_s16le', str(video_path)],
+                   check=True)
+
+def make_srt(path, blocks, seed):
+    rng = random.Random(seed)
+    t = rng.randint(0, 3000)
+    with open(path, 'w', encoding='utf-8') as f:
+        for index in range(1, blocks + 1):
+            n_words = rng.randint(1, 20)
+            duration = n_words * rng.randint(250, 500)
+            words = ' '.join(rng.choice(vocabulary) for _ in range(n_words))
+            f.write(f"{index}\n{srt_engine.format_time(t)} --> {srt_engine.format_time(t + duration)}\n{words}\n\n")
+            t += duration + rng.randint(0, 1500)
+
+def audio_fixture(kind, minutes, seed):
+    """(wav path, video path) of an audio fixture, generated on first use."""
+    name = f"{kind}_{minutes:g}min_seed{seed}"
+    wav_path = fixtures_dir / f"{name}.wav"
+    video_path = fixtures_dir / f"{name}.mkv"
+    if not wav_path.exists():
+        print(f"Generating {wav_path.name}...")
+        make_wav(wav_path, minutes * 60, kind, seed)
+    if not video_path.exists():
+        make_video(wav_path, video_path)
+    return wav_path, video_path
+
+def srt_fixture(blocks, seed):
+    path = fixtures_dir / f"blocks_{blocks}_seed{seed}.srt"
+    if not path.exists():
+        print(f"Generating {path.name}...")
+        make_srt(path, blocks, seed)
+    return path
+
+# ----- Cases: each returns a dict of metrics; 'seconds' is the timed part -----
+
+def case_extract(video_path, audio_seconds, audio_format, work_dir):
+    extract = importlib.import_module('01_audio_detach')
+    extract.video_dir = str(video_path.parent)
+    extract.audio_output_dir = work_dir
+    start_time = time.perf_counter()
+    _, _, _, error = extract.extract_audio(video_path.name, audio_format)
+    seconds = time.perf_counter() - start_time
+    if error:
+        raise RuntimeError(error)
+    return {'seconds': seconds, 'rtf': seconds / audio_seconds}
+
+def case_pcm(wav_path, audio_seconds, work_dir):
+    start_time = time.perf_counter()
+    audio = pcm_audio.load_pcm(wav_path)
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'rtf': seconds / audio_seconds, 'samples': len(audio)}
+
+def case_vad(wav_path, audio_seconds, work_dir):
+    audio = pcm_audio.load_pcm(wav_path)
+    start_time = time.perf_counter()
+    regions = vad.detect_speech(audio)
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'rtf': seconds / audio_seconds, 'regions': len(regions)}
+
+def case_transcribe(wav_path, audio_seconds, model_name, work_dir):
+    transcription.srt_dir = transcription.txt_dir = work_dir
+    transcript_store.store_dir = Path(work_dir) / 'transcripts'
+    if model_name == 'stub':
+        model, load_seconds = StubModel(), 0.0
+    else:
+        model, load_seconds = transcription.load_model(model_name)
+    start_time = time.perf_counter()
+    _, stats = transcription.transcribe_file(model, str(wav_path), verbose=False)
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'rtf': seconds / audio_seconds, 'model_load_seconds': load_seconds,
+            'decode_seconds': stats['decode_seconds']}
+
+def case_reblock(srt_path, blocks, work_dir):
+    reblock = importlib.import_module('03_reblock')
+    output_path = os.path.join(work_dir, 'reblocked.srt')
+    start_time = time.perf_counter()
+    reblock.process_srt_file(srt_path, output_path)
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'blocks_per_s': blocks / seconds}
+
+def case_srt_read(srt_path, blocks, work_dir):
+    start_time = time.perf_counter()
+    srt_engine.read_srt(srt_path)
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'blocks_per_s': blocks / seconds}
+
+def case_srt_write(srt_path, blocks, work_dir):
+    table = srt_engine.read_srt(srt_path)
+    texts = [' '.join(table.words[:10])] * len(table)
+    output_path = os.path.join(work_dir, 'written.srt')
+    start_time = time.perf_counter()
+    srt_engine.write_srt(output_path, zip(table.starts.tolist(), table.ends.tolist(), texts))
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'blocks_per_s': blocks / seconds}
+
+def case_pysrt_read(srt_path, blocks, work_dir):
+    import pysrt
+    start_time = time.perf_counter()
+    pysrt.open(str(srt_path), encoding='utf-8')
+    seconds = time.perf_counter() - start_time
+    return {'seconds': seconds, 'blocks_per_s': blocks / seconds}
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def _run_case(queue, function, args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            metrics = function(*args, work_dir)
+            metrics['peak_rss_mb'] = max(peak_rss_mb(resource.RUSAGE_SELF), peak_rss_mb(resource.RUSAGE_CHILDREN))
+            queue.put(metrics)
+        except Exception as e:
+            queue.put({'error': f"{type(e).__name__}: {e}"})
+
+def wait_for_case(queue, process):
+    """The metrics a case process puts, or an error if it dies without them (OOM kill, segfault) or runs too long."""
+    start_time = time.time()
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            # It may have put its result right before exiting
+            try:
+                return queue.get(timeout=poll_interval)
+            except queue_module.Empty:
+                pass
+            code = process.exitcode
+            reason = f"killed by {signal.Signals(-code).name}" if code is not None and code < 0 else f"exit code {code}"
+            return {'error': f"case process ended without a result ({reason})"}
+        if time.time() - start_time > case_timeout:
+            process.kill()
+            return {'error': f"timed out after {case_timeout} s"}
+
+def run_case(name, function, args, repeat):
+    """Runs a case repeat times in forked processes and keeps the fastest run."""
+    context = multiprocessing.get_context('fork')
+    best = None
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=_run_case, args=(queue, function, args))
+        process.start()
+        metrics = wait_for_case(queue, process)
+        process.join()
+        if 'error' in metrics:
+            print(f"  {name}: FAILED ({metrics['error']})")
+            return dict(metrics, name=name)
+        if best is None or metrics['seconds'] < best['seconds']:
+            best = metrics
+    print(f"  {name}: {format_metrics(best)}")
+    return dict(best, name=name)
+
+def format_metrics(metrics):
+    parts = [f"{metrics['seconds']:.3f} s"]
+    if 'rtf' in metrics:
+        parts.append(f"RTF {metrics['rtf']:.4f}")
+    if 'blocks_per_s' in metrics:
+        parts.append(f"{metrics['blocks_per_s']:.0f} blocks/s")
+    parts.append(f"peak {metrics['peak_rss_mb']:.0f} MB")
+    return ', '.join(parts)
+
+# Function to run the selected suites on the fixtures of a preset
+def run_suites(selected, preset, seed, repeat, model_name):
+    os.makedirs(fixtures_dir, exist_ok=True)
+    sizes = presets[preset]
+    results = []
+
+    audio_suites = [suite for suite in selected if suite in ('extract', 'pcm', 'vad', 'transcribe')]
+    if audio_suites:
+        for kind in sizes['audio_kinds']:
+            for minutes in sizes['audio_minutes']:
+                wav_path, video_path = audio_fixture(kind, minutes, seed)
+                audio_seconds = minutes * 60.0
+                label = f"{kind}_{minutes:g}min"
+                print(f"Audio {label}:")
+                if 'extract' in audio_suites:
+                    for audio_format in ('mp3', 'pcm'):
+                        results.append(run_case(f"extract_{audio_format}/{label}", case_extract,
+                                                (video_path, audio_seconds, audio_format), repeat))
+                if 'pcm' in audio_suites:
+                    results.append(run_case(f"pcm_decode/{label}", case_pcm, (wav_path, audio_seconds), repeat))
+                if 'vad' in audio_suites:
+                    results.append(run_case(f"vad/{label}", case_vad, (wav_path, audio_seconds), repeat))
+                if 'transcribe' in audio_suites:
+                    results.append(run_case(f"transcribe_{model_name}/{label}", case_transcribe,
+                                            (wav_path, audio_seconds, model_name), repeat))
+
+    for blocks in sizes['srt_blocks']:
+        if 'reblock' not in selected and 'srt_io' not in selected:
+            break
+        srt_path = srt_fixture(blocks, seed)
+        print(f"SRT {blocks} blocks:")
+        if 'reblock' in selected:
+            results.append(run_case(f"reblock/{blocks}_blocks", case_reblock, (srt_path, blocks), repeat))
+        if 'srt_io' in selected:
+            results.append(run_case(f"srt_read/{blocks}_blocks", case_srt_read, (srt_path, blocks), repeat))
+            results.append(run_case(f"srt_write/{blocks}_blocks", case_srt_write, (srt_path, blocks), repeat))
+            results.append(run_case(f"pysrt_read/{blocks}_blocks", case_pysrt_read, (srt_path, blocks), repeat))
+    return results
+
+# ----- Compare mode -----
+
+def compare(results, baseline):
+    """Prints every case against the baseline and returns the names of the regressions."""
+    known = {item['name']: item for item in baseline['results'] if 'error' not in item}
+    regressions = []
+    print(f"\n{'case':40} {'baseline s':>11} {'now s':>9} {'change':>8} {'peak MB':>15}")
+    for item in results:
+        before = known.get(item['name'])
+        if before is None:
+            continue
+        if 'error' in item:
+            # Passed in the baseline and fails now
+            print(f"{item['name']:40} {before['seconds']:11.3f} {'-':>9} {'-':>8} {'':15} FAILED")
+            regressions.append(item['name'])
+            continue
+        change = item['seconds'] / before['seconds'] - 1 if before['seconds'] > 0 else 0.0
+        slower = change > time_tolerance and item['seconds'] - before['seconds'] > min_seconds_difference
+        bigger = item['peak_rss_mb'] > before['peak_rss_mb'] * (1 + memory_tolerance)
+        flags = ' '.join(flag for flag, on in (('SLOWER', slower), ('MORE MEMORY', bigger)) if on)
+        print(f"{item['name']:40} {before['seconds']:11.3f} {item['seconds']:9.3f} {change:+8.1%} "
+              f"{before['peak_rss_mb']:7.0f}->{item['peak_rss_mb']:<7.0f} {flags}")
+        if flags:
+            regressions.append(item['name'])
+    missing = [name for name in known if name not in {item['name'] for item in results}]
+    if missing:
+        print(f"Not run this time: {', '.join(missing)}")
+    return regressions
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'ffmpeg': shutil.which('ffmpeg'), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+
+# Main function to run the benchmark suite
+def main():
+    global case_timeout
+    parser = argparse.ArgumentParser(description="Benchmark the audio and subtitle stages on reproducible synthetic fixtures.")
+    parser.add_argument("--preset", choices=sorted(presets), default='quick', help="Fixture sizes (full: audio up to 3 h, SRT up to 100k blocks)")
+    parser.add_argument("--suites", nargs='+', choices=suites, default=list(suites))
+    parser.add_argument("--model", default='stub', help="Whisper model of the transcribe suite, or 'stub' for a model that costs nothing")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Baseline JSON to compare with; exits with code 1 on a regression")
+    parser.add_argument("--save_baseline", help="Write the results as the new baseline")
+    parser.add_argument("--case_timeout", type=float, default=case_timeout, help="Seconds after which a case is killed and recorded as failed")
+    args = parser.parse_args()
+    case_timeout = args.case_timeout
+
+    results = run_suites(args.suites, args.preset, args.seed, args.repeat, args.model)
+    report = {'environment': environment(), 'preset': args.preset, 'seed': args.seed, 'repeat': args.repeat,
+              'results': results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            write_json(path, report)
+            print(f"Results written to {path}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Speed and accuracy of the CPU backends (cpu_backend.py) on a fixed reference set, to choose the backend
+# and thread count per deployment.
+#
+# The reference set is a directory of audio files, each with the checked transcript next to it:
+#   data/reference/lecture1.mp3   data/reference/lecture1.txt
+# Every backend runs in a fresh process, so its peak memory is measured alone. Reported per backend:
+#   RTF          transcription seconds per second of audio (below 1 is faster than real time)
+#   peak RSS     the largest resident memory of the process, model included
+#   WER          word error rate against the reference transcripts, and the change against fp32
+#   vs fp32      word error rate against the fp32 output, i.e. how much quantization alone changes the text
+#
+#   python3 benchmark_backends.py --backends fp32 int8 --threads 8 --output data/backends.json
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import cpu_backend
+import pcm_audio
+import transcription
+
+# Paths to directories
+base_dir = Path(__file__).resolve().parent.parent
+reference_dir = base_dir / 'data' / 'reference'
+
+non_word = re.compile(r'[^\w\s]')
+
+def normalize_words(text):
+    """Lowercase words without punctuation; ё and е count as the same letter."""
+    return non_word.sub(' ', text.lower().replace('ё', 'е')).split()
+
+def word_error_rate(reference, hypothesis):
+    """(substitutions + deletions + insertions) / reference words, by word-level edit distance."""
+    reference_words = normalize_words(reference)
+    hypothesis_words = normalize_words(hypothesis)
+    if not reference_words:
+        return 0.0 if not hypothesis_words else 1.0
+    vocabulary = {}
+    ref = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in reference_words])
+    hyp = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in hypothesis_words])
+
+    # One row of the edit distance table per reference word; insertions along the row are a running minimum
+    positions = np.arange(len(hyp) + 1)
+    row = positions.copy()
+    for word in ref:
+        diagonal = row[:-1] + (hyp != word)
+        candidates = np.empty_like(row)
+        candidates[0] = row[0] + 1
+        candidates[1:] = np.minimum(row[1:] + 1, diagonal)
+        row = np.minimum.accumulate(candidates - positions) + positions
+    return float(row[-1]) / len(ref)
+
+def list_reference_files(directory):
+    return transcription.list_media_files(directory, transcription.supported_extensions)
+
+def read_reference(audio_path):
+    text_path = os.path.splitext(audio_path)[0] + '.txt'
+    if not os.path.exists(text_path):
+        return None
+    with open(text_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Function to transcribe the reference set with one backend; runs in its own process
+def run_backend(backend, threads, model_name, directory, output_path):
+    model, load_seconds = cpu_backend.load_model(model_name, backend=backend, threads=threads)
+    files = []
+    for filename in list_reference_files(directory):
+        audio = pcm_audio.load_audio_array(os.path.join(directory, filename))
+        start_time = time.perf_counter()
+        result = transcription.transcribe_audio(model, audio, verbose=False)
+        files.append({'file': filename, 'audio_seconds': pcm_audio.duration_seconds(audio),
+                      'transcribe_seconds': time.perf_counter() - start_time, 'text': result['text']})
+        print(f"{backend}: {filename} in {files[-1]['transcribe_seconds']:.1f} s")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({'backend': backend, 'threads': cpu_backend.configure_threads(threads), 'load_seconds': load_seconds,
+                   'peak_rss_mb': cpu_backend.peak_rss_mb(), 'files': files}, f, ensure_ascii=False)
+
+# Function to run every backend in a fresh interpreter and collect its results
+def run_all(backends, threads, model_name, directory):
+    runs = {}
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        for backend in backends:
+            output_path = os.path.join(temporary_dir, f"{backend}.json")
+            command = [sys.executable, os.path.abspath(__file__), '--run_backend', backend, '--model', model_name,
+                       '--reference_dir', str(directory), '--run_output', output_path]
+            if threads:
+                command += ['--threads', str(threads)]
+            subprocess.run(command, check=True)
+            with open(output_path, 'r', encoding='utf-8') as f:
+                runs[backend] = json.load(f)
+    return runs
+
+# Function to add the real-time factor and error rates to every run
+def summarize(runs, directory):
+    references = {filename: read_reference(os.path.join(directory, filename)) for filename in list_reference_files(directory)}
+    baseline = runs.get('fp32')
+    baseline_texts = {item['file']: item['text'] for item in baseline['files']} if baseline else {}
+
+    for run in runs.values():
+        audio_seconds = sum(item['audio_seconds'] for item in run['files'])
+        run['rtf'] = sum(item['transcribe_seconds'] for item in run['files']) / audio_seconds if audio_seconds else None
+        # Error rates are weighted by words: the mean over files would overweight the short ones
+        errors = words = 0.0
+        drift = drift_words = 0.0
+        for item in run['files']:
+            reference = references.get(item['file'])
+            if reference is not None:
+                n = len(normalize_words(reference))
+                item['wer'] = word_error_rate(reference, item['text'])
+                errors += item['wer'] * n
+                words += n
+            if item['file'] in baseline_texts:
+                n = len(normalize_words(baseline_texts[item['file']]))
+                drift += word_error_rate(baseline_texts[item['file']], item['text']) * n
+                drift_words += n
+        run['wer'] = errors / words if words else None
+        run['wer_vs_fp32'] = drift / drift_words if drift_words else None
+
+    if baseline and baseline['wer'] is not None:
+        for run in runs.values():
+            run['wer_delta'] = run['wer'] - baseline['wer'] if run['wer'] is not None else None
+    return runs
+
+def format_value(value, pattern):
+    return pattern.format(value) if value is not None else '-'
+
+def print_report(runs):
+    print(f"\n{'backend':>8} {'threads':>7} {'load s':>7} {'RTF':>6} {'peak RSS MB':>12} {'WER':>7} {'dWER':>7} {'vs fp32':>8}")
+    for backend, run in runs.items():
+        print(f"{backend:>8} {run['threads']:>7} {run['load_seconds']:7.1f} {format_value(run['rtf'], '{:6.3f}')} "
+              f"{run['peak_rss_mb']:12.0f} {format_value(run['wer'], '{:7.2%}')} "
+              f"{format_value(run.get('wer_delta'), '{:+7.2%}')} {format_value(run['wer_vs_fp32'], '{:8.2%}')}")
+    baseline = runs.get('fp32')
+    for backend, run in runs.items():
+        if baseline and backend != 'fp32' and run['rtf']:
+            print(f"{backend}: {baseline['rtf'] / run['rtf']:.2f}x faster than fp32, "
+                  f"{run['peak_rss_mb'] / baseline['peak_rss_mb']:.0%} of its peak memory")
+
+# Main function to run the benchmark
+def main():
+    parser = argparse.ArgumentParser(description="Compare the CPU backends on a reference set: real-time factor, peak memory and WER.")
+    parser.add_argument("--backends", nargs='+', choices=cpu_backend.backends, default=list(cpu_backend.backends))
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch (default: all cores)")
+    parser.add_argument("--model", default=transcription.model_name, help="Whisper model to compare")
+    parser.add_argument("--reference_dir", default=reference_dir, help="Audio files with their reference .txt transcripts")
+    parser.add_argument("--output", help="Write the full report as JSON")
+    # Used by the benchmark itself to run one backend in a child process
+    parser.add_argument("--run_backend", choices=cpu_backend.backends, help=argparse.SUPPRESS)
+    parser.add_argument("--run_output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_backend:
+        run_backend(args.run_backend, args.threads, args.model, args.reference_dir, args.run_output)
+        return
+
+    if not list_reference_files(args.reference_dir):
+        print(f"No audio files in {args.reference_dir}")
+        return
+    # fp32 first: it is the baseline of the comparison
+    backends = sorted(set(args.backends), key=cpu_backend.backends.index)
+    runs = summarize(run_all(backends, args.threads, args.model, args.reference_dir), args.reference_dir)
+    print_report(runs)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(runs, f, ensure_ascii=False, indent=1)
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
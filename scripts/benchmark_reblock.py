@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Benchmark of the SRT reblocking: the array-backed engine (srt_engine.py) against the pysrt
+# implementation it replaces, on synthetic transcripts of a few hours. Both outputs are compared byte
+# for byte, and a batch of small random files checks the edge cases (odd word counts, gaps, one-word blocks).
+#
+#   python3 benchmark_reblock.py --hours 1 4 12 --check 200
+import argparse
+import importlib
+import os
+import random
+import tempfile
+import time
+
+import srt_engine
+
+reblock = importlib.import_module('03_reblock')
+
+vocabulary = ("итак рассмотрим треугольник ABC у которого угол при вершине равен икс значит сторона "
+              "равна корню из двух и мы получаем что площадь это половина произведения основания на высоту").split()
+
+# Function to write a synthetic Whisper-like SRT file
+def make_srt(path, hours, rng, max_words=20, max_gap_ms=1500):
+    end_of_file = int(hours * 3600 * 1000)
+    t = rng.randint(0, 3000)
+    index = 1
+    with open(path, 'w', encoding='utf-8') as f:
+        while t < end_of_file:
+            n_words = rng.randint(1, max_words)
+            duration = n_words * rng.randint(250, 500)
+            words = ' '.join(rng.choice(vocabulary) for _ in range(n_words))
+            if rng.random() < 0.2:
+                # Some blocks span two lines
+                cut = len(words) // 2
+                words = words[:cut].rstrip() + '\n' + words[cut:].lstrip()
+            f.write(f"{index}\n{srt_engine.format_time(t)} --> {srt_engine.format_time(t + duration)}\n{words}\n\n")
+            index += 1
+            t += duration + rng.randint(0, max_gap_ms)
+    return index - 1
+
+# Function to time one reblocking implementation
+def time_run(function, input_path, output_path):
+    start_time = time.perf_counter()
+    function(input_path, output_path)
+    return time.perf_counter() - start_time
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Function to compare both implementations on many small random files
+def check_equivalence(count, rng, directory):
+    input_path = os.path.join(directory, 'check.srt')
+    for i in range(count):
+        make_srt(input_path, rng.uniform(0.005, 0.2), rng, max_words=rng.choice((1, 3, 12, 40)), max_gap_ms=rng.choice((0, 800, 20000)))
+        reblock.process_srt_file_pysrt(input_path, os.path.join(directory, 'pysrt.srt'))
+        reblock.process_srt_file(input_path, os.path.join(directory, 'engine.srt'))
+        if read_bytes(os.path.join(directory, 'pysrt.srt')) != read_bytes(os.path.join(directory, 'engine.srt')):
+            print(f"Output differs for random file {i + 1}, kept in {directory}")
+            return False
+    print(f"Identical output on {count} random files")
+    return True
+
+# Main function to run the benchmark
+def main():
+    parser = argparse.ArgumentParser(description="Compare the array-backed SRT reblocking with the pysrt implementation.")
+    parser.add_argument("--hours", type=float, nargs='+', default=[1, 4, 12], help="Lengths of the synthetic transcripts")
+    parser.add_argument("--check", type=int, default=100, help="Number of small random files compared byte for byte")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        if args.check and not check_equivalence(args.check, rng, directory):
+            return
+
+        print(f"\n{'hours':>6} {'blocks':>8} {'pysrt s':>9} {'engine s':>9} {'speedup':>8}  output")
+        for hours in args.hours:
+            input_path = os.path.join(directory, f'{hours}h.srt')
+            blocks = make_srt(input_path, hours, rng)
+            pysrt_path = os.path.join(directory, f'{hours}h_pysrt.srt')
+            engine_path = os.path.join(directory, f'{hours}h_engine.srt')
+            pysrt_seconds = time_run(reblock.process_srt_file_pysrt, input_path, pysrt_path)
+            engine_seconds = time_run(reblock.process_srt_file, input_path, engine_path)
+            same = "identical" if read_bytes(pysrt_path) == read_bytes(engine_path) else "DIFFERENT"
+            print(f"{hours:6g} {blocks:8d} {pysrt_seconds:9.3f} {engine_seconds:9.3f} {pysrt_seconds / engine_seconds:7.1f}x  {same}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Confidence cascade for 02_transcribe.py --cascade: a small model with greedy decoding transcribes
+# everything, and only the segments it is unsure of are decoded again by the large model with beam search.
+#
+# A segment is escalated if Whisper's own confidence figures are poor:
+#   avg_logprob        below avg_logprob_threshold   (the model was unsure of its tokens)
+#   compression_ratio  above compression_threshold   (repetitive text, typical of hallucination loops)
+#   no_speech_prob     above no_speech_threshold     (text decoded where the model heard no speech)
+# The escalated segments are joined into time windows, widened a little into the silence around them,
+# decoded again and spliced in place of the small model's segments.
+#
+# A Cascade stands in for a Whisper model: transcription.transcribe_audio calls its transcribe method.
+import threading
+import time
+
+import metrics
+import pcm_audio
+import transcription
+
+# Models
+fast_model_name = "small"
+# Greedy decoding for the first pass
+fast_options = dict(transcription.decode_options, beam_size=None, best_of=None, temperature=0.0)
+
+# Escalation thresholds
+avg_logprob_threshold = -0.6
+compression_threshold = 2.2
+no_speech_threshold = 0.5
+
+# Windows
+window_padding = 0.5  # Seconds of context added on both sides, never into a segment that is kept
+merge_gap = 2.0       # Windows closer than this are decoded as one, together with the segments between them
+
+def params():
+    """Everything that changes the cascade transcript, for the incremental mode."""
+    return {'fast_model': fast_model_name, 'fast_options': fast_options, 'avg_logprob_threshold': avg_logprob_threshold,
+            'compression_threshold': compression_threshold, 'no_speech_threshold': no_speech_threshold,
+            'window_padding': window_padding, 'merge_gap': merge_gap}
+
+def escalation_reasons(segment):
+    reasons = []
+    if segment.get('avg_logprob', 0.0) < avg_logprob_threshold:
+        reasons.append('avg_logprob')
+    if segment.get('compression_ratio', 0.0) > compression_threshold:
+        reasons.append('compression_ratio')
+    if segment.get('no_speech_prob', 0.0) > no_speech_threshold:
+        reasons.append('no_speech_prob')
+    return reasons
+
+def escalation_windows(segments, flagged, audio_seconds):
+    """Merged (start, end) windows in seconds that cover the flagged segments."""
+    windows = []
+    for index in flagged:
+        segment = segments[index]
+        # Pad into the silence around the segment, but not into the neighbours that are kept
+        previous_end = segments[index - 1]['end'] if index > 0 else 0.0
+        next_start = segments[index + 1]['start'] if index + 1 < len(segments) else audio_seconds
+        start = max(0.0, min(segment['start'], max(previous_end, segment['start'] - window_padding)))
+        end = min(audio_seconds, max(segment['end'], min(next_start, segment['end'] + window_padding)))
+        if windows and start - windows[-1][1] < merge_gap:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+def splice(segments, windows, window_segments):
+    """Replaces the segments whose middle falls into a window by the segments decoded for that window."""
+    kept = [segment for segment in segments
+            if not any(start <= (segment['start'] + segment['end']) / 2 <= end for start, end in windows)]
+    spliced = sorted(kept + [segment for decoded in window_segments for segment in decoded], key=lambda segment: segment['start'])
+    for index, segment in enumerate(spliced):
+        segment['id'] = index
+    return spliced
+
+class Cascade:
+    def __init__(self, large_name=transcription.model_name, fast_name=None, backend='fp32', threads=None):
+        self.large_name = large_name
+        self.fast_name = fast_name or fast_model_name
+        self.backend = backend
+        self.threads = threads
+        self.fast_model, self.load_seconds = transcription.load_model(self.fast_name, backend, threads)
+        print(f"Loaded fast Whisper model '{self.fast_name}' in {self.load_seconds:.2f} s")
+        self.large_model = None
+        self.large_model_lock = threading.Lock()
+        self.files = []
+
+    def get_large_model(self):
+        # Loaded on the first escalation, so clean recordings never pay for it
+        with self.large_model_lock:
+            if self.large_model is None:
+                self.large_model, load_seconds = transcription.load_model(self.large_name, self.backend, self.threads)
+                self.load_seconds += load_seconds
+                print(f"Loaded Whisper model '{self.large_name}' for the escalated windows in {load_seconds:.2f} s")
+        return self.large_model
+
+    def transcribe(self, audio, verbose=True, word_timestamps=False, **_):
+        """Transcribes like a Whisper model. The decoding options of both passes come from this module
+        and transcription.decode_options, so the options of the caller are ignored."""
+        audio_seconds = pcm_audio.duration_seconds(audio)
+        fast_start = time.time()
+        with metrics.span('transcribe.cascade_fast', model=self.fast_name):
+            result = transcription.transcribe_audio(self.fast_model, audio, verbose=verbose, word_timestamps=word_timestamps,
+                                                    options=fast_options)
+        fast_seconds = time.time() - fast_start
+
+        segments = result['segments']
+        flagged = [index for index, segment in enumerate(segments) if escalation_reasons(segment)]
+        windows = escalation_windows(segments, flagged, audio_seconds)
+        large_start = time.time()
+        window_segments = []
+        for start, end in windows:
+            window_audio = audio[int(start * pcm_audio.SAMPLE_RATE):int(end * pcm_audio.SAMPLE_RATE)]
+            large_model = self.get_large_model()
+            with metrics.span('transcribe.cascade_window', model=self.large_name, start=start, end=end):
+                decoded = transcription.transcribe_audio(large_model, window_audio, verbose=False,
+                                                         word_timestamps=word_timestamps)
+            window_segments.append([transcription.shift_segment(segment, start) for segment in decoded['segments']])
+        large_seconds = time.time() - large_start
+
+        escalated_seconds = sum(end - start for start, end in windows)
+        metrics.observe('transcribe_cascade_windows', len(windows))
+        reasons = {}
+        for index in flagged:
+            for reason in escalation_reasons(segments[index]):
+                reasons[reason] = reasons.get(reason, 0) + 1
+        self.files.append({'audio_seconds': audio_seconds, 'escalated_seconds': escalated_seconds,
+                           'fast_seconds': fast_seconds, 'large_seconds': large_seconds})
+        print(f"Cascade: {len(flagged)} of {len(segments)} segments flagged "
+              f"({', '.join(f'{reason} {count}' for reason, count in reasons.items()) or 'none'}), "
+              f"{len(windows)} windows, {escalated_seconds / audio_seconds if audio_seconds else 0:.1%} of the audio "
+              f"re-decoded by '{self.large_name}'")
+
+        result['segments'] = splice(segments, windows, window_segments)
+        result['text'] = ''.join(segment['text'] for segment in result['segments'])
+        return result
+
+    def print_report(self):
+        audio_seconds = sum(item['audio_seconds'] for item in self.files)
+        escalated_seconds = sum(item['escalated_seconds'] for item in self.files)
+        fast_seconds = sum(item['fast_seconds'] for item in self.files)
+        large_seconds = sum(item['large_seconds'] for item in self.files)
+        if audio_seconds <= 0:
+            return
+        print(f"Cascade: escalated {escalated_seconds / 60:.1f} of {audio_seconds / 60:.1f} min "
+              f"({escalated_seconds / audio_seconds:.1%}) to '{self.large_name}'; "
+              f"{fast_seconds:.1f} s in '{self.fast_name}', {large_seconds:.1f} s in '{self.large_name}'")
+        if escalated_seconds > 0:
+            # The large model's speed on the escalated windows, applied to all the audio
+            large_only_seconds = large_seconds / escalated_seconds * audio_seconds
+            print(f"Estimated speedup over '{self.large_name}' alone: "
+                  f"{large_only_seconds / (fast_seconds + large_seconds):.2f}x ({large_only_seconds:.1f} s estimated)")
+        else:
+            print(f"Nothing was escalated; '{self.large_name}' was never loaded")
+
+# Function to load a cascade in place of a Whisper model. Returns it and the seconds it took, like transcription.load_model.
+def load(large_name=transcription.model_name, backend='fp32', threads=None):
+    cascade = Cascade(large_name, backend=backend, threads=threads)
+    return cascade, cascade.load_seconds
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# CPU backends for Whisper on nodes without a GPU.
+#
+#   fp32  the model as whisper.load_model returns it. On CPU Whisper downgrades fp16=True to fp32 with a warning.
+#   int8  dynamic int8 quantization of the linear layers (torch.quantization.quantize_dynamic): the weights are
+#         stored as int8 and the activations are quantized on the fly. The attention and MLP projections hold
+#         most of the weights and most of the compute, so this is where the time of a CPU decode goes.
+#
+# torch and whisper are imported inside the functions, so the thin clients never pay for them.
+import os
+import time
+
+import metrics
+
+backends = ('fp32', 'int8')
+default_backend = 'fp32'
+
+def configure_threads(threads=None):
+    """Sets the number of threads torch uses for one operation. None keeps torch's default (all cores)."""
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(max(1, min(threads, 4)))
+        except RuntimeError:
+            # Can only be set before the first parallel operation; the intra-op threads matter most anyway
+            pass
+    return torch.get_num_threads()
+
+def plain_linear_layers(module):
+    """Replaces Whisper's Linear (a subclass that casts its weights to the input dtype) by torch.nn.Linear.
+    quantize_dynamic only converts modules whose type is exactly nn.Linear."""
+    import torch
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+            linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.weight = child.weight
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            plain_linear_layers(child)
+    return module
+
+def quantize_model(model):
+    """Quantizes the linear layers of a Whisper model to int8, in place."""
+    import torch
+    model = plain_linear_layers(model.cpu().float().eval())
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def load_model(name, backend=default_backend, threads=None):
+    """Loads a Whisper model for a backend. Returns the model and the seconds it took."""
+    if backend not in backends:
+        raise ValueError(f"unknown backend {backend}, choose one of {', '.join(backends)}")
+    load_start = time.time()
+    with metrics.span('transcribe.model_load', model=name, backend=backend):
+        import whisper
+        used_threads = configure_threads(threads)
+        if backend == 'int8':
+            model = quantize_model(whisper.load_model(name, device='cpu'))
+        else:
+            model = whisper.load_model(name)
+    if backend != default_backend or threads:
+        print(f"Backend {backend}, {used_threads} threads")
+    return model, time.time() - load_start
+
+def decode_options_for(model, options):
+    """The decoding options for a model: fp16 only where the model runs on a GPU."""
+    device = getattr(model, 'device', None)
+    if options.get('fp16') and (device is None or device.type == 'cpu'):
+        return dict(options, fp16=False)
+    return options
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, in MB (Linux and macOS)."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if os.uname().sysname == 'Darwin' else peak / 1024
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Post-decode check for the usual Whisper failures, for 02_transcribe.py --repair. Only the bad windows
+# are decoded again, so a broken half minute costs half a minute of decoding instead of the whole file.
+#
+# A segment is flagged for
+#   loop         a phrase repeated over and over inside the segment, or the same text as the segment before
+#   compression  compression_ratio above Whisper's own threshold (repetitive text the loop check missed)
+#   silence      text where the energy VAD hears no speech, or high no_speech_prob with a low avg_logprob
+# The flagged windows are decoded again with Whisper's temperature fallback, which our decode_options
+# switch off. What still fails the check afterwards is patched: loops are collapsed to one repetition
+# and text over silence is dropped.
+import re
+
+import numpy as np
+
+import cascade
+import metrics
+import pcm_audio
+import transcription
+import vad
+
+# Thresholds
+compression_threshold = 2.4  # Whisper's default for falling back to a higher temperature
+no_speech_threshold = 0.6
+logprob_threshold = -1.0
+min_speech_share = 0.1       # A segment with less VAD speech under it than this is text over silence
+max_ngram = 6                # Longest repeated phrase looked for, in words
+min_repeats = 3              # Repetitions of a phrase that make a loop (single words: one more)
+min_repeated_segment_words = 3
+
+# Decoding settings for the windows: beam search with the temperature fallback Whisper does by default
+fallback_options = dict(
+    transcription.decode_options,
+    temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+    compression_ratio_threshold=compression_threshold,
+    logprob_threshold=logprob_threshold,
+    no_speech_threshold=no_speech_threshold,
+)
+
+word_pattern = re.compile(r'\w+')
+
+def params():
+    """Everything that changes the repaired transcript, for the incremental mode."""
+    return {'compression_threshold': compression_threshold, 'no_speech_threshold': no_speech_threshold,
+            'logprob_threshold': logprob_threshold, 'min_speech_share': min_speech_share, 'max_ngram': max_ngram,
+            'min_repeats': min_repeats, 'fallback_options': fallback_options}
+
+def normalized_words(text):
+    return word_pattern.findall(text.lower())
+
+def repeated_phrase(words):
+    """(start, phrase length, repetitions) of the longest run of a repeated phrase, or None if there is no loop."""
+    best = None
+    for n in range(1, max_ngram + 1):
+        needed = n * ((min_repeats + 1 if n == 1 else min_repeats) - 1)
+        run = 0
+        for i in range(len(words) - n):
+            # run counts the words equal to the word n places further on; k repetitions give n * (k - 1)
+            run = run + 1 if words[i] == words[i + n] else 0
+            if run >= needed and (best is None or run // n + 1 > best[2]):
+                best = (i - run + 1, n, run // n + 1)
+    return best
+
+def collapse_loops(text):
+    """The text with every repeated phrase kept once."""
+    words = text.split()
+    while True:
+        loop = repeated_phrase([word.lower().strip('.,!?…;:') for word in words])
+        if loop is None:
+            return ' ' + ' '.join(words) if text.startswith(' ') else ' '.join(words)
+        start, n, repetitions = loop
+        words = words[:start + n] + words[start + n * repetitions:]
+
+def speech_share(segment, speech_mask, frame_seconds):
+    first = int(segment['start'] / frame_seconds)
+    last = max(first + 1, int(np.ceil(segment['end'] / frame_seconds)))
+    frames = speech_mask[first:last]
+    return float(frames.mean()) if len(frames) else 0.0
+
+def speech_frames(audio):
+    """Speech/non-speech per VAD frame, from the regions of the energy VAD."""
+    frame_samples = int(pcm_audio.SAMPLE_RATE * vad.FRAME_MS / 1000)
+    mask = np.zeros(len(audio) // frame_samples + 1, dtype=bool)
+    for start, end in vad.detect_speech(audio):
+        mask[start // frame_samples:end // frame_samples + 1] = True
+    return mask, frame_samples / pcm_audio.SAMPLE_RATE
+
+def problems(segments, speech_mask, frame_seconds):
+    """The reasons every segment is flagged for, as a list of lists."""
+    reasons = []
+    previous_words = None
+    for segment in segments:
+        words = normalized_words(segment['text'])
+        found = []
+        if repeated_phrase(words) or (len(words) >= min_repeated_segment_words and words == previous_words):
+            found.append('loop')
+        if segment.get('compression_ratio', 0.0) > compression_threshold:
+            found.append('compression')
+        if words and (speech_share(segment, speech_mask, frame_seconds) < min_speech_share
+                      or (segment.get('no_speech_prob', 0.0) > no_speech_threshold
+                          and segment.get('avg_logprob', 0.0) < logprob_threshold)):
+            found.append('silence')
+        reasons.append(found)
+        previous_words = words
+    return reasons
+
+def patch_segments(segments, speech_mask, frame_seconds):
+    """Collapses the loops left after the re-decode and drops text over silence. Returns the segments and the number changed."""
+    patched = []
+    changed = 0
+    for segment, reasons in zip(segments, problems(segments, speech_mask, frame_seconds)):
+        if 'silence' in reasons:
+            changed += 1
+            continue
+        if 'loop' in reasons or 'compression' in reasons:
+            segment = dict(segment, text=collapse_loops(segment['text']))
+            # The word times no longer belong to the shortened text
+            segment.pop('words', None)
+            changed += 1
+        patched.append(segment)
+    return patched, changed
+
+def repair(model, audio, result, word_timestamps=False):
+    """Re-decodes the flagged windows of a result in place. Returns the result and a dict of counts."""
+    segments = result['segments']
+    speech_mask, frame_seconds = speech_frames(audio)
+    reasons = problems(segments, speech_mask, frame_seconds)
+    flagged = [index for index, found in enumerate(reasons) if found]
+    stats = {'flagged_segments': len(flagged), 'repaired_seconds': 0.0, 'patched_segments': 0}
+    if not flagged:
+        return result, stats
+
+    # A cascade repairs with its large model
+    decoder = model.get_large_model() if isinstance(model, cascade.Cascade) else model
+    audio_seconds = pcm_audio.duration_seconds(audio)
+    windows = cascade.escalation_windows(segments, flagged, audio_seconds)
+    window_segments = []
+    for start, end in windows:
+        window_audio = audio[int(start * pcm_audio.SAMPLE_RATE):int(end * pcm_audio.SAMPLE_RATE)]
+        with metrics.span('transcribe.repair_window', start=start, end=end):
+            decoded = transcription.transcribe_audio(decoder, window_audio, verbose=False, word_timestamps=word_timestamps,
+                                                     options=fallback_options)
+        shifted = [transcription.shift_segment(segment, start) for segment in decoded['segments']]
+        patched, changed = patch_segments(shifted, speech_mask, frame_seconds)
+        stats['patched_segments'] += changed
+        window_segments.append(patched)
+
+    counts = {}
+    for index in flagged:
+        for reason in reasons[index]:
+            counts[reason] = counts.get(reason, 0) + 1
+    for reason, count in counts.items():
+        metrics.increment('transcribe_flagged_segments', count, reason=reason)
+    stats['repaired_seconds'] = sum(end - start for start, end in windows)
+    print(f"Repair: {len(flagged)} of {len(segments)} segments flagged "
+          f"({', '.join(f'{reason} {count}' for reason, count in counts.items())}), "
+          f"re-decoded {len(windows)} windows, {stats['repaired_seconds']:.1f} s of audio"
+          + (f", patched {stats['patched_segments']} segments that still failed" if stats['patched_segments'] else ""))
+
+    result['segments'] = cascade.splice(segments, windows, window_segments)
+    result['text'] = ''.join(segment['text'] for segment in result['segments'])
+    return result, stats
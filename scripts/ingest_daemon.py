@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+# Watch-folder daemon: new uploads in data/input go through the pipeline stages within seconds,
+# without anyone running 00_main.py.
+#
+#   python3 ingest_daemon.py --to transcribe --jobs 2         # watch and process, until Ctrl+C
+#   python3 ingest_daemon.py --enqueue lecture.mp4 --priority 10
+#   python3 ingest_daemon.py --status
+#
+# The input directory is watched with inotify (through ctypes, so nothing needs installing), or scanned every
+# poll_interval seconds where inotify is not available. A file is only taken once its size and modification
+# time have not changed for settle_seconds, so half-copied uploads are never processed.
+#
+# Jobs live in a SQLite queue (data/ingest_queue.sqlite) that survives restarts: jobs that were running when
+# the daemon stopped are queued again. Jobs are deduplicated by the content hash of the file, so a file that is
+# copied in twice, or under a new name, is processed once. Higher priorities run first, then the oldest jobs.
+# Videos start at the extract stage and audio files at the transcribe stage. At most --jobs files are in the
+# pipeline at a time; inside it every stage keeps its own worker limit (see pipeline.py).
+import argparse
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+import metrics
+import pipeline
+import transcription
+from stage_cache import hash_file
+
+# Paths
+base_dir = Path(__file__).resolve().parent.parent
+watch_dir = base_dir / 'data' / 'input'
+queue_path = base_dir / 'data' / 'ingest_queue.sqlite'
+
+video_extensions = transcription.video_extensions
+audio_extensions = transcription.supported_extensions
+
+# Timing
+settle_seconds = 5.0    # A file must stay unchanged this long before it is queued
+poll_interval = 2.0     # Seconds between directory scans without inotify
+report_interval = 60.0  # Seconds between status lines
+
+# Priorities by file name pattern; the highest matching one wins, anything else gets 0
+priority_patterns = {
+    '*urgent*': 10,
+}
+
+# ----- Watching -----
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+event_header = struct.Struct('iIII')
+
+class InotifyWatcher:
+    """Names of the files of a directory that were written, created or moved in, from inotify."""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {directory}")
+        self.directory = directory
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds. Returns the changed names, or None if events were lost and a rescan is needed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        names = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """The same interface on top of directory scans."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = {}
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, poll_interval))
+        names = set()
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                if self.seen.get(entry.name) != current[entry.name]:
+                    names.add(entry.name)
+        self.seen = current
+        return names
+
+    def close(self):
+        pass
+
+def make_watcher(directory, polling=False):
+    if not polling:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as e:
+            # AttributeError: no inotify in this libc (macOS)
+            print(f"inotify is not available ({e}), scanning the directory every {poll_interval:.0f} s")
+    return PollingWatcher(directory)
+
+# ----- Queue -----
+
+class JobQueue:
+    """Durable job queue in SQLite. One connection, shared by the threads of the daemon under a lock."""
+
+    def __init__(self, path=queue_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL,
+            sha256 TEXT NOT NULL UNIQUE,
+            first_stage TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            enqueued_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            error TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_next ON jobs (status, priority DESC, enqueued_at)')
+        # Files that never become jobs of their own: audio the pipeline extracted into the watched directory,
+        # and copies of files that were queued already
+        self.db.execute('CREATE TABLE IF NOT EXISTS ignored (path TEXT PRIMARY KEY)')
+        self.db.commit()
+
+    def add(self, path, sha256, first_stage, priority=0):
+        """Queues a file. Returns False if a job with the same content exists already."""
+        with self.lock:
+            cursor = self.db.execute('INSERT OR IGNORE INTO jobs (path, sha256, first_stage, priority, enqueued_at) '
+                                     'VALUES (?, ?, ?, ?, ?)', (str(path), sha256, first_stage, priority, time.time()))
+            self.db.commit()
+            return cursor.rowcount == 1
+
+    def claim(self):
+        """Marks the next job as running and returns it as a dict, or None if nothing is queued."""
+        with self.lock:
+            row = self.db.execute("SELECT id, path, first_stage, priority, enqueued_at FROM jobs WHERE status = 'queued' "
+                                  "ORDER BY priority DESC, enqueued_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.db.execute("UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                            (now, row[0]))
+            self.db.commit()
+        return {'id': row[0], 'path': row[1], 'first_stage': row[2], 'priority': row[3], 'enqueued_at': row[4],
+                'started_at': now}
+
+    def finish(self, job_id, ok, error=None):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?',
+                            ('done' if ok else 'failed', time.time(), error, job_id))
+            self.db.commit()
+
+    def requeue(self, status):
+        """Puts the jobs with a status back into the queue. Returns how many."""
+        with self.lock:
+            cursor = self.db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = ?", (status,))
+            self.db.commit()
+            return cursor.rowcount
+
+    def ignore(self, path):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO ignored (path) VALUES (?)', (str(path),))
+            self.db.commit()
+
+    def is_known(self, path):
+        """True for files that are a job already, an output of one or a copy of one."""
+        with self.lock:
+            return (self.db.execute('SELECT 1 FROM jobs WHERE path = ?', (str(path),)).fetchone() is not None
+                    or self.db.execute('SELECT 1 FROM ignored WHERE path = ?', (str(path),)).fetchone() is not None)
+
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+    def recent(self, limit=20):
+        with self.lock:
+            return self.db.execute('SELECT id, status, priority, attempts, enqueued_at, started_at, finished_at, path, error '
+                                   'FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def file_priority(name):
+    matches = [priority for pattern, priority in priority_patterns.items() if fnmatch.fnmatch(name.lower(), pattern)]
+    return max(matches) if matches else 0
+
+def first_stage_for(name, stages):
+    """The stage a file enters the pipeline at, or None if the pipeline has nothing to do with it."""
+    if name.lower().endswith(video_extensions) and 'extract' in stages:
+        return 'extract'
+    if name.lower().endswith(audio_extensions) and 'transcribe' in stages:
+        return 'transcribe'
+    return None
+
+# ----- Daemon -----
+
+class IngestDaemon:
+    def __init__(self, stages, max_jobs, limits=None, polling=False, pipeline_options=None):
+        self.stages = stages
+        self.max_jobs = max_jobs
+        self.queue = JobQueue()
+        self.watcher = make_watcher(watch_dir, polling)
+        # Files seen changing: name -> (size, mtime_ns, unchanged since)
+        self.candidates = {}
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.job_finished = threading.Event()
+        self.stopping = False
+        self.wait_times = []
+        self.finished = 0
+        self.failed = 0
+        self.start_time = time.time()
+        self.last_report = 0.0
+
+        requeued = self.queue.requeue('running')
+        if requeued:
+            print(f"Re-queued {requeued} job(s) that were running when the daemon stopped")
+        self.pipeline = pipeline.Pipeline(stages, dict(pipeline.default_limits, **(limits or {})), **(pipeline_options or {}))
+
+    def is_own_output(self, name):
+        # Extracted audio is written into the watched directory under a name the extract stage reserved
+        extract = self.pipeline.modules.get('extract')
+        return extract is not None and name in extract.reserved_names
+
+    def note_changes(self, names):
+        now = time.time()
+        for name in names:
+            path = watch_dir / name
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                self.candidates.pop(name, None)
+                continue
+            self.candidates[name] = (stat.st_size, stat.st_mtime_ns, now)
+
+    def enqueue_settled(self):
+        """Queues the candidates that stopped changing settle_seconds ago."""
+        now = time.time()
+        for name, (size, mtime_ns, since) in list(self.candidates.items()):
+            path = watch_dir / name
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self.candidates[name]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.candidates[name] = (stat.st_size, stat.st_mtime_ns, now)
+                continue
+            if now - since < settle_seconds:
+                continue
+            del self.candidates[name]
+            self.enqueue(path)
+
+    def enqueue(self, path, priority=None):
+        first_stage = first_stage_for(path.name, self.stages)
+        if first_stage is None or self.is_own_output(path.name) or self.queue.is_known(path):
+            return
+        priority = file_priority(path.name) if priority is None else priority
+        if self.queue.add(path, hash_file(path), first_stage, priority):
+            print(f"[ingest] queued {path.name} (priority {priority}, from {first_stage})")
+            metrics.increment('ingest_enqueued', first_stage=first_stage)
+        else:
+            print(f"[ingest] {path.name} has the same content as an earlier job, skipped")
+            self.queue.ignore(path)
+            metrics.increment('ingest_duplicates')
+
+    def scan(self):
+        """Takes every file already in the directory as a candidate, e.g. uploads made while the daemon was down."""
+        self.note_changes(entry.name for entry in os.scandir(watch_dir) if entry.is_file())
+
+    def start_jobs(self):
+        while len(self.running) < self.max_jobs and not self.stopping:
+            job = self.queue.claim()
+            if job is None:
+                return
+            wait = job['started_at'] - job['enqueued_at']
+            self.wait_times.append(wait)
+            metrics.observe('ingest_wait_seconds', wait)
+            print(f"[ingest] starting {Path(job['path']).name} after {wait:.1f} s in the queue")
+            with self.running_lock:
+                self.running[job['id']] = job
+            self.pipeline.add(job['path'], job['first_stage'], lambda item, job=job: self.on_finish(job, item))
+
+    def on_finish(self, job, item):
+        # Runs in a pipeline worker thread
+        extracted = item['outputs'].get('extract')
+        if extracted is not None:
+            self.queue.ignore(extracted)
+        self.queue.finish(job['id'], item['ok'], None if item['ok'] else "failed in the pipeline, see the log")
+        seconds = item['finished_at'] - job['started_at']
+        metrics.observe('ingest_job_seconds', seconds)
+        metrics.increment('ingest_jobs', status='done' if item['ok'] else 'failed')
+        with self.running_lock:
+            del self.running[job['id']]
+            if item['ok']:
+                self.finished += 1
+            else:
+                self.failed += 1
+        print(f"[ingest] {'finished' if item['ok'] else 'FAILED'} {item['name']} in {seconds:.1f} s")
+        self.job_finished.set()
+
+    def report(self):
+        counts = self.queue.counts()
+        hours = (time.time() - self.start_time) / 3600
+        waits = sorted(self.wait_times[-1000:])
+        wait_text = f", median wait {waits[len(waits) // 2]:.1f} s, max {waits[-1]:.1f} s" if waits else ""
+        print(f"[ingest] queue depth {counts.get('queued', 0)}, running {len(self.running)}, "
+              f"finished {self.finished}, failed {self.failed} since start "
+              f"({self.finished / hours if hours > 0 else 0:.1f} files/h){wait_text}")
+        metrics.set_gauge('ingest_queue_depth', counts.get('queued', 0))
+        metrics.set_gauge('ingest_running', len(self.running))
+        metrics.flush()
+
+    def stop(self, *_):
+        print("\n[ingest] stopping: no new jobs are started, running jobs are finished")
+        self.stopping = True
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"[ingest] watching {watch_dir}: {' -> '.join(self.stages)}, at most {self.max_jobs} file(s) at a time")
+        self.scan()
+        try:
+            while not self.stopping:
+                # Short waits while files are settling, so they are queued soon after they stop changing
+                names = self.watcher.wait(1.0 if self.candidates else poll_interval)
+                if names is None:
+                    print("[ingest] inotify queue overflowed, rescanning the directory")
+                    self.scan()
+                else:
+                    self.note_changes(names)
+                self.enqueue_settled()
+                self.start_jobs()
+                if time.time() - self.last_report >= report_interval:
+                    self.report()
+                    self.last_report = time.time()
+        finally:
+            while self.running:
+                self.job_finished.wait(1.0)
+                self.job_finished.clear()
+            self.pipeline.shutdown()
+            self.watcher.close()
+            self.report()
+            self.queue.close()
+
+def print_status(queue):
+    counts = queue.counts()
+    print(f"Queued {counts.get('queued', 0)}, running {counts.get('running', 0)}, "
+          f"done {counts.get('done', 0)}, failed {counts.get('failed', 0)}")
+    for job_id, status, priority, attempts, enqueued_at, started_at, finished_at, path, error in queue.recent():
+        waited = f"{started_at - enqueued_at:7.1f}" if started_at else '      -'
+        took = f"{finished_at - started_at:8.1f}" if finished_at and started_at else '       -'
+        print(f"  {job_id:5} {status:8} p{priority:<3} wait {waited} s  run {took} s  {Path(path).name}"
+              + (f"  ({error})" if error else ""))
+
+# Main function to run the daemon
+def main():
+    global settle_seconds
+    parser = argparse.ArgumentParser(description="Watch the input directory and run new uploads through the pipeline.")
+    parser.add_argument("--to", dest="last_stage", choices=pipeline.STAGES, default='transcribe', help="Last stage to run (default: transcribe, like 00_main.py)")
+    parser.add_argument("--jobs", type=int, default=2, help="Files in the pipeline at the same time")
+    parser.add_argument("--polling", action="store_true", help="Scan the directory instead of using inotify")
+    parser.add_argument("--settle", type=float, default=settle_seconds, help="Seconds a file must stay unchanged before it is queued")
+    parser.add_argument("--requeue_failed", action="store_true", help="Queue the failed jobs again at start")
+    parser.add_argument("--enqueue", nargs='+', help="Queue these files for the running daemon and exit")
+    parser.add_argument("--priority", type=int, default=None, help="Priority of the files given with --enqueue")
+    parser.add_argument("--status", action="store_true", help="Print the queue and exit")
+    parser.add_argument("--incremental", action="store_true", help="Skip inputs whose content and stage parameters are unchanged")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    settle_seconds = args.settle
+    stages = pipeline.STAGES[:pipeline.STAGES.index(args.last_stage) + 1]
+
+    if args.status or args.enqueue:
+        queue = JobQueue()
+        for filename in args.enqueue or []:
+            path = Path(filename).resolve()
+            first_stage = first_stage_for(path.name, stages)
+            if first_stage is None:
+                print(f"{path.name}: not a media file")
+            elif queue.add(path, hash_file(path), first_stage, file_priority(path.name) if args.priority is None else args.priority):
+                print(f"Queued {path.name}")
+            else:
+                print(f"{path.name} has the same content as an earlier job, skipped")
+        if args.status:
+            print_status(queue)
+        queue.close()
+        return
+
+    metrics.configure_from_args('ingest', args)
+    try:
+        daemon = IngestDaemon(stages, max(1, args.jobs), polling=args.polling,
+                              pipeline_options={'incremental': args.incremental})
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if args.requeue_failed:
+        print(f"Re-queued {daemon.queue.requeue('failed')} failed job(s)")
+    daemon.serve()
+
+if __name__ == "__main__":
+    main()
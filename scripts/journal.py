@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Crash-safe journal of the finished batches of 04_verbalize.py and 05_translate.py.
+#
+# The stages only write their SRT when the whole file is done. Every finished batch is therefore appended
+# to a per-file journal first, as one JSON line written with a single write and fsync'd:
+#   data/journal/<stage>/<input name>.<key>.jsonl
+# The key hashes the content of the input and the stage parameters, so a changed file or a new prompt
+# starts over. A run that dies at block 1,800 of 2,000 resumes with the blocks of the journal and only sends
+# the batches that are not in it. Once the output has been written (to a temporary file, fsync'd and renamed
+# over the old one), the journal is deleted.
+#
+# A journal belongs to one worker at a time: it is held with an exclusive flock on <journal>.lock, and a second
+# worker that reaches the same file skips it instead of paying for the same batches twice. The lock file is
+# deleted with the journal.
+import fcntl
+import json
+import os
+from pathlib import Path
+
+import metrics
+from stage_cache import hash_file, params_hash
+
+# Paths to directories
+base_dir = Path(__file__).resolve().parent.parent
+journal_dir = base_dir / 'data' / 'journal'
+
+JOURNAL_VERSION = 1
+
+class JournalLocked(RuntimeError):
+    """Another worker is processing the same input."""
+
+def fsync_directory(directory):
+    """Makes a rename or a new file in a directory survive a power loss."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_atomic(write, path):
+    """Calls write(temporary path), fsyncs the file and renames it over path, so path is always complete."""
+    temporary_path = f"{path}.part"
+    write(temporary_path)
+    with open(temporary_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+def save_subs_atomic(subs, path):
+    """SubRipFile.save through a temporary file."""
+    replace_atomic(lambda temporary_path: subs.save(temporary_path, encoding='utf-8'), path)
+
+class Journal:
+    """Finished blocks of one input file: done maps a block index to its text."""
+
+    def __init__(self, path, lock_file, done, records):
+        self.path = path
+        self.lock_file = lock_file
+        self.done = done
+        self.resumed_blocks = len(done)
+        self.resumed_batches = records
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    @classmethod
+    def open(cls, stage, input_path, params):
+        """Opens (or resumes) the journal of an input. Raises JournalLocked if another worker holds it."""
+        directory = journal_dir / stage
+        os.makedirs(directory, exist_ok=True)
+        key = params_hash({'input': hash_file(input_path), 'params': params, 'version': JOURNAL_VERSION})[:16]
+        path = directory / f"{Path(input_path).name}.{key}.jsonl"
+
+        lock_path = f"{path}.lock"
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                raise JournalLocked(f"{Path(input_path).name} is being processed by another worker")
+            # The worker we waited for may have deleted the lock file on completion; a lock on a deleted file
+            # excludes nobody, so only a lock on the file still at lock_path counts
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        done, records = cls.read(path)
+        metrics.increment('journal_resumed_blocks', len(done), stage=stage)
+        metrics.increment('journal_saved_batches', records, stage=stage)
+        return cls(path, lock_file, done, records)
+
+    @staticmethod
+    def read(path):
+        """Reads the blocks of a journal, and cuts off a last line torn by a crash."""
+        done = {}
+        records = 0
+        if not os.path.exists(path):
+            return done, records
+        with open(path, 'rb') as f:
+            data = f.read()
+        valid_bytes = 0
+        for line in data.splitlines(keepends=True):
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError("incomplete line")
+                record = json.loads(line)
+            except ValueError:
+                break
+            done.update(zip(record['blocks'], record['texts']))
+            records += 1
+            valid_bytes += len(line)
+        if valid_bytes < len(data):
+            print(f"Journal {Path(path).name}: dropped {len(data) - valid_bytes} bytes of an unfinished write")
+            os.truncate(path, valid_bytes)
+        return done, records
+
+    def append(self, blocks, texts):
+        """Records finished blocks (indexes into the file's blocks) before the run goes on."""
+        blocks = list(blocks)
+        texts = list(texts)
+        line = json.dumps({'blocks': blocks, 'texts': texts}, ensure_ascii=False) + '\n'
+        # One write per record: a crash leaves at most one torn line, which read() drops
+        os.write(self.fd, line.encode('utf-8'))
+        os.fsync(self.fd)
+        self.done.update(zip(blocks, texts))
+
+    def summary(self, total_blocks):
+        if not self.resumed_blocks:
+            return None
+        return (f"Resumed from the journal: {self.resumed_blocks} of {total_blocks} blocks were already done, "
+                f"{self.resumed_batches} batch request(s) saved")
+
+    def complete(self):
+        """Deletes the journal and its lock file once the output is safely written."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        os.remove(self.path)
+        if self.lock_file is not None:
+            # Removed while still locked; a worker that opened the old file notices in open() and locks anew
+            os.remove(self.lock_file.name)
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.lock_file is not None:
+            # An unfinished journal keeps its lock file for the run that resumes it
+            self.lock_file.close()
+            self.lock_file = None
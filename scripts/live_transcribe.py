@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+# Live subtitles for a stream: ffmpeg decodes the input continuously, and the SRT grows while the lecture goes on.
+#
+#   python3 live_transcribe.py rtmp://host/live/lecture --latency 5
+#   ffmpeg -i ... -f matroska - | python3 live_transcribe.py -          # from a pipe
+#   python3 live_transcribe.py lecture.mp4 --realtime --model small     # a file, read at its own pace like a stream
+#
+# ffmpeg's PCM goes into a ring buffer that holds the last ring_seconds of the stream. Every step_seconds the
+# decoder transcribes the window from the end of the last committed segment to the newest audio, at most
+# window_seconds long, so consecutive windows overlap. The segments of a window are first partial: Whisper
+# revises the end of the window as more audio comes in. A segment is committed, appended to the SRT and never
+# changed again once
+#   - two consecutive decodes agree on it (same words, about the same start), or
+#   - waiting any longer would break the latency target, or
+#   - the window is full and has to move on, or the stream has ended.
+# The lag of a committed segment is the time from the arrival of its last sample to its commit. The lag and the
+# real-time factor of the decoder (overlapping windows included) are printed every report_interval seconds and
+# at the end; a real-time factor above 1 means the decoder cannot keep up with this model and step.
+import argparse
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+import numpy as np
+
+import cpu_backend
+import hallucination
+import metrics
+import pcm_audio
+import stub_model
+import transcription
+import vad
+from srt_engine import format_time
+
+# Timing
+latency_target = 5.0    # Seconds from the arrival of speech to its committed subtitle
+window_seconds = 30.0   # Longest window decoded at once (Whisper's own window)
+min_window_seconds = 1.0
+ring_seconds = 120.0    # Audio kept for the decoder; a decoder further behind than this drops audio
+holdback_seconds = 1.0  # Segments ending this close to the newest audio may still be cut mid-word
+report_interval = 30.0
+agreement_seconds = 0.5  # Largest start difference of the same segment in two decodes
+prompt_chars = 200      # Committed text given to Whisper as the prompt of the next window
+tolerance_seconds = 0.5  # Largest difference between a file's length and the audio ffmpeg delivered for it
+
+SAMPLE_RATE = pcm_audio.SAMPLE_RATE
+
+class RingBuffer:
+    """The last capacity samples of the stream, addressed by their position since the start of the stream."""
+
+    def __init__(self, seconds):
+        self.capacity = int(seconds * SAMPLE_RATE)
+        self.data = np.zeros(self.capacity, dtype=np.float32)
+        self.head = 0  # Samples written so far
+        self.closed = False
+        self.arrivals = deque()  # (head after a write, wall time of the write)
+        self.changed = threading.Condition()
+
+    def write(self, samples):
+        with self.changed:
+            # Of a write longer than the buffer, only the end is kept
+            skipped = max(0, len(samples) - self.capacity)
+            samples = samples[skipped:]
+            start = (self.head + skipped) % self.capacity
+            first = min(len(samples), self.capacity - start)
+            self.data[start:start + first] = samples[:first]
+            self.data[:len(samples) - first] = samples[first:]
+            self.head += skipped + len(samples)
+            self.arrivals.append((self.head, time.time()))
+            while self.arrivals and self.arrivals[0][0] < self.head - self.capacity:
+                self.arrivals.popleft()
+            self.changed.notify_all()
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def oldest(self):
+        return max(0, self.head - self.capacity)
+
+    def read(self, start, end):
+        """A copy of the samples from start to end, which must still be in the buffer."""
+        with self.changed:
+            if start < self.oldest() or end > self.head:
+                raise ValueError(f"Samples {start}-{end} are not in the buffer ({self.oldest()}-{self.head})")
+            indexes = np.arange(start, end) % self.capacity
+            return self.data[indexes]
+
+    def arrival_time(self, position):
+        """Wall time at which the sample at position arrived (that of the oldest write kept, for older samples)."""
+        with self.changed:
+            positions = [head for head, _ in self.arrivals]
+            index = min(bisect_left(positions, position), len(positions) - 1)
+            return self.arrivals[index][1] if self.arrivals else time.time()
+
+    def wait_for(self, position, timeout):
+        """Waits until the buffer reaches position or the stream ends. Returns (head, closed)."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.head >= position or self.closed, timeout)
+            return self.head, self.closed
+
+def is_stream(source):
+    return source == '-' or '://' in source
+
+def ffmpeg_command(source, realtime=False):
+    command = pcm_audio.ffmpeg_pcm_command(source)
+    if source == '-':
+        command.remove('-nostdin')
+    input_index = command.index('-i')
+    # -re reads a file at its own pace, like a stream. nobuffer passes the packets of a stream on at once; on a
+    # file it makes ffmpeg drop the start of the audio, which would shift every timestamp
+    command[input_index:input_index] = (['-re'] if realtime else []) + (['-fflags', 'nobuffer'] if is_stream(source) else [])
+    return command
+
+def check_file_length(source, ring):
+    """Warns when ffmpeg delivered less or more audio than the file holds, since the timestamps would be off."""
+    expected = pcm_audio.probe_duration(source)
+    received = ring.head / SAMPLE_RATE
+    if expected is not None and abs(received - expected) > tolerance_seconds:
+        print(f"Warning: {source} is {expected:.2f} s long, but ffmpeg delivered {received:.2f} s of audio; "
+              f"the subtitle times may be shifted")
+
+def read_stream(process, ring, chunk_seconds=0.1):
+    """Copies ffmpeg's PCM into the ring buffer as it arrives. Runs in its own thread."""
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * pcm_audio.BYTES_PER_SAMPLE
+    remainder = b''
+    fd = process.stdout.fileno()
+    while True:
+        data = os.read(fd, chunk_bytes)
+        if not data:
+            break
+        data = remainder + data
+        usable = len(data) - len(data) % pcm_audio.BYTES_PER_SAMPLE
+        remainder = data[usable:]
+        ring.write(np.frombuffer(data[:usable], dtype='<f4'))
+    ring.close()
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class LiveTranscriber:
+    def __init__(self, model, ring, srt_path, events_path=None, latency=latency_target, step=None,
+                 word_timestamps=False):
+        self.model = model
+        self.ring = ring
+        self.latency = latency
+        # Decoding more often than this gives little: a quarter of the target leaves room for two agreeing decodes
+        self.step = step or max(0.5, latency / 4)
+        self.word_timestamps = word_timestamps
+        self.srt_path = srt_path
+        self.srt_file = open(srt_path, 'w', encoding='utf-8')
+        self.events_file = open(events_path, 'a', encoding='utf-8') if events_path else None
+        self.committed_until = 0   # Sample position up to which the subtitles are final
+        self.committed_text = ''
+        self.blocks = 0
+        self.previous = []         # Partial segments of the last decode
+        self.last_partial = None
+        self.lags = []
+        self.decode_seconds = 0.0
+        self.decoded_audio_seconds = 0.0
+        self.dropped_seconds = 0.0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    # ----- Output -----
+
+    def emit(self, kind, segment, **fields):
+        if self.events_file is not None:
+            record = {'type': kind, 'start': round(segment['start'], 3), 'end': round(segment['end'], 3),
+                      'text': segment['text'].strip(), 'time': round(time.time(), 3), **fields}
+            self.events_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.events_file.flush()
+
+    def commit(self, segment):
+        self.blocks += 1
+        self.srt_file.write(f"{self.blocks}\n{format_time(segment['start'] * 1000)} --> {format_time(segment['end'] * 1000)}\n"
+                            f"{segment['text'].strip()}\n\n")
+        self.srt_file.flush()
+        end_position = int(segment['end'] * SAMPLE_RATE)
+        lag = time.time() - self.ring.arrival_time(end_position)
+        self.lags.append(lag)
+        metrics.observe('live_commit_lag_seconds', lag)
+        self.committed_until = max(self.committed_until, end_position)
+        self.committed_text = (self.committed_text + segment['text'])[-prompt_chars:]
+        print(f"[{segment['start']:8.1f} - {segment['end']:8.1f}] {segment['text'].strip()}   (lag {lag:.1f} s)")
+        self.emit('commit', segment, lag=round(lag, 3))
+
+    def show_partial(self, segments):
+        text = ''.join(segment['text'] for segment in segments).strip()
+        if text and text != self.last_partial:
+            print(f"  ... {text}")
+            for segment in segments:
+                self.emit('partial', segment)
+        self.last_partial = text
+
+    # ----- Decoding -----
+
+    def agrees(self, segment):
+        words = hallucination.normalized_words(segment['text'])
+        return any(words and hallucination.normalized_words(previous['text']) == words
+                   and abs(previous['start'] - segment['start']) <= agreement_seconds for previous in self.previous)
+
+    def commit_count(self, segments, window_end, window_full, final):
+        """How many of the leading segments of a decode can be committed."""
+        newest = self.ring.head / SAMPLE_RATE
+        count = 0
+        for index, segment in enumerate(segments):
+            last = index == len(segments) - 1
+            settled = segment['end'] <= window_end - holdback_seconds
+            if final or (window_full and not last):
+                count += 1
+            elif settled and (self.agrees(segment) or newest - segment['end'] + self.step >= self.latency):
+                count += 1
+            else:
+                break
+        if window_full and count == 0 and segments:
+            # One segment filling the whole window: commit it rather than stall
+            count = 1
+        return count
+
+    def decode(self, start, end):
+        audio = self.ring.read(start, end)
+        offset = start / SAMPLE_RATE
+        # Only silence is skipped: on a few seconds of audio the noise floor of the VAD is not known yet,
+        # and a window full of speech would look like noise to it
+        energies = vad.frame_energies_db(audio, int(SAMPLE_RATE * vad.FRAME_MS / 1000))
+        if not len(energies) or energies.max() <= vad.ABSOLUTE_FLOOR_DB:
+            return []
+        options = dict(transcription.decode_options)
+        if self.committed_text:
+            options['initial_prompt'] = self.committed_text
+        decode_start = time.perf_counter()
+        with metrics.span('live.decode', start=offset, seconds=len(audio) / SAMPLE_RATE):
+            result = transcription.transcribe_audio(self.model, audio, verbose=False, word_timestamps=self.word_timestamps,
+                                                    options=options)
+        seconds = time.perf_counter() - decode_start
+        self.decode_seconds += seconds
+        self.decoded_audio_seconds += len(audio) / SAMPLE_RATE
+        window_end = end / SAMPLE_RATE
+        segments = []
+        for segment in result['segments']:
+            segment = transcription.shift_segment(segment, offset)
+            # Whisper sometimes places the end of the last segment behind the audio it was given
+            segment['end'] = min(segment['end'], window_end)
+            if segment['text'].strip() and segment['end'] > segment['start']:
+                segments.append(segment)
+        return segments
+
+    def run(self):
+        window_samples = int(window_seconds * SAMPLE_RATE)
+        step_samples = int(self.step * SAMPLE_RATE)
+        decoded_head = 0
+        while True:
+            head, closed = self.ring.wait_for(decoded_head + step_samples, timeout=self.step)
+            if head < decoded_head + step_samples and not closed:
+                continue
+            if self.committed_until < self.ring.oldest():
+                # The decoder fell further behind than the ring buffer reaches: it jumps to the newest window
+                skip_to = max(self.ring.oldest(), head - window_samples)
+                dropped = (skip_to - self.committed_until) / SAMPLE_RATE
+                self.dropped_seconds += dropped
+                metrics.increment('live_dropped_seconds', dropped)
+                print(f"Warning: the decoder fell behind, {dropped:.1f} s of audio are skipped")
+                self.committed_until = skip_to
+                self.previous = []
+
+            start = self.committed_until
+            end = min(head, start + window_samples)
+            final = closed and end == head
+            if end - start < min_window_seconds * SAMPLE_RATE and not final:
+                decoded_head = head
+                continue
+            segments = self.decode(start, end) if end > start else []
+            decoded_head = end if end < head else head
+
+            if not segments:
+                # Silence: everything but the last moments (a word may be starting) is done
+                self.committed_until = max(start, end - (0 if final else int(holdback_seconds * SAMPLE_RATE)))
+                self.previous = []
+            else:
+                count = self.commit_count(segments, end / SAMPLE_RATE, end - start >= window_samples, final)
+                for segment in segments[:count]:
+                    self.commit(segment)
+                self.previous = segments[count:]
+                self.show_partial(self.previous)
+
+            if time.time() - self.last_report >= report_interval:
+                self.report()
+                self.last_report = time.time()
+            if final:
+                break
+        self.close()
+
+    # ----- Report -----
+
+    def report(self, final=False):
+        stream_seconds = self.ring.head / SAMPLE_RATE
+        if stream_seconds <= 0:
+            return
+        rtf = self.decode_seconds / stream_seconds
+        metrics.set_gauge('live_real_time_factor', rtf)
+        line = (f"{'Stream ended' if final else 'Live'}: {stream_seconds:.0f} s of audio, {self.blocks} subtitles, "
+                f"decoder real-time factor {rtf:.2f} ({self.decoded_audio_seconds / stream_seconds:.1f}x the audio decoded "
+                f"with the overlap)")
+        if self.lags:
+            lags = sorted(self.lags)
+            within = sum(lag <= self.latency for lag in lags) / len(lags)
+            line += (f"; lag p50 {percentile(lags, 0.5):.1f} s, p95 {percentile(lags, 0.95):.1f} s, max {lags[-1]:.1f} s, "
+                     f"{within:.0%} within the {self.latency:.0f} s target")
+        if self.dropped_seconds:
+            line += f"; {self.dropped_seconds:.1f} s of audio dropped"
+        print(line)
+        if rtf > 1 and not final:
+            print("Warning: the decoder is slower than real time; use a smaller model, a longer --step or a GPU")
+        metrics.flush()
+
+    def close(self):
+        self.srt_file.close()
+        if self.events_file is not None:
+            self.events_file.close()
+        self.report(final=True)
+        print(f"Saved SRT file: {self.srt_path}")
+
+def load_model(name, backend, threads):
+    if name == 'stub':
+        # Answers at once, for trying the streaming path without Whisper
+        return stub_model.StubModel(), 0.0
+    return transcription.load_model(name, backend, threads)
+
+# Main function to transcribe a stream
+def main():
+    global window_seconds, ring_seconds
+    parser = argparse.ArgumentParser(description="Transcribe a live stream into an SRT file that grows while the stream runs.")
+    parser.add_argument("source", help="Stream URL, media file, or - for a pipe")
+    parser.add_argument("--output", help="SRT file to write (default: data/output/<source name>_live.srt)")
+    parser.add_argument("--events", help="Append every partial and committed segment as a JSON line to this file")
+    parser.add_argument("--latency", type=float, default=latency_target, help="Target seconds from speech to its committed subtitle")
+    parser.add_argument("--step", type=float, default=None, help="Seconds between decodes (default: a quarter of --latency)")
+    parser.add_argument("--window", type=float, default=window_seconds, help="Longest window decoded at once, in seconds")
+    parser.add_argument("--ring", type=float, default=ring_seconds, help="Seconds of audio kept for a decoder that falls behind")
+    parser.add_argument("--realtime", action="store_true", help="Read a file at its own pace, as if it were a stream")
+    parser.add_argument("--model", default=transcription.model_name, help="Whisper model; small models keep up more easily")
+    parser.add_argument("--backend", choices=cpu_backend.backends, default=cpu_backend.default_backend,
+                        help="int8: quantize the linear layers for CPU nodes (see benchmark_backends.py)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch (default: all cores)")
+    parser.add_argument("--word_timestamps", action="store_true", help="Keep the time of every word in the events")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('live_transcribe', args)
+
+    window_seconds = args.window
+    ring_seconds = max(args.ring, 2 * args.window)
+
+    if args.output:
+        srt_path = args.output
+    else:
+        name = 'stream' if is_stream(args.source) else os.path.splitext(os.path.basename(args.source))[0]
+        srt_path = os.path.join(transcription.srt_dir, transcription.get_unique_filename(f"{name}_live", 'srt', transcription.srt_dir))
+
+    print(f"Loading Whisper model '{args.model}'...")
+    model, load_seconds = load_model(args.model, args.backend, args.threads)
+    print(f"Model loaded in {load_seconds:.2f} s")
+
+    ring = RingBuffer(ring_seconds)
+    process = subprocess.Popen(ffmpeg_command(args.source, args.realtime), stdout=subprocess.PIPE,
+                               stdin=None if args.source == '-' else subprocess.DEVNULL)
+    reader = threading.Thread(target=read_stream, args=(process, ring), name='ffmpeg-reader', daemon=True)
+    reader.start()
+
+    # Ctrl+C ends the stream: what has been heard is decoded and committed before the program exits
+    def stop(*_):
+        print("\nStopping: committing the rest of the stream")
+        process.terminate()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    transcriber = LiveTranscriber(model, ring, srt_path, args.events, latency=args.latency, step=args.step,
+                                  word_timestamps=args.word_timestamps)
+    print(f"Transcribing {args.source}: latency target {transcriber.latency:.1f} s, a decode every {transcriber.step:.2f} s, "
+          f"windows of up to {window_seconds:.0f} s")
+    transcriber.run()
+    process.wait()
+    if not is_stream(args.source) and process.returncode == 0:
+        check_file_length(args.source, ring)
+
+if __name__ == "__main__":
+    main()
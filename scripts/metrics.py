@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Per-stage metrics and tracing for the stage scripts, in place of reading "Time taken" lines.
+#
+# A span times one piece of work (a file, a batch, an API call, a model load) and knows the span it runs in,
+# also across asyncio tasks. Every finished span adds its duration to the histogram <name>_seconds; other
+# histograms (tokens, retries, queueing), counters and gauges are recorded with observe(), increment() and set_gauge().
+# Two export targets, both off by default:
+#   --trace PATH        one JSON line per finished span, appended; processes of one run can share the file
+#   --metrics_dir DIR   a Prometheus textfile <process>.prom, for node_exporter's textfile collector,
+#                       rewritten atomically by flush() and when the process exits
+# While both are off, span() hands out one shared no-op context manager and observe()/increment() return
+# at once, so the instrumentation can stay in the stages.
+#
+#   python3 metrics.py data/metrics/trace.jsonl    # where the time went, per span name
+import argparse
+import atexit
+import contextvars
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+enabled = False
+process_name = None
+_trace_fd = None
+_prometheus_path = None
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count per bucket, sum, count]
+_current_span = contextvars.ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+_exit_hook_registered = False
+
+metric_prefix = 'whisper_'
+# Histogram buckets: durations in seconds, everything else (tokens, blocks, retries) in counts
+seconds_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+invalid_name_characters = re.compile(r'[^a-zA-Z0-9_]')
+
+def add_metrics_arguments(parser):
+    """Adds the --trace and --metrics_dir options shared by all stages."""
+    parser.add_argument("--trace", help="Append a JSON line per span (file, batch, API call...) to this file")
+    parser.add_argument("--metrics_dir", help="Write latency, token and retry histograms as a Prometheus textfile into this directory")
+
+def configure(process, trace_path=None, metrics_dir=None):
+    """Switches the instrumentation on for this process if a trace file or a metrics directory is given."""
+    global enabled, process_name, _trace_fd, _prometheus_path, _exit_hook_registered
+    process_name = process
+    if trace_path:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+        # O_APPEND and one write per line keep the lines of parallel processes whole
+        _trace_fd = os.open(trace_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        _prometheus_path = os.path.join(metrics_dir, f"{process}.prom")
+    enabled = bool(trace_path or metrics_dir)
+    if enabled and not _exit_hook_registered:
+        atexit.register(flush)
+        _exit_hook_registered = True
+
+def configure_from_args(process, args):
+    configure(process, getattr(args, 'trace', None), getattr(args, 'metrics_dir', None))
+
+def metric_name(name):
+    return metric_prefix + invalid_name_characters.sub('_', name)
+
+def observe(name, value, **labels):
+    """Adds a value to a histogram. Names ending in _seconds get duration buckets, the others count buckets."""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    buckets = seconds_buckets if name.endswith('_seconds') else count_buckets
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+def increment(name, amount=1, **labels):
+    """Adds to a counter."""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    """Sets a value that goes up and down, such as a queue depth."""
+    if not enabled:
+        return
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+class Span:
+    """Times the code in a with block and writes it to the trace. set() adds attributes learned on the way."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.id = f"{os.getpid()}-{next(_span_ids)}"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent_id = parent.id if parent is not None else None
+        self.token = _current_span.set(self)
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.perf_start
+        _current_span.reset(self.token)
+        observe(f"{self.name}_seconds", seconds)
+        if exc_type is not None:
+            increment(f"{self.name}_errors")
+        if _trace_fd is not None:
+            record = {'name': self.name, 'start': round(self.start, 6), 'seconds': round(seconds, 6), 'id': self.id,
+                      'parent': self.parent_id, 'process': process_name, 'pid': os.getpid(),
+                      'thread': threading.current_thread().name, 'attributes': self.attributes}
+            if exc_type is not None:
+                record['error'] = f"{exc_type.__name__}: {exc}"
+            os.write(_trace_fd, (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+        return False
+
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_null_span = NullSpan()
+
+def span(name, **attributes):
+    """A context manager timing one piece of work, e.g. span('translate.api_call', blocks=12)."""
+    if not enabled:
+        return _null_span
+    return Span(name, attributes)
+
+def format_labels(labels):
+    labels = (('process', process_name),) + labels
+    escaped = ((key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels if value is not None)
+    return ','.join(f'{key}="{value}"' for key, value in escaped)
+
+def prometheus_text():
+    """The counters and histograms in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (list(value[0]), value[1], value[2])) for key, value in _histograms.items())
+    typed = set()
+    for (name, labels), value in counters:
+        metric = metric_name(name) + '_total'
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{{{format_labels(labels)}}} {value}")
+    for (name, labels), value in gauges:
+        metric = metric_name(name)
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} gauge")
+            typed.add(metric)
+        lines.append(f"{metric}{{{format_labels(labels)}}} {value}")
+    for (name, labels), (bucket_counts, total, count) in histograms:
+        metric = metric_name(name)
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        buckets = seconds_buckets if name.endswith('_seconds') else count_buckets
+        label_text = format_labels(labels)
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{{label_text},le="{bound:g}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{label_text},le="+Inf"}} {count}')
+        lines.append(f"{metric}_sum{{{label_text}}} {total:.6f}")
+        lines.append(f"{metric}_count{{{label_text}}} {count}")
+    return '\n'.join(lines) + '\n'
+
+def flush():
+    """Rewrites the Prometheus textfile. Long-running processes call it now and then; it also runs at exit."""
+    if _prometheus_path is None:
+        return
+    temp_path = f"{_prometheus_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    # node_exporter must never read a half-written file
+    os.replace(temp_path, _prometheus_path)
+
+# ----- Trace summary -----
+
+def read_trace(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def print_trace_summary(path):
+    durations = {}
+    errors = {}
+    for record in read_trace(path):
+        durations.setdefault(record['name'], []).append(record['seconds'])
+        if 'error' in record:
+            errors[record['name']] = errors.get(record['name'], 0) + 1
+    if not durations:
+        print(f"No spans in {path}")
+        return
+    print(f"{'span':32} {'count':>7} {'total s':>10} {'mean s':>9} {'p50 s':>9} {'p95 s':>9} {'max s':>9} {'errors':>7}")
+    for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        print(f"{name:32} {len(values):7} {sum(values):10.2f} {sum(values) / len(values):9.3f} "
+              f"{percentile(values, 0.5):9.3f} {percentile(values, 0.95):9.3f} {values[-1]:9.3f} {errors.get(name, 0):7}")
+
+# Main function to summarize a trace file
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a trace file written with --trace: count, total and percentiles per span.")
+    parser.add_argument("trace", help="JSONL trace file")
+    args = parser.parse_args()
+    print_trace_summary(args.trace)
+
+if __name__ == "__main__":
+    main()
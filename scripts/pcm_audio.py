@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import subprocess
+import threading
+
+import numpy as np
+
+# Whisper works on 16 kHz mono float32 audio, so ffmpeg produces exactly that and nothing is resampled twice
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 4  # float32
+
+# Extension of the raw PCM cache files (headerless 16 kHz mono float32, little-endian)
+PCM_EXTENSION = 'f32'
+
+# Bitrate of the MP3 files written by the default mode of 01_audio_detach.py, used for the savings report
+MP3_BITRATE = 192000
+
+# Read size for the ffmpeg pipe
+READ_CHUNK_BYTES = 1 << 20
+
+# Function to build the ffmpeg command that decodes any audio/video file to raw 16 kHz mono float32
+def ffmpeg_pcm_command(input_path, output='-'):
+    return [
+        'ffmpeg',
+        '-nostdin',
+        '-loglevel', 'error',
+        '-y',
+        '-i', str(input_path),
+        '-vn',
+        '-ac', '1',
+        '-ar', str(SAMPLE_RATE),
+        '-f', 'f32le',
+        str(output)
+    ]
+
+def load_pcm(input_path):
+    """Decodes a media file with ffmpeg straight into a float32 NumPy array, without an intermediate file."""
+    process = subprocess.Popen(ffmpeg_pcm_command(input_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # On a corrupt file ffmpeg can write more errors than the pipe holds even with -loglevel error, so stderr is
+    # drained in a thread; read after stdout, a full stderr pipe would block ffmpeg and this loop with it
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    # Grow one buffer and view it as float32 at the end: NumPy shares the memory instead of copying it
+    buffer = bytearray()
+    while True:
+        chunk = process.stdout.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        buffer += chunk
+    stderr_reader.join()
+    stderr = b''.join(stderr_chunks)
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {input_path}: {stderr.decode('utf-8', errors='replace')}")
+
+    usable = len(buffer) - len(buffer) % BYTES_PER_SAMPLE
+    return np.frombuffer(buffer, dtype='<f4', count=usable // BYTES_PER_SAMPLE)
+
+def extract_pcm_cache(input_path, cache_path):
+    """Decodes a media file into a raw PCM cache file. The file is written under a temporary name and renamed when complete."""
+    partial_path = f"{cache_path}.part"
+    result = subprocess.run(ffmpeg_pcm_command(input_path, partial_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise RuntimeError(f"ffmpeg failed to decode {input_path}: {result.stderr.decode('utf-8', errors='replace')}")
+    os.replace(partial_path, cache_path)
+    return os.path.getsize(cache_path)
+
+def open_pcm_cache(cache_path):
+    """Memory-maps a raw PCM cache file. Copy-on-write mode keeps the file untouched while giving torch a writable array."""
+    if os.path.getsize(cache_path) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(cache_path, dtype='<f4', mode='c')
+
+def is_pcm_cache(path):
+    return str(path).lower().endswith(f".{PCM_EXTENSION}")
+
+def load_audio_array(path):
+    """Returns the audio of a file as a float32 array, memory-mapping PCM cache files and decoding everything else with ffmpeg."""
+    if is_pcm_cache(path):
+        return open_pcm_cache(path)
+    return load_pcm(path)
+
+def duration_seconds(audio):
+    return len(audio) / SAMPLE_RATE
+
+duration_pattern = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+def probe_duration(input_path):
+    """Duration of a media file in seconds from ffmpeg's header probe, or None if the container does not state it."""
+    result = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', str(input_path)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    match = duration_pattern.search(result.stderr.decode('utf-8', errors='replace'))
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def pcm_bytes(seconds):
+    return int(seconds * SAMPLE_RATE * BYTES_PER_SAMPLE)
+
+def mp3_bytes(seconds):
+    return int(seconds * MP3_BITRATE / 8)
+
+# Function to print what a run cost and saved, normalized to one hour of audio
+def print_savings_report(label, audio_seconds, elapsed_seconds, bytes_written):
+    if audio_seconds <= 0:
+        return
+    hours = audio_seconds / 3600
+    saved_bytes = mp3_bytes(audio_seconds) - bytes_written
+    print(f"{label}: {audio_seconds / 60:.1f} min of audio in {elapsed_seconds:.2f} s "
+          f"({elapsed_seconds / hours:.1f} s per hour of audio)")
+    print(f"{label}: {bytes_written / hours / 1e6:.1f} MB written per hour of audio, "
+          f"{saved_bytes / hours / 1e6:+.1f} MB per hour compared to the 192k MP3 intermediate")
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# In-process pipeline runner: every media file moves on to the next stage as soon as its previous stage is done,
+# instead of each stage script processing the whole directory before the next one starts.
+#
+#   extract -> transcribe -> reblock -> verbalize -> translate
+#
+# Every stage has its own bounded thread pool: ffmpeg jobs run side by side, the Whisper model
+# (loaded once, while the first videos are still being extracted) takes one file at a time,
+# and the OpenAI stages keep several files in flight because they mostly wait on the network.
+import argparse
+import importlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cascade
+import cpu_backend
+import hallucination
+import metrics
+import transcription
+from stage_cache import StageCache
+
+STAGES = ['extract', 'transcribe', 'reblock', 'verbalize', 'translate']
+
+# Default number of files each stage works on at the same time
+default_limits = {
+    'extract': os.cpu_count() or 1,  # CPU-bound ffmpeg processes
+    'transcribe': 1,                 # One resident model, decoding uses all cores / the GPU
+    'reblock': 2,
+    'verbalize': 4,                  # I/O-bound OpenAI requests
+    'translate': 4,
+}
+
+# Stage scripts, imported only when their stage is used (their names start with digits, so import_module is needed)
+stage_scripts = {
+    'extract': '01_audio_detach',
+    'reblock': '03_reblock',
+    'verbalize': '04_verbalize',
+    'translate': '05_translate',
+}
+
+class Pipeline:
+    def __init__(self, stages, limits, incremental=False, force=False, audio_format='mp3', use_vad=False,
+                 word_timestamps=False, backend=cpu_backend.default_backend, threads=None, use_cascade=False,
+                 repair=False):
+        self.stages = stages
+        self.audio_format = audio_format
+        self.use_vad = use_vad
+        self.word_timestamps = word_timestamps
+        self.repair = repair
+        self.modules = {stage: importlib.import_module(stage_scripts[stage]) for stage in stages if stage in stage_scripts}
+        if 'translate' in self.modules:
+            # Read before any work starts; raises RuntimeError if the key is missing
+            self.modules['translate'].load_api_key()
+
+        params = {
+            'extract': lambda: self.modules['extract'].stage_params(audio_format),
+            'transcribe': lambda: transcription.stage_params(transcription.model_name, use_vad, word_timestamps, backend,
+                                                             cascade.params() if use_cascade else None,
+                                                             hallucination.params() if repair else None),
+            'reblock': lambda: self.modules['reblock'].stage_params(),
+            'verbalize': lambda: self.modules['verbalize'].stage_params(),
+            'translate': lambda: self.modules['translate'].stage_params(),
+        }
+        self.caches = {stage: StageCache(stage, params[stage](), enabled=incremental, force=force) for stage in stages}
+        self.executors = {stage: ThreadPoolExecutor(max_workers=max(1, limits[stage]), thread_name_prefix=stage) for stage in stages}
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.all_done = threading.Event()
+        self.items = []
+        self.stage_busy = {stage: 0.0 for stage in stages}
+        self.start_time = None
+
+        self.model_future = None
+        if 'transcribe' in stages:
+            # Queued first on the transcription pool, so the model loads while the first videos are extracted
+            load = cascade.load if use_cascade else transcription.load_model
+            self.model_future = self.executors['transcribe'].submit(load, transcription.model_name, backend, threads)
+
+    # ----- Stage functions: each takes the input path and returns the path for the next stage -----
+
+    def run_extract(self, path):
+        cache = self.caches['extract']
+        if not cache.should_process(path):
+            return cache.previous_outputs(path)[0]
+        extract = self.modules['extract']
+        # The full path, since the daemon also queues files from outside data/input
+        _, output_filename, _, error = extract.extract_audio(str(path), self.audio_format, cache)
+        if error is not None:
+            raise RuntimeError(error)
+        return Path(extract.audio_output_dir) / output_filename
+
+    def run_transcribe(self, path):
+        cache = self.caches['transcribe']
+        if not cache.should_process(path):
+            outputs = cache.previous_outputs(path)
+        else:
+            model, model_load_seconds = self.model_future.result()
+            input_hash = cache.input_hash(path)
+            names, _ = transcription.transcribe_file(model, path, verbose=False, use_vad=self.use_vad,
+                                                     output_names=transcription.previous_output_names(cache, path),
+                                                     word_timestamps=self.word_timestamps, repair=self.repair)
+            outputs = transcription.output_paths(names)
+            cache.record(path, input_hash, outputs)
+        return next(Path(output) for output in outputs if str(output).endswith('.srt'))
+
+    def run_in_place(self, stage, path):
+        # 03 and 04 rewrite the SRT they read
+        cache = self.caches[stage]
+        if cache.should_process(path):
+            input_hash = cache.input_hash(path)
+            self.modules[stage].process_srt_file(path, path)
+            cache.record(path, input_hash, [path])
+        return path
+
+    def run_translate(self, path):
+        translate = self.modules['translate']
+        # One output per target language; the first is the path handed on
+        output_paths = translate.output_paths(path)
+        cache = self.caches['translate']
+        if cache.should_process(path):
+            input_hash = cache.input_hash(path)
+            translate.process_srt_file(path, output_paths)
+            written = [output for output in output_paths.values() if output.exists()]
+            if written:
+                cache.record(path, input_hash, written)
+        return output_paths[translate.target_languages[0]]
+
+    def run_stage(self, stage, path):
+        if stage == 'extract':
+            return self.run_extract(path)
+        if stage == 'transcribe':
+            return self.run_transcribe(path)
+        if stage == 'translate':
+            return self.run_translate(path)
+        return self.run_in_place(stage, path)
+
+    # ----- Scheduling -----
+
+    def submit(self, item, stage_index):
+        stage = self.stages[stage_index]
+        item['submitted_at'] = time.time()
+        self.executors[stage].submit(self.step, item, stage_index)
+
+    def step(self, item, stage_index):
+        stage = self.stages[stage_index]
+        stage_start = time.time()
+        # Time spent waiting for a free worker of the stage
+        metrics.observe('pipeline_queue_seconds', stage_start - item['submitted_at'], stage=stage)
+        try:
+            with metrics.span(f'pipeline.{stage}', file=item['name']):
+                item['path'] = Path(self.run_stage(stage, item['path']))
+            item['outputs'][stage] = item['path']
+            error = None
+        except BaseException as e:
+            # SystemExit from a stage included: every item must reach finish(), or run() waits forever
+            error = e if isinstance(e, Exception) else RuntimeError(f"{type(e).__name__} {e}".strip())
+        elapsed = time.time() - stage_start
+
+        with self.lock:
+            item['stage_seconds'][stage] = elapsed
+            self.stage_busy[stage] += elapsed
+
+        if error is not None:
+            print(f"[{stage}] {item['name']} failed: {error}")
+            self.finish(item, ok=False)
+        elif stage_index + 1 < len(self.stages):
+            print(f"[{stage}] {item['name']} done in {elapsed:.2f} s")
+            self.submit(item, stage_index + 1)
+        else:
+            print(f"[{stage}] {item['name']} done in {elapsed:.2f} s, file finished")
+            self.finish(item, ok=True)
+
+    def finish(self, item, ok):
+        with self.lock:
+            item['finished_at'] = time.time()
+            item['ok'] = ok
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.all_done.set()
+        if item.get('on_finish'):
+            item['on_finish'](item)
+
+    def add(self, path, first_stage=None, on_finish=None):
+        """Feeds one more file into a running pipeline, for callers that keep it open (ingest_daemon.py).
+        on_finish(item) is called once the file is done or has failed."""
+        item = {'name': Path(path).name, 'path': Path(path), 'stage_seconds': {}, 'outputs': {}, 'ok': None,
+                'on_finish': on_finish}
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            self.in_flight += 1
+            self.all_done.clear()
+            self.items.append(item)
+        self.submit(item, self.stages.index(first_stage) if first_stage else 0)
+        return item
+
+    def run(self, input_paths):
+        self.start_time = time.time()
+        if not input_paths:
+            print("Nothing to process.")
+            self.shutdown()
+            return
+        self.in_flight = len(input_paths)
+        for path in input_paths:
+            item = {'name': Path(path).name, 'path': Path(path), 'stage_seconds': {}, 'outputs': {}, 'ok': None}
+            self.items.append(item)
+            self.submit(item, 0)
+        self.all_done.wait()
+        self.shutdown()
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+
+    def print_report(self):
+        if not self.items:
+            return
+        finished = [item for item in self.items if item['ok']]
+        makespan = max(item['finished_at'] for item in self.items) - self.start_time
+
+        print("\nPer-file times (seconds):")
+        print("  " + "".join(f"{stage:>11}" for stage in self.stages) + "      total  file")
+        for item in sorted(self.items, key=lambda item: item['finished_at']):
+            cells = "".join(f"{item['stage_seconds'].get(stage, 0.0):11.2f}" for stage in self.stages)
+            status = "" if item['ok'] else "  FAILED"
+            print(f"  {cells} {item['finished_at'] - self.start_time:10.2f}  {item['name']}{status}")
+
+        print("\nStage utilization:")
+        for stage in self.stages:
+            workers = self.executors[stage]._max_workers
+            busy = self.stage_busy[stage]
+            print(f"  {stage:11} busy {busy:9.2f} s with {workers} worker(s), "
+                  f"{busy / (makespan * workers) if makespan > 0 else 0:.0%} of capacity")
+
+        if finished:
+            first = min(item['finished_at'] for item in finished) - self.start_time
+            print(f"\nTime to first finished file: {first:.2f} s")
+        print(f"Makespan: {makespan:.2f} s for {len(self.items)} file(s) ({len(finished)} finished)")
+        if self.model_future and self.model_future.done() and isinstance(self.model_future.result()[0], cascade.Cascade):
+            self.model_future.result()[0].print_report()
+
+# Function to list the inputs of the first stage
+def list_inputs(first_stage):
+    if first_stage == 'extract':
+        extract = importlib.import_module(stage_scripts['extract'])
+        return [Path(extract.video_dir) / f for f in extract.list_video_files(extract.video_dir)]
+    if first_stage == 'transcribe':
+        return [transcription.audio_dir / f for f in transcription.list_media_files(transcription.audio_dir, transcription.supported_extensions)]
+    module = importlib.import_module(stage_scripts[first_stage])
+    return [Path(module.input_dir) / f for f in sorted(os.listdir(module.input_dir))
+            if f.endswith('.srt') and not f.endswith(module.translated_suffixes)]
+
+# Function to run the pipeline with the given options
+def run_pipeline(first_stage='extract', last_stage='translate', limits=None, incremental=False, force=False,
+                 audio_format='mp3', use_vad=False, word_timestamps=False, backend=cpu_backend.default_backend,
+                 threads=None, use_cascade=False, repair=False):
+    stages = STAGES[STAGES.index(first_stage):STAGES.index(last_stage) + 1]
+    limits = dict(default_limits, **(limits or {}))
+
+    start_time = time.time()
+    pipeline = Pipeline(stages, limits, incremental=incremental, force=force, audio_format=audio_format, use_vad=use_vad,
+                        word_timestamps=word_timestamps, backend=backend, threads=threads, use_cascade=use_cascade,
+                        repair=repair)
+    inputs = list_inputs(first_stage)
+    print(f"Running {' -> '.join(stages)} on {len(inputs)} file(s)")
+    pipeline.run(inputs)
+    pipeline.print_report()
+
+    elapsed_time = time.time() - start_time
+    minutes, seconds = divmod(elapsed_time, 60)
+    print(f"Time taken for the pipeline: {int(minutes)} minutes and {seconds:.2f} seconds\n")
+    return pipeline
+
+# Main function to run the script
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline stages in one process, moving each file on as soon as a stage is done.")
+    parser.add_argument("--from", dest="first_stage", choices=STAGES, default='extract', help="First stage to run")
+    parser.add_argument("--to", dest="last_stage", choices=STAGES, default='translate', help="Last stage to run")
+    for stage in STAGES:
+        parser.add_argument(f"--{stage}_workers", type=int, default=default_limits[stage],
+                            help=f"Files processed at the same time by the {stage} stage (default: {default_limits[stage]})")
+    parser.add_argument("--format", dest="audio_format", choices=('mp3', 'pcm'), default='mp3', help="Audio format written by the extract stage")
+    parser.add_argument("--vad", action="store_true", help="Transcribe only the detected speech regions")
+    parser.add_argument("--word_timestamps", action="store_true", help="Record word times, so the reblock stage cuts blocks between words")
+    parser.add_argument("--backend", choices=cpu_backend.backends, default=cpu_backend.default_backend,
+                        help="int8: quantize the linear layers of the Whisper model for CPU nodes")
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch (default: all cores)")
+    parser.add_argument("--cascade", action="store_true", help="Transcribe with a small model first and re-decode only the low-confidence parts")
+    parser.add_argument("--repair", action="store_true", help="Re-decode only the windows with repetition loops or text over silence")
+    parser.add_argument("--incremental", action="store_true", help="Skip inputs whose content and stage parameters are unchanged")
+    parser.add_argument("--force", action="store_true", help="With --incremental: process every input again")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('pipeline', args)
+
+    if STAGES.index(args.first_stage) > STAGES.index(args.last_stage):
+        parser.error("--from must not come after --to")
+
+    limits = {stage: getattr(args, f"{stage}_workers") for stage in STAGES}
+    try:
+        run_pipeline(args.first_stage, args.last_stage, limits, incremental=args.incremental, force=args.force,
+                     audio_format=args.audio_format, use_vad=args.vad, word_timestamps=args.word_timestamps,
+                     backend=args.backend, threads=args.threads, use_cascade=args.cascade,
+                     repair=args.repair)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Request and token budgets for the OpenAI stages, shared by every request of a process.
+#
+# The buckets are guarded by a threading lock and only compute wait times, and waiting is done by the
+# caller with asyncio.sleep. One limiter can therefore serve several event loops at once, for example
+# the in-process pipeline translating a few files in parallel threads.
+import asyncio
+import random
+import threading
+import time
+
+import metrics
+
+# Retry policy for failed requests
+max_retries = 6
+backoff_base = 1.0   # seconds
+backoff_cap = 60.0   # seconds
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to one minute of capacity."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # A single request larger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        self.refill(now)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budget, plus a shared pause after a 429."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens):
+        """Takes one request and `tokens` tokens if both are available. Returns 0.0 on success, else the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.level -= 1
+            self.tokens.level -= min(tokens, self.tokens.capacity)
+            return 0.0
+
+    async def acquire(self, tokens):
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                metrics.observe('rate_limit_wait_seconds', waited)
+                return
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """Stops every caller for `seconds`, as asked by a 429 response."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def refund(self, estimated_tokens, actual_tokens):
+        """Gives back the difference when a request used fewer tokens than estimated."""
+        with self.lock:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + max(0, estimated_tokens - actual_tokens))
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt, capped."""
+    return random.uniform(0, min(backoff_cap, backoff_base * (2 ** attempt)))
+
+def retry_after_seconds(error):
+    """Reads the Retry-After (or retry-after-ms) header of an OpenAI API error, if there is one."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        return None
+    return None
+
+def estimate_tokens(text):
+    """Rough token count for budgeting: about three characters per token for Russian and Ukrainian text."""
+    return len(text) // 3 + 1
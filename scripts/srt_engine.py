@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# Array-backed SRT reblocking for 03_reblock.py.
+#
+# The subtitle times are kept in integer-millisecond NumPy arrays and the words of the whole file in one
+# flat list, split once. Which input block closes every output block is found for all blocks at once
+# with a cumulative word count, and the output is written block by block as the times are computed.
+#
+# The output is the same, byte for byte, as the pysrt implementation (process_srt_file_pysrt in
+# 03_reblock.py). That includes its rounding: add_time works with fractional milliseconds, and the next
+# block starts from that end time rounded down, while the duration is measured from the fractional value.
+import codecs
+import math
+import os
+import re
+
+import numpy as np
+
+# Byte order marks recognized the same way as pysrt
+boms = ((codecs.BOM_UTF32_LE, 'utf_32_le'),
+        (codecs.BOM_UTF32_BE, 'utf_32_be'),
+        (codecs.BOM_UTF16_LE, 'utf_16_le'),
+        (codecs.BOM_UTF16_BE, 'utf_16_be'),
+        (codecs.BOM_UTF8, 'utf_8'))
+
+time_separator = re.compile(r'\:|\.|\,')
+leading_integer = re.compile(r'^(\d+)')
+# The usual timing line, parsed in one step; anything else goes through the general rules of parse_item
+timing_line = re.compile(r'\s*(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)\s*$')
+
+class SrtTable:
+    """Start and end times (ms) and word counts of every block, and the words of all blocks in one list."""
+
+    def __init__(self, starts, ends, word_counts, words):
+        self.starts = starts
+        self.ends = ends
+        self.word_counts = word_counts
+        self.words = words
+
+    def __len__(self):
+        return len(self.starts)
+
+def read_text(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    for bom, encoding in boms:
+        if data.startswith(bom):
+            return data[len(bom):].decode(encoding)
+    return data.decode('utf-8')
+
+def parse_int(digits):
+    try:
+        return int(digits)
+    except ValueError:
+        match = leading_integer.match(digits)
+        return int(match.group()) if match else 0
+
+def parse_time(value):
+    """'HH:MM:SS,mmm' -> milliseconds, or None if it is not a time. An empty value is 0, as in pysrt."""
+    if not value:
+        return 0
+    items = time_separator.split(value)
+    if len(items) != 4:
+        return None
+    hours, minutes, seconds, milliseconds = (parse_int(item) for item in items)
+    return hours * 3600000 + minutes * 60000 + seconds * 1000 + milliseconds
+
+def parse_item(lines):
+    """(start, end, words) of one block, or None if pysrt would skip it."""
+    if len(lines) < 2:
+        return None
+    lines = [line.rstrip() for line in lines]
+    if '-->' not in lines[0]:
+        lines.pop(0)
+    timestamps = lines[0].split('-->')
+    if len(timestamps) != 2:
+        return None
+    start = parse_time(timestamps[0].strip())
+    end = parse_time(timestamps[1].lstrip().split(' ', 1)[0].strip())
+    if start is None or end is None:
+        return None
+    words = []
+    for line in lines[1:]:
+        words.extend(line.split())
+    return start, end, words
+
+def read_srt(path):
+    """Parses an SRT file into an SrtTable. Blocks that pysrt cannot parse are skipped, as pysrt does."""
+    starts = []
+    ends = []
+    word_counts = []
+    words = []
+    lines = read_text(path).splitlines()
+    lines.append('')  # Sentinel that ends the last block
+    i = 0
+    while i < len(lines):
+        if not lines[i].strip():
+            i += 1
+            continue
+        j = i + 1
+        while lines[j].strip():
+            j += 1
+        block = lines[i:j]
+        i = j
+
+        match = timing_line.match(block[1]) if len(block) >= 2 and '-->' not in block[0] else None
+        if match:
+            h1, m1, s1, ms1, h2, m2, s2, ms2 = map(int, match.groups())
+            start = h1 * 3600000 + m1 * 60000 + s1 * 1000 + ms1
+            end = h2 * 3600000 + m2 * 60000 + s2 * 1000 + ms2
+            block_words = ' '.join(block[2:]).split()
+        else:
+            item = parse_item(block)
+            if item is None:
+                continue
+            start, end, block_words = item
+        starts.append(start)
+        ends.append(end)
+        word_counts.append(len(block_words))
+        words.extend(block_words)
+    return SrtTable(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                    np.array(word_counts, dtype=np.int64), words)
+
+def words_per_block(table, seconds_per_block):
+    """Words spoken in seconds_per_block at the average pace of the file."""
+    total_duration_seconds = int(table.ends[-1]) / 1000.0
+    total_words = int(table.word_counts.sum())
+    avg_time_per_word = total_duration_seconds / total_words
+    return int(seconds_per_block / avg_time_per_word)
+
+def end_ordinal(start, delta_ms):
+    """add_time of 03_reblock.py: the start rounded down to whole milliseconds, plus a fractional delta."""
+    start_ms = start if isinstance(start, int) else math.floor(start)
+    total_ms = start_ms + delta_ms
+    hours, remainder = divmod(total_ms, 3600000)
+    minutes, remainder = divmod(remainder, 60000)
+    seconds, milliseconds = divmod(remainder, 1000)
+    return hours * 3600000 + minutes * 60000 + seconds * 1000 + milliseconds
+
+def reblock(table, seconds_per_block):
+    """Yields (start, end, text) of the output blocks; times are milliseconds and may be fractional."""
+    if len(table) == 0:
+        raise IndexError("the subtitle file has no blocks")
+    block_words = words_per_block(table, seconds_per_block)
+    if block_words < 1:
+        raise ValueError(f"{seconds_per_block} seconds hold less than one word at the pace of this file")
+
+    # Every full block closes at the first input block whose cumulative word count reaches its last word
+    cumulative = np.cumsum(table.word_counts)
+    total_words = int(cumulative[-1])
+    full_blocks = total_words // block_words
+    first_word = np.arange(full_blocks, dtype=np.int64) * block_words
+    closing = np.searchsorted(cumulative, first_word + block_words, side='left')
+    closing_ends = table.ends[closing].tolist()
+    buffered_words = (cumulative[closing] - first_word).tolist()
+
+    words = table.words
+    start = int(table.starts[0])
+    for j in range(full_blocks):
+        # Duration from the fractional start; add_time then starts from the rounded-down one
+        word_duration_ms = (closing_ends[j] - start) / buffered_words[j]
+        end = end_ordinal(start, word_duration_ms * block_words)
+        yield start, end, ' '.join(words[j * block_words:(j + 1) * block_words])
+        start = end
+
+    if full_blocks * block_words < total_words:
+        yield start, int(table.ends[-1]), ' '.join(words[full_blocks * block_words:])
+
+# Cutting on real word times (recorded by 02_transcribe.py --word_timestamps)
+PAUSE_SECONDS = 0.5       # A gap this long inside the target window ends the block right there
+LONG_PAUSE_SECONDS = 3.0  # A gap this long always ends the block, however short it is
+MIN_FRACTION = 0.75       # The window where a block may end, as fractions of SECONDS_PER_BLOCK
+MAX_FRACTION = 1.25
+sentence_ends = ('.', '?', '!', '…')
+
+def reblock_words(words, seconds_per_block, pause_seconds=PAUSE_SECONDS, long_pause_seconds=LONG_PAUSE_SECONDS,
+                  min_fraction=MIN_FRACTION, max_fraction=MAX_FRACTION):
+    """Yields (start, end, text) blocks of about seconds_per_block seconds, in milliseconds, cut between words.
+    Inside the window a block ends at the first pause, else at the best cut: the longest gap,
+    with a bonus for the end of a sentence. A long silence ends a block anywhere."""
+    n = len(words)
+    if n == 0:
+        return
+    starts = np.asarray(words.starts, dtype=np.float64)
+    ends = np.maximum.accumulate(np.asarray(words.ends, dtype=np.float64))  # Sorted, for searchsorted
+    gaps = np.empty(n)
+    gaps[:-1] = starts[1:] - ends[:-1]
+    gaps[-1] = np.inf
+    score = gaps + 0.3 * np.array([text.rstrip().endswith(sentence_ends) for text in words.texts])
+    long_pauses = np.flatnonzero(gaps >= long_pause_seconds)
+
+    i = 0
+    while i < n:
+        # Words whose end falls in the window [min_fraction, max_fraction] * seconds_per_block from the block start
+        low = int(np.searchsorted(ends, starts[i] + seconds_per_block * min_fraction, side='left'))
+        high = int(np.searchsorted(ends, starts[i] + seconds_per_block * max_fraction, side='right'))
+        pause_index = np.searchsorted(long_pauses, i)
+        next_long = int(long_pauses[pause_index]) if pause_index < len(long_pauses) else n - 1
+
+        if next_long < low or low >= n:
+            last = min(next_long, n - 1)
+        else:
+            window = score[low:max(high, low + 1)]
+            pauses = np.flatnonzero(window >= pause_seconds)
+            last = low + int(pauses[0] if pauses.size else np.argmax(window))
+        yield starts[i] * 1000.0, ends[last] * 1000.0, ''.join(words.texts[i:last + 1]).strip()
+        i = last + 1
+
+def format_time(ordinal):
+    """SubRipTime formatting: fractional milliseconds are cut off and negative times are shown as zero."""
+    ms = max(0, math.floor(ordinal))
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    return '%02d:%02d:%02d,%03d' % (hours, minutes, seconds, ms)
+
+def write_srt(path, blocks, eol=os.linesep, chunk_blocks=1000):
+    """Writes (start, end, text) blocks as they come, numbered from 1, like SubRipFile.save.
+    The file is written under a temporary name and renamed, so a crash never leaves half an SRT."""
+    temporary_path = f"{path}.part"
+    with open(temporary_path, 'w', encoding='utf-8', newline='') as f:
+        chunk = []
+        for index, (start, end, text) in enumerate(blocks, start=1):
+            chunk.append(f"{index}{eol}{format_time(start)} --> {format_time(end)}{eol}{text}{eol}{eol}")
+            if len(chunk) >= chunk_blocks:
+                f.write(''.join(chunk))
+                chunk = []
+        f.write(''.join(chunk))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+def reblock_file(input_file, output_file, seconds_per_block):
+    """Reblocks an SRT file. The input is read completely first, so it may be rewritten in place."""
+    table = read_srt(input_file)
+    write_srt(output_file, reblock(table, seconds_per_block))
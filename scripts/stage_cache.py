@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Manifest of finished pipeline work, used by the --incremental mode of every stage.
+#
+# Each stage records, per input file, the content hash of the input, a hash of the parameters
+# that influence the result (model, beam size, block length, prompt, language...) and the
+# outputs it wrote. On the next run a stage skips every input whose hash and parameters are
+# unchanged and whose outputs still exist, so unchanged files cost nothing and only changed
+# files flow downstream.
+#
+# 03_reblock.py and 04_verbalize.py rewrite their input in place. For those the manifest
+# also remembers the hashes that later in-place stages produced from an output, so a
+# reblocked-then-verbalized SRT is still recognized as "reblock done".
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Paths
+base_dir = Path(__file__).resolve().parent.parent
+manifest_path = base_dir / 'data' / 'manifest.json'
+lock_path = base_dir / 'data' / 'manifest.lock'
+
+MANIFEST_VERSION = 1
+HASH_CHUNK_BYTES = 1 << 20
+
+def params_hash(params):
+    """Returns a stable hash of a JSON-serializable dict of stage parameters."""
+    encoded = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def relative_key(path):
+    """Manifest keys are paths relative to the repository, so the data folder can be moved."""
+    path = Path(path).resolve()
+    try:
+        return str(path.relative_to(base_dir))
+    except ValueError:
+        return str(path)
+
+def load_manifest():
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'files': {}, 'stages': {}}
+
+def add_cache_arguments(parser):
+    """Adds the --incremental, --force and --dry_run options shared by all stages."""
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip inputs whose content and stage parameters are unchanged since the last run")
+    parser.add_argument("--force", action="store_true",
+                        help="With --incremental: process every input again and refresh the manifest")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only list which inputs would be processed (implies --incremental)")
+
+class StageCache:
+    """Per-stage view of the manifest. With enabled=False every input is processed and nothing is recorded."""
+
+    def __init__(self, stage, params, enabled=False, force=False, dry_run=False):
+        self.stage = stage
+        self.params_hash = params_hash(params)
+        self.enabled = enabled or dry_run
+        self.force = force
+        self.dry_run = dry_run
+        self.manifest = load_manifest() if self.enabled else None
+        self.hashed = {}  # File hashes computed by this process, kept when the manifest is reloaded
+        self.skipped = 0
+        self.processed = 0
+
+    @classmethod
+    def from_args(cls, stage, params, args):
+        return cls(stage, params, enabled=args.incremental, force=args.force, dry_run=args.dry_run)
+
+    # Function to hash a file, reusing the stored hash while size and modification time are unchanged
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = relative_key(path)
+        known = self.manifest['files'].get(key)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        digest = hash_file(path)
+        self.manifest['files'][key] = self.hashed[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+        return digest
+
+    def entry(self, input_path):
+        return self.manifest['stages'].get(self.stage, {}).get(relative_key(input_path))
+
+    def previous_outputs(self, input_path):
+        """Returns the outputs recorded for an input, so a re-run can overwrite them instead of writing _v1 copies."""
+        if not self.enabled:
+            return None
+        entry = self.entry(input_path)
+        return [base_dir / output for output in entry['outputs']] if entry else None
+
+    def is_fresh(self, input_path):
+        """Returns True if the recorded outputs for this input are still valid."""
+        if not self.enabled or self.force:
+            return False
+        entry = self.entry(input_path)
+        if not entry or entry['params_hash'] != self.params_hash:
+            return False
+        if not all((base_dir / output).exists() for output in entry['outputs']):
+            return False
+
+        current_hash = self.file_hash(input_path)
+        if entry['outputs'] == [relative_key(input_path)]:
+            # In-place stage: the file must still hold our output, or something a later stage made from it
+            return current_hash == entry['output_hash'] or current_hash in entry.get('derived', [])
+        return current_hash == entry['input_hash']
+
+    def should_process(self, input_path):
+        """Decides whether an input needs work, printing the decision in dry-run mode. Returns False for dry runs."""
+        fresh = self.is_fresh(input_path)
+        if fresh:
+            self.skipped += 1
+            print(f"[{self.stage}] up to date: {relative_key(input_path)}")
+            return False
+        if self.dry_run:
+            self.processed += 1
+            print(f"[{self.stage}] would run: {relative_key(input_path)}")
+            return False
+        self.processed += 1
+        return True
+
+    def input_hash(self, input_path):
+        """Hashes an input before the stage runs, which matters for stages that overwrite it."""
+        return self.file_hash(input_path) if self.enabled else None
+
+    def record(self, input_path, input_hash, output_paths):
+        """Stores the outputs of one input and saves the manifest."""
+        if not self.enabled or self.dry_run:
+            return
+        with open(lock_path, 'a') as lock_file:
+            # Other stages may update the manifest at the same time; merge under an exclusive lock
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.manifest = load_manifest()
+            # The hashes computed since the last save (should_process hashed the inputs) are not on disk yet
+            self.manifest['files'].update(self.hashed)
+            key = relative_key(input_path)
+            outputs = [relative_key(path) for path in output_paths]
+            output_hashes = [self.file_hash(path) for path in output_paths]
+
+            if outputs == [key] and input_hash != output_hashes[0]:
+                # An in-place rewrite: entries whose output we just consumed now also accept the new content
+                for entries in self.manifest['stages'].values():
+                    for other in entries.values():
+                        if key in other['outputs'] and (other.get('output_hash') == input_hash or input_hash in other.get('derived', [])):
+                            other.setdefault('derived', []).append(output_hashes[0])
+
+            self.manifest['stages'].setdefault(self.stage, {})[key] = {
+                'input_hash': input_hash,
+                'params_hash': self.params_hash,
+                'outputs': outputs,
+                'output_hash': output_hashes[0] if len(output_hashes) == 1 else None,
+                'derived': [],
+            }
+            self.save()
+
+    def save(self):
+        temp_path = f"{manifest_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, manifest_path)
+
+    def print_summary(self):
+        if self.enabled:
+            verb = "would process" if self.dry_run else "processing"
+            print(f"[{self.stage}] {verb} {self.processed} file(s), {self.skipped} up to date")
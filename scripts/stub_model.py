@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Stand-in for a Whisper model, for the benchmarks and for trying the server and the live mode without Whisper.
+#
+#   python3 transcribe_server.py --model stub
+#   python3 live_transcribe.py lecture.mp3 --realtime --model stub
+import numpy as np
+
+import pcm_audio
+
+# Words of the stub's segments (and of the benchmark's SRT fixtures)
+vocabulary = ("итак рассмотрим треугольник ABC у которого угол при вершине равен икс значит сторона "
+              "равна корню из двух и мы получаем что площадь это половина произведения основания на высоту").split()
+
+class StubModel:
+    """Answers like Whisper with one segment per 5 s of audio, at no cost; measures everything around the model."""
+
+    def transcribe(self, audio, verbose=True, word_timestamps=False, **_):
+        segments = []
+        seconds = pcm_audio.duration_seconds(audio)
+        for index, start in enumerate(np.arange(0.0, seconds, 5.0)):
+            text = ' ' + ' '.join(vocabulary[(index + k) % len(vocabulary)] for k in range(10))
+            segments.append({'id': index, 'start': float(start), 'end': float(min(seconds, start + 4.5)), 'text': text,
+                             'tokens': list(range(12)), 'avg_logprob': -0.2, 'compression_ratio': 1.4,
+                             'no_speech_prob': 0.01, 'temperature': 0.0})
+        return {'text': ''.join(segment['text'] for segment in segments), 'segments': segments, 'language': 'ru'}
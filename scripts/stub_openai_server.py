@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Minimal local stand-in for the OpenAI chat-completions endpoint, for testing the LLM stages offline.
+# It answers every request with the user message (optionally prefixed), after a configurable latency,
+# and can reject a share of the requests with 429 + Retry-After to exercise the retry path, or merge
+# two subtitle blocks of a share of the answers to exercise the separator-mismatch recovery. Requests with a
+# JSON schema response_format get a JSON object with the blocks of the user message under every required key.
+#
+#   python3 stub_openai_server.py --port 8089 --latency 0.5 --rate_limit_share 0.1
+#   python3 05_translate.py --base_url http://127.0.0.1:8089/v1
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+separator = "<|SUB_SEPARATOR|>"
+
+class StubState:
+    def __init__(self, latency, rate_limit_share, retry_after, prefix, mismatch_share=0.0):
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.prefix = prefix
+        self.mismatch_share = mismatch_share
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+        self.mismatched = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass  # Keep the console for the summary lines
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if not self.path.endswith('/chat/completions'):
+                self.send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+            with state.lock:
+                state.requests += 1
+                reject = random.random() < state.rate_limit_share
+                if reject:
+                    state.rejected += 1
+                else:
+                    state.in_flight += 1
+                    state.max_in_flight = max(state.max_in_flight, state.in_flight)
+            if reject:
+                self.send_json(429, {'error': {'message': 'Rate limit reached (stub)', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                               headers={'Retry-After': str(state.retry_after)})
+                return
+
+            try:
+                time.sleep(state.latency)
+                user_text = next((m['content'] for m in reversed(request.get('messages', [])) if m.get('role') == 'user'), '')
+                if separator in user_text and random.random() < state.mismatch_share:
+                    # Answer with two blocks merged into one, as models sometimes do
+                    user_text = user_text.replace(separator, ' ', 1)
+                    with state.lock:
+                        state.mismatched += 1
+                content = state.prefix + user_text
+                response_format = request.get('response_format') or {}
+                if response_format.get('type') == 'json_schema':
+                    # Structured output: one list of the blocks per required key (e.g. per language)
+                    keys = response_format['json_schema']['schema'].get('required', [])
+                    content = json.dumps({key: [state.prefix + block for block in user_text.split(separator)] for key in keys},
+                                         ensure_ascii=False)
+                prompt_chars = sum(len(m.get('content', '')) for m in request.get('messages', []))
+                self.send_json(200, {
+                    'id': f"chatcmpl-stub-{state.requests}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': request.get('model', 'stub'),
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': content},
+                        'finish_reason': 'stop',
+                    }],
+                    'usage': {
+                        'prompt_tokens': prompt_chars // 3,
+                        'completion_tokens': len(content) // 3,
+                        'total_tokens': prompt_chars // 3 + len(content) // 3,
+                    },
+                })
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+
+    return Handler
+
+# Main function to run the stub server
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI chat-completions endpoint that echoes the user message.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds to wait before answering")
+    parser.add_argument("--rate_limit_share", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After value sent with 429 answers")
+    parser.add_argument("--mismatch_share", type=float, default=0.0, help="Share of multi-block answers with two blocks merged")
+    parser.add_argument("--prefix", default="", help="Text put in front of every answer")
+    args = parser.parse_args()
+
+    state = StubState(args.latency, args.rate_limit_share, args.retry_after, args.prefix, args.mismatch_share)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(state))
+    print(f"Stub OpenAI server on http://127.0.0.1:{args.port}/v1 (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Requests: {state.requests}, answered with 429: {state.rejected}, with merged blocks: {state.mismatched}, max in flight: {state.max_in_flight}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+# Local HTTP service around the transcription path, for tools that cannot use the data/input and data/output folders.
+#
+#   python3 transcribe_server.py --port 8090 --pool 1 --max_queue 8
+#
+#   curl -s -X POST --data-binary @lecture.mp3 'http://127.0.0.1:8090/jobs?name=lecture.mp3'   # upload, answers the job id
+#   curl -s -X POST -H 'Content-Type: application/json' -d '{"path": "/root/package/data/input/lecture.mp3"}' \
+#        http://127.0.0.1:8090/jobs                                                            # or a local file
+#   curl -N http://127.0.0.1:8090/jobs/<id>/events    # Server-Sent Events: one 'segment' event per subtitle, then 'done'
+#   curl -N http://127.0.0.1:8090/jobs/<id>/srt       # the SRT itself, sent chunk by chunk while decoding goes on
+#   curl -s http://127.0.0.1:8090/jobs/<id>           # status; DELETE cancels; GET /health for the pool
+#
+# A POST with 'Accept: text/event-stream' answers with the event stream of the new job right away.
+#
+# The models are loaded once at start (--pool of them, one decoding thread each) and stay warm. The audio is
+# decoded window by window: up to window_seconds, cut in the pauses found by the energy VAD, so the segments
+# of the first window reach the clients while the rest of the file is still decoding. Whisper works on 30 s
+# windows anyway, so this costs little over one model.transcribe call on the whole file.
+#
+# Admission control: at most --max_queue jobs wait for a model. Further submissions get 429 with a Retry-After
+# estimated from the recent job durations, before their upload is read; while no model is loaded yet, or while
+# the server stops, they get 503. Uploads are spooled to disk and the audio of a job is only decoded when a model
+# takes it, so waiting jobs hold no audio in memory. Every client reads the segments of a job at its own pace,
+# so a slow client never holds up the decoder.
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import cpu_backend
+import metrics
+import pcm_audio
+import stub_model
+import transcription
+import vad
+from srt_engine import format_time
+
+# Paths to directories
+upload_dir = transcription.base_dir / 'data' / 'server' / 'uploads'
+allowed_dirs = [transcription.audio_dir]  # Local paths a client may ask for, besides uploads
+
+# Limits
+window_seconds = 30.0     # Longest stretch of audio decoded at once
+max_upload_bytes = 4 * 1024 ** 3
+job_ttl = 3600            # Seconds a finished job stays available to clients
+keepalive_seconds = 15    # Comment lines on idle event streams, so proxies keep the connection open
+read_chunk_bytes = 1024 * 1024
+
+media_extensions = transcription.supported_extensions + transcription.video_extensions
+
+# ----- Windows -----
+
+def plan_windows(audio, seconds=None, speech_only=False):
+    """(start_sample, end_sample) windows of at most seconds, cut in the middle of pauses where there are any.
+    With speech_only every window is trimmed to the speech in it, and windows without speech are dropped."""
+    limit = int((seconds or window_seconds) * pcm_audio.SAMPLE_RATE)
+    total = len(audio)
+    regions = vad.detect_speech(audio)
+    pauses = [(end + next_start) // 2 for (_, end), (next_start, _) in zip(regions, regions[1:])]
+
+    windows = []
+    start = 0
+    while total - start > limit:
+        # The last pause before the limit, unless it would make a window shorter than half the limit
+        cut = max((pause for pause in pauses if start + limit // 2 < pause <= start + limit), default=start + limit)
+        windows.append((start, cut))
+        start = cut
+    if total > start:
+        windows.append((start, total))
+    if not speech_only:
+        return windows
+
+    trimmed = []
+    for start, end in windows:
+        inside = [(max(start, region_start), min(end, region_end)) for region_start, region_end in regions
+                  if region_start < end and region_end > start]
+        if inside:
+            trimmed.append((inside[0][0], inside[-1][1]))
+    return trimmed
+
+def srt_block(index, segment):
+    return (f"{index + 1}\n{format_time(segment['start'] * 1000)} --> {format_time(segment['end'] * 1000)}\n"
+            f"{segment['text'].strip()}\n\n")
+
+# ----- Jobs -----
+
+class Job:
+    """One transcription. Its segments only grow; clients follow them with wait_for_change()."""
+
+    def __init__(self, path, name, use_vad=False, word_timestamps=False, save=False, upload=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.path = Path(path) if path is not None else None  # Uploads get theirs once the id is known
+        self.name = name
+        self.use_vad = use_vad
+        self.word_timestamps = word_timestamps
+        self.save = save
+        self.upload = upload
+        self.status = 'queued'
+        self.error = None
+        self.segments = []
+        self.outputs = []
+        self.audio_seconds = None
+        self.decoded_seconds = 0.0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.first_segment_at = None
+        self.finished_at = None
+        self.cancelled = False
+        self.version = 0
+        self.changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def update(self, segments=(), **fields):
+        with self.changed:
+            if segments and self.first_segment_at is None:
+                self.first_segment_at = time.time()
+            self.segments.extend(segments)
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait_for_change(self, seen_segments, seen_version, timeout):
+        """Waits until there is something a client has not seen. Returns (new segments, version, finished)."""
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.segments) > seen_segments or self.version != seen_version or self.finished,
+                                  timeout)
+            return self.segments[seen_segments:], self.version, self.finished
+
+    def summary(self, position=None):
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else None
+        summary = {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'segments': len(self.segments),
+            'audio_seconds': self.audio_seconds,
+            'decoded_seconds': round(self.decoded_seconds, 3),
+            'queued_seconds': round((self.started_at or time.time()) - self.submitted_at, 3),
+            'first_segment_seconds': round(self.first_segment_at - self.submitted_at, 3) if self.first_segment_at else None,
+            'real_time_factor': round(elapsed / self.decoded_seconds, 3) if elapsed and self.decoded_seconds else None,
+        }
+        if position is not None:
+            summary['position'] = position
+        if self.outputs:
+            summary['outputs'] = self.outputs
+        if self.error:
+            summary['error'] = self.error
+        return summary
+
+class Rejected(Exception):
+    """A submission the service does not take, with the HTTP status to answer (429 and 503 mean: try again later)."""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class TranscriptionService:
+    """The warm model pool and the bounded queue of jobs in front of it."""
+
+    def __init__(self, model_name, pool_size=1, max_queue=8, backend=cpu_backend.default_backend, threads=None):
+        self.model_name = model_name
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.backend = backend
+        self.threads = threads
+        self.lock = threading.Condition()
+        self.pending = deque()
+        self.reserved = 0           # Admitted submissions whose upload is still being read
+        self.jobs = {}
+        self.models_loaded = 0
+        self.load_errors = []       # One per model thread whose load failed
+        self.busy = 0
+        self.stopping = False
+        self.recent_job_seconds = deque(maxlen=20)
+        self.workers = [threading.Thread(target=self.worker_loop, name=f"model-{index}", daemon=True)
+                        for index in range(pool_size)]
+
+    def start(self):
+        os.makedirs(upload_dir, exist_ok=True)
+        for worker in self.workers:
+            worker.start()
+
+    def load_model(self):
+        if self.model_name == 'stub':
+            # Answers at once, for trying the service without Whisper
+            return stub_model.StubModel(), 0.0
+        return transcription.load_model(self.model_name, self.backend, self.threads)
+
+    # ----- Admission -----
+
+    def retry_after(self):
+        """Seconds until a queue slot is likely to be free, from the recent job durations."""
+        job_seconds = sum(self.recent_job_seconds) / len(self.recent_job_seconds) if self.recent_job_seconds else 10.0
+        return max(1, int(job_seconds / max(1, self.pool_size)))
+
+    def admit(self):
+        """Reserves a queue slot for a new job, or raises Rejected. Called before an upload is read."""
+        with self.lock:
+            if self.stopping:
+                raise Rejected(503, "The server is stopping")
+            if self.models_loaded == 0 and len(self.load_errors) == self.pool_size:
+                raise Rejected(503, f"The model failed to load: {self.load_errors[0]}")
+            if self.models_loaded == 0:
+                raise Rejected(503, "No model is loaded yet", retry_after=5)
+            if len(self.pending) + self.reserved >= self.max_queue:
+                metrics.increment('server_rejected', reason='queue_full')
+                raise Rejected(429, f"{self.max_queue} jobs are waiting already", retry_after=self.retry_after())
+            self.reserved += 1
+
+    def release(self):
+        """Gives back a slot reserved by admit() whose job was never queued."""
+        with self.lock:
+            self.reserved -= 1
+
+    def enqueue(self, job):
+        """Queues a job for a slot reserved by admit(). Returns its position in the queue."""
+        with self.lock:
+            self.reserved -= 1
+            self.drop_expired()
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            print(f"Job {job.id}: {job.name} queued at position {len(self.pending)}")
+            metrics.set_gauge('server_queue_depth', len(self.pending))
+            self.lock.notify()
+            return len(self.pending)
+
+    def position(self, job):
+        with self.lock:
+            return next((index + 1 for index, pending in enumerate(self.pending) if pending is job), None)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job):
+        with self.lock:
+            if job in self.pending:
+                self.pending.remove(job)
+                self.finish(job, 'cancelled')
+            elif not job.finished:
+                # Running: the decoding thread stops after the current window
+                job.cancelled = True
+
+    def drop_expired(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and now - job.finished_at > job_ttl]:
+            del self.jobs[job_id]
+
+    def health(self):
+        with self.lock:
+            return {'model': self.model_name, 'pool': self.pool_size, 'models_loaded': self.models_loaded,
+                    'busy': self.busy, 'queued': len(self.pending), 'max_queue': self.max_queue,
+                    'jobs': len(self.jobs), 'stopping': self.stopping, 'load_errors': list(self.load_errors)}
+
+    # ----- Decoding -----
+
+    def worker_loop(self):
+        print(f"Loading Whisper model '{self.model_name}' ({self.backend}) for {threading.current_thread().name}...")
+        try:
+            model, load_seconds = self.load_model()
+        except Exception as e:
+            # Shown by /health and in the 503 answers; the other models of the pool may still load
+            print(f"Error: {threading.current_thread().name} could not load the model: {type(e).__name__}: {e}")
+            with self.lock:
+                self.load_errors.append(f"{type(e).__name__}: {e}")
+            return
+        print(f"Model loaded in {load_seconds:.2f} s")
+        with self.lock:
+            self.models_loaded += 1
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.pending or self.stopping)
+                if self.stopping:
+                    return
+                job = self.pending.popleft()
+                self.busy += 1
+                metrics.set_gauge('server_queue_depth', len(self.pending))
+                metrics.set_gauge('server_busy_models', self.busy)
+            try:
+                self.run_job(model, job)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                    metrics.set_gauge('server_busy_models', self.busy)
+                metrics.flush()
+
+    def run_job(self, model, job):
+        job.update(status='running', started_at=time.time())
+        metrics.observe('server_queue_seconds', job.started_at - job.submitted_at)
+        print(f"Job {job.id}: transcribing {job.name} (waited {job.started_at - job.submitted_at:.2f} s in the queue)")
+        try:
+            with metrics.span('server.job', file=job.name, vad=job.use_vad) as span:
+                with metrics.span('transcribe.load_audio'):
+                    audio = pcm_audio.load_audio_array(job.path)
+                job.update(audio_seconds=round(pcm_audio.duration_seconds(audio), 3))
+                windows = plan_windows(audio, speech_only=job.use_vad)
+                for start, end in windows:
+                    if job.cancelled:
+                        break
+                    offset = start / pcm_audio.SAMPLE_RATE
+                    with metrics.span('server.window', start=offset, seconds=(end - start) / pcm_audio.SAMPLE_RATE):
+                        result = transcription.transcribe_audio(model, audio[start:end], verbose=False,
+                                                                word_timestamps=job.word_timestamps)
+                    segments = [transcription.shift_segment(segment, offset) for segment in result['segments']]
+                    job.update(segments, decoded_seconds=end / pcm_audio.SAMPLE_RATE)
+                span.set(windows=len(windows), segments=len(job.segments))
+            if job.save and not job.cancelled:
+                result = {'text': ''.join(segment['text'] for segment in job.segments), 'segments': job.segments}
+                # The silent intro is only skipped with the VAD, as in 02_transcribe.py
+                job.update(outputs=transcription.save_outputs(result, job.name, initial_shift=0 if job.use_vad else 6))
+            self.finish(job, 'cancelled' if job.cancelled else 'done')
+        except Exception as e:
+            # One broken file must not take a model out of the pool
+            print(f"Job {job.id} failed: {e}")
+            self.finish(job, 'failed', str(e))
+
+    def finish(self, job, status, error=None):
+        job.update(status=status, error=error, finished_at=time.time())
+        if job.upload and job.path.exists():
+            os.remove(job.path)
+        metrics.increment('server_jobs', status=status)
+        if job.started_at is not None:
+            job_seconds = job.finished_at - job.started_at
+            self.recent_job_seconds.append(job_seconds)
+            if job.first_segment_at is not None:
+                metrics.observe('server_first_segment_seconds', job.first_segment_at - job.submitted_at)
+            summary = job.summary()
+            print(f"Job {job.id} {status} in {job_seconds:.2f} s: {summary['segments']} segments"
+                  + (f", the first after {summary['first_segment_seconds']} s" if job.first_segment_at else "")
+                  + (f", real-time factor {summary['real_time_factor']}" if summary['real_time_factor'] else ""))
+
+    def stop(self):
+        """Lets the running jobs finish; queued jobs are cancelled."""
+        with self.lock:
+            self.stopping = True
+            while self.pending:
+                self.finish(self.pending.popleft(), 'cancelled', "The server stopped")
+            self.lock.notify_all()
+
+# ----- HTTP -----
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass  # The jobs print their own lines
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, str(value))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_json(self, status, message, headers=None, close=False):
+            if close:
+                # The request body was not read, so the connection cannot carry another request
+                self.close_connection = True
+                headers = dict(headers or {}, Connection='close')
+            self.send_json(status, {'error': message}, headers)
+
+        def start_chunked(self, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+        def write_chunk(self, text):
+            data = text.encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        def end_chunked(self):
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        # ----- Routing -----
+
+        def route(self):
+            """(job, action) for /jobs/<id>[/<action>], with None for a missing job."""
+            parts = urlparse(self.path).path.strip('/').split('/')
+            if len(parts) < 2 or parts[0] != 'jobs':
+                return None, None
+            return service.get(parts[1]), (parts[2] if len(parts) > 2 else '')
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/health':
+                health = service.health()
+                self.send_json(200 if health['models_loaded'] and not health['stopping'] else 503, health)
+                return
+            job, action = self.route()
+            if job is None:
+                self.send_error_json(404, f"Unknown path or job {url.path}")
+            elif action == '':
+                self.send_json(200, job.summary(service.position(job)))
+            elif action == 'events':
+                # A reconnecting EventSource sends the id of the last segment it received
+                query = parse_qs(url.query)
+                last_id = self.headers.get('Last-Event-ID') or query.get('from', [None])[0]
+                try:
+                    position = max(0, int(last_id) + 1) if last_id is not None else 0
+                except ValueError:
+                    self.send_error_json(400, f"Last-Event-ID and ?from= must be segment indexes, not {last_id!r}")
+                    return
+                self.stream_events(job, position)
+            elif action == 'srt':
+                self.stream_srt(job)
+            else:
+                self.send_error_json(404, f"Unknown path {url.path}")
+
+        def do_DELETE(self):
+            job, action = self.route()
+            if job is None or action:
+                self.send_error_json(404, f"Unknown path or job {self.path}")
+                return
+            service.cancel(job)
+            self.send_json(200, job.summary())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path.rstrip('/') != '/jobs':
+                self.send_error_json(404, f"Unknown path {url.path}", close=True)
+                return
+            try:
+                service.admit()
+            except Rejected as e:
+                headers = {'Retry-After': e.retry_after} if e.retry_after else None
+                self.send_error_json(e.status, str(e), headers, close=True)
+                return
+            try:
+                job = self.read_submission(parse_qs(url.query))
+            except Rejected as e:
+                service.release()
+                self.send_error_json(e.status, str(e), close=True)
+                return
+            except Exception:
+                service.release()
+                raise
+            position = service.enqueue(job)
+            if 'text/event-stream' in self.headers.get('Accept', ''):
+                self.stream_events(job, 0)
+            else:
+                self.send_json(202, dict(job.summary(position), events=f"/jobs/{job.id}/events", srt=f"/jobs/{job.id}/srt"),
+                               headers={'Location': f"/jobs/{job.id}"})
+
+        def read_submission(self, query):
+            """Builds the job of a POST: a JSON body with a local path, or an upload. Raises Rejected on a bad request."""
+            def flag(name, default=False):
+                values = query.get(name)
+                return values[0].lower() in ('1', 'true', 'yes') if values else default
+
+            length = self.headers.get('Content-Length')
+            if length is None:
+                raise Rejected(411, "Content-Length is required (chunked uploads are not supported)")
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise Rejected(400, f"Content-Length must be a number of bytes, not {self.headers.get('Content-Length')!r}")
+
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                    path = Path(request['path']).resolve()
+                    path.is_file()  # Raises ValueError on a path with a NUL byte
+                except (ValueError, TypeError, KeyError) as e:
+                    raise Rejected(400, f"The body must be a JSON object with the 'path' of a local file ({type(e).__name__}: {e})")
+                if not any(path.is_relative_to(Path(directory).resolve()) for directory in allowed_dirs):
+                    raise Rejected(403, f"{path} is outside the directories this server reads")
+                if not path.is_file():
+                    raise Rejected(404, f"{path} does not exist")
+                if not path.name.lower().endswith(media_extensions):
+                    raise Rejected(415, f"{path.name} is not a supported media file")
+                return Job(path, path.name, use_vad=request.get('vad', flag('vad')),
+                           word_timestamps=request.get('word_timestamps', flag('word_timestamps')),
+                           save=request.get('save', flag('save')))
+
+            name = os.path.basename(query.get('name', ['upload.mp3'])[0])
+            if not name.lower().endswith(media_extensions):
+                raise Rejected(415, f"{name} is not a supported media file (give the file name with ?name=)")
+            if length > max_upload_bytes:
+                raise Rejected(413, f"Uploads are limited to {max_upload_bytes} bytes")
+            job = Job(None, name, use_vad=flag('vad'), word_timestamps=flag('word_timestamps'),
+                      save=flag('save'), upload=True)
+            job.path = upload_dir / f"{job.id}{os.path.splitext(name)[1].lower()}"
+            # Spooled to disk in chunks, so an upload never sits in memory as a whole
+            with metrics.span('server.upload', bytes=length):
+                remaining = length
+                with open(job.path, 'wb') as f:
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(read_chunk_bytes, remaining))
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        remaining -= len(chunk)
+            if remaining > 0:
+                os.remove(job.path)
+                raise Rejected(400, "The upload ended early")
+            return job
+
+        # ----- Streaming -----
+
+        def follow(self, job, position):
+            """Yields the segments of a job from position on as (index, segment), and None when nothing happened
+            for keepalive_seconds. Ends when the job is finished and every segment has been yielded."""
+            version = job.version
+            while True:
+                segments, version, finished = job.wait_for_change(position, version, keepalive_seconds)
+                for segment in segments:
+                    yield position, segment
+                    position += 1
+                if finished:
+                    return
+                if not segments:
+                    yield None
+
+        def stream_events(self, job, position):
+            self.start_chunked('text/event-stream')
+            try:
+                self.write_chunk(f"event: job\ndata: {json.dumps(job.summary(service.position(job)))}\n\n")
+                decoded_seconds = job.decoded_seconds
+                for item in self.follow(job, position):
+                    if item is None:
+                        self.write_chunk(": keepalive\n\n")
+                        continue
+                    index, segment = item
+                    payload = {'index': index, 'start': round(segment['start'], 3), 'end': round(segment['end'], 3),
+                               'text': segment['text'].strip(), 'srt': srt_block(index, segment)}
+                    self.write_chunk(f"id: {index}\nevent: segment\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n")
+                    if job.decoded_seconds != decoded_seconds:
+                        decoded_seconds = job.decoded_seconds
+                        self.write_chunk(f"event: progress\ndata: {json.dumps(job.summary())}\n\n")
+                self.write_chunk(f"event: {'done' if job.status == 'done' else 'error'}\n"
+                                 f"data: {json.dumps(job.summary(), ensure_ascii=False)}\n\n")
+                self.end_chunked()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away; the job goes on and can be followed again
+                self.close_connection = True
+
+        def stream_srt(self, job):
+            self.start_chunked('application/x-subrip; charset=utf-8')
+            try:
+                for item in self.follow(job, 0):
+                    if item is not None:
+                        self.write_chunk(srt_block(*item))
+                self.end_chunked()
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    return Handler
+
+# Main function to run the service
+def main():
+    global window_seconds, max_upload_bytes
+    parser = argparse.ArgumentParser(description="Serve transcription over HTTP, streaming the subtitles while decoding.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--model", default=transcription.model_name, help="Whisper model to keep loaded, or 'stub' for trying the service")
+    parser.add_argument("--pool", type=int, default=1, help="Models kept loaded, each decoding one job at a time")
+    parser.add_argument("--max_queue", type=int, default=8, help="Jobs that may wait for a model; more are answered with 429")
+    parser.add_argument("--window", type=float, default=window_seconds, help="Longest stretch of audio decoded at once, in seconds")
+    parser.add_argument("--max_upload_mb", type=int, default=max_upload_bytes // 1024 ** 2)
+    parser.add_argument("--allow_dir", action="append", default=[], help="Another directory clients may name local files in")
+    parser.add_argument("--backend", choices=cpu_backend.backends, default=cpu_backend.default_backend,
+                        help="int8: quantize the linear layers for CPU nodes (see benchmark_backends.py)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch (default: all cores)")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('transcribe_server', args)
+
+    window_seconds = args.window
+    max_upload_bytes = args.max_upload_mb * 1024 ** 2
+    allowed_dirs.extend(args.allow_dir)
+
+    service = TranscriptionService(args.model, max(1, args.pool), max(1, args.max_queue), args.backend, args.threads)
+    service.start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    print(f"Transcription service on http://{args.host}:{args.port} ({args.pool} x '{args.model}', "
+          f"up to {args.max_queue} waiting jobs; Ctrl+C to stop)")
+
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\nStopping: running jobs are finished, queued jobs are cancelled")
+        service.stop()
+        for worker in service.workers:
+            worker.join()
+        server.server_close()
+        metrics.flush()
+
+if __name__ == "__main__":
+    main()
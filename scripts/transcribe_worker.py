@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# Long-lived transcription worker: loads the Whisper model once and takes jobs from a queue directory.
+#
+#   python3 transcribe_worker.py            # start the worker, keep it running
+#   python3 02_transcribe.py                # becomes a thin client while a worker is alive
+#
+# Queue layout (all under data/worker):
+#   pending/<id>.json   jobs waiting for the worker
+#   running/<id>.json   the job being transcribed (claimed by an atomic rename)
+#   done/<id>.json      results, picked up and removed by the client
+#   worker.<pid>.json   one heartbeat per worker with its model and load time, written from the start of the model load
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+
+import cpu_backend
+import metrics
+import transcription
+
+# Paths to directories
+queue_dir = transcription.base_dir / 'data' / 'worker'
+pending_dir = queue_dir / 'pending'
+running_dir = queue_dir / 'running'
+done_dir = queue_dir / 'done'
+
+# How often the worker looks for new jobs, and how old a heartbeat may be before clients ignore the worker
+poll_interval = 0.5  # seconds
+heartbeat_timeout = 10  # seconds
+
+# Function to create the queue directories; done by the worker and by a client that submits, not on import
+def ensure_queue_dirs():
+    for directory in (pending_dir, running_dir, done_dir):
+        os.makedirs(directory, exist_ok=True)
+
+# Function to write a JSON file atomically, so readers never see half of it
+def write_json_atomic(path, data):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# ----- Client side -----
+
+def heartbeat_path(pid):
+    return queue_dir / f"worker.{pid}.json"
+
+def read_heartbeats():
+    """Returns (path, heartbeat, fresh) for the heartbeat file of every worker, oldest pid first."""
+    heartbeats = []
+    for path in sorted(queue_dir.glob('worker.*.json')):
+        try:
+            heartbeat = read_json(path)
+        except (OSError, ValueError):
+            continue  # Removed by its worker in the meantime
+        heartbeats.append((path, heartbeat, time.time() - heartbeat.get('updated_at', 0) < heartbeat_timeout))
+    return heartbeats
+
+def live_heartbeat():
+    """The heartbeat of a running worker, preferring one that has its model loaded, or None."""
+    fresh = [heartbeat for _, heartbeat, is_fresh in read_heartbeats() if is_fresh]
+    return next((heartbeat for heartbeat in fresh if not heartbeat.get('loading')), fresh[0] if fresh else None)
+
+def worker_is_alive():
+    """Returns True if any worker has refreshed its heartbeat recently."""
+    return live_heartbeat() is not None
+
+def worker_model_name():
+    """Returns the name of the model the running worker has loaded."""
+    return (live_heartbeat() or {}).get('model', transcription.model_name)
+
+def worker_backend():
+    """Returns the backend of the model the running worker has loaded."""
+    return (live_heartbeat() or {}).get('backend', cpu_backend.default_backend)
+
+def worker_is_loading():
+    """Returns True while the running worker is still loading its model (jobs wait in the queue until it is done)."""
+    return (live_heartbeat() or {}).get('loading', False)
+
+def submit_job(audio_path, use_vad=False, shards=1, output_names=None, word_timestamps=False, repair=False):
+    """Puts a transcription job into the queue and returns its id."""
+    ensure_queue_dirs()
+    # Ids sort by submission time, so the worker handles jobs in order
+    job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    write_json_atomic(pending_dir / f"{job_id}.json", {
+        'id': job_id,
+        'path': str(audio_path),
+        'vad': use_vad,
+        'shards': shards,
+        'word_timestamps': word_timestamps,
+        'repair': repair,
+        'output_names': output_names,
+        'submitted_at': time.time(),
+    })
+    return job_id
+
+def wait_for_job(job_id, timeout=None):
+    """Blocks until the worker has finished a job and returns its result."""
+    result_path = done_dir / f"{job_id}.json"
+    start = time.time()
+    while not result_path.exists():
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout} seconds")
+        if not worker_is_alive():
+            # A killed worker leaves its job in running/; the next worker puts it back into the queue
+            state = 'while transcribing' if (running_dir / f"{job_id}.json").exists() else 'before taking'
+            raise RuntimeError(f"Transcription worker stopped {state} job {job_id}")
+        time.sleep(poll_interval)
+    result = read_json(result_path)
+    os.remove(result_path)
+    return result
+
+# ----- Worker side -----
+
+class Worker:
+    def __init__(self, name, backend=cpu_backend.default_backend, threads=None):
+        self.name = name
+        self.backend = backend
+        self.threads = threads
+        self.model = None
+        self.model_load_seconds = 0.0
+        self.jobs_done = 0
+        self.loading = False
+        self.stopping = False
+        self.heartbeat_file = heartbeat_path(os.getpid())
+
+    def write_heartbeat(self):
+        write_json_atomic(self.heartbeat_file, {
+            'pid': os.getpid(),
+            'model': self.name,
+            'backend': self.backend,
+            'loading': self.loading,
+            'model_load_seconds': self.model_load_seconds,
+            'jobs_done': self.jobs_done,
+            'updated_at': time.time(),
+        })
+
+    def claim_next_job(self):
+        """Moves the oldest pending job to running/. The rename is atomic, so two workers never take the same job."""
+        for job_file in sorted(os.listdir(pending_dir)):
+            if not job_file.endswith('.json'):
+                continue
+            running_path = running_dir / job_file
+            try:
+                os.rename(pending_dir / job_file, running_path)
+            except FileNotFoundError:
+                continue  # Taken by another worker
+            return running_path
+        return None
+
+    def run_job(self, running_path):
+        job = read_json(running_path)
+        started_at = time.time()
+        queued_seconds = started_at - job['submitted_at']
+        print(f"\nJob {job['id']}: transcribing {job['path']} (waited {queued_seconds:.2f} s in queue)")
+        metrics.observe('worker_queue_seconds', queued_seconds)
+
+        result = {'id': job['id'], 'path': job['path'], 'queued_seconds': queued_seconds,
+                  'model_load_seconds': self.model_load_seconds}
+        try:
+            outputs, stats = transcription.transcribe_file(self.model, job['path'], use_vad=job.get('vad', False),
+                                                           shards=job.get('shards', 1),
+                                                           output_names=job.get('output_names'),
+                                                           word_timestamps=job.get('word_timestamps', False),
+                                                           repair=job.get('repair', False))
+            result.update(status='ok', outputs=outputs, **stats)
+        except Exception as e:
+            # One broken file must not take the worker down
+            print(f"Job {job['id']} failed: {e}")
+            result.update(status='error', error=str(e))
+
+        result['latency_seconds'] = time.time() - job['submitted_at']
+        metrics.observe('worker_job_latency_seconds', result['latency_seconds'])
+        metrics.increment('worker_jobs', status=result['status'])
+        metrics.flush()
+        write_json_atomic(done_dir / f"{job['id']}.json", result)
+        os.remove(running_path)
+        self.jobs_done += 1
+        print(f"Job {job['id']} finished in {time.time() - started_at:.2f} s "
+              f"(latency since submission {result['latency_seconds']:.2f} s)")
+
+    def heartbeat_loop(self):
+        # Runs in a background thread, so the heartbeat stays fresh during long transcriptions
+        while not self.stopping:
+            self.write_heartbeat()
+            time.sleep(poll_interval)
+
+    def requeue_orphans(self):
+        """Puts jobs left in running/ by a killed worker back into the queue."""
+        for job_file in os.listdir(running_dir):
+            if job_file.endswith('.json'):
+                os.rename(running_dir / job_file, pending_dir / job_file)
+                print(f"Re-queued unfinished job {job_file}")
+
+    def stop(self, *_):
+        print("\nStopping after the current job...")
+        self.stopping = True
+
+    def serve(self):
+        ensure_queue_dirs()
+        # Jobs in running/ belong to a live worker, unless none is left to finish them
+        if not worker_is_alive():
+            self.requeue_orphans()
+        # Heartbeats of killed workers
+        for path, _, fresh in read_heartbeats():
+            if not fresh:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # Removed by another worker starting at the same time
+
+        # The heartbeat starts before the model load, so clients queue their jobs instead of loading a model of their own
+        self.loading = True
+        heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+        heartbeat_thread.start()
+        try:
+            print(f"Loading Whisper model '{self.name}' ({self.backend})...")
+            self.model, self.model_load_seconds = transcription.load_model(self.name, self.backend, self.threads)
+            self.loading = False
+            print(f"Model loaded in {self.model_load_seconds:.2f} s, waiting for jobs in {pending_dir}")
+
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+            while not self.stopping:
+                running_path = self.claim_next_job()
+                if running_path is None:
+                    time.sleep(poll_interval)
+                    continue
+                self.run_job(running_path)
+        finally:
+            self.stopping = True
+            heartbeat_thread.join()
+            # Only our own heartbeat: other workers may still be running
+            if self.heartbeat_file.exists():
+                os.remove(self.heartbeat_file)
+        print(f"Worker stopped after {self.jobs_done} job(s).")
+
+# Main function to run the worker
+def main():
+    parser = argparse.ArgumentParser(description="Keep a Whisper model loaded and transcribe jobs from the queue directory.")
+    parser.add_argument("--model", default=transcription.model_name, help="Whisper model to keep loaded")
+    parser.add_argument("--backend", choices=cpu_backend.backends, default=cpu_backend.default_backend,
+                        help="int8: quantize the linear layers for CPU nodes (see benchmark_backends.py)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch (default: all cores)")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args('transcribe_worker', args)
+
+    Worker(args.model, args.backend, args.threads).serve()
+
+if __name__ == "__main__":
+    main()
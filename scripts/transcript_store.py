@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Columnar transcript store: one directory per media file that every stage reads from and adds to.
+#
+# data/transcripts/<name>/ holds
+#   meta.json                   tables, their row counts and columns, and the files exported from them
+#   <table>.<generation>/       one file per column: raw little-endian values (numpy.tofile)
+#                               text and list columns: <column>.bin with the values of all rows back to back,
+#                               and <column>.ends with the int64 end offset of every row
+#
+# Tables written by the pipeline:
+#   segments  Whisper segments: start, end (s), avg_logprob, no_speech_prob, compression_ratio, temperature,
+#             tokens (list), text
+#   words     word times, if transcribed with --word_timestamps: start, end (s), probability, segment, text
+#   blocks    the subtitle blocks: start_ms, end_ms and one text column per stage
+#             (raw, verbalized, translated_<language>)
+#
+# meta.json is the commit point: it is replaced atomically after the column files are written, and only
+# the rows it counts are read, so a crash leaves the previous state readable. The SRT and TXT files are
+# exports of a table column. A stage that gets an SRT file which is still the store's export (same size and
+# mtime) reads the column instead of parsing the text; a file edited by hand is parsed as before.
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pysrt
+
+import srt_engine
+from stage_cache import relative_key
+
+# Paths to directories
+base_dir = Path(__file__).resolve().parent.parent
+store_dir = base_dir / 'data' / 'transcripts'
+
+STORE_VERSION = 1
+variable_kinds = ('text', 'list')
+
+def store_name(path):
+    """Name of the store of an output file: the file name without extension."""
+    return os.path.splitext(os.path.basename(str(path)))[0]
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def write_json_atomic(path, data):
+    temporary_path = f"{path}.part"
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(temporary_path, path)
+
+# Function to describe a column from its values: (kind, dtype, flat values, row ends or None)
+def encode_column(values):
+    if isinstance(values, np.ndarray):
+        return 'array', values.dtype.str, values, None
+    values = list(values)
+    if values and isinstance(values[0], str) or not values:
+        encoded = [value.encode('utf-8') for value in values]
+        flat = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return 'text', '|u1', flat, np.cumsum([len(data) for data in encoded], dtype=np.int64)
+    if isinstance(values[0], (list, tuple, np.ndarray)):
+        flat = np.concatenate([np.asarray(value, dtype=np.int32) for value in values]) if values else np.zeros(0, np.int32)
+        return 'list', '<i4', flat, np.cumsum([len(value) for value in values], dtype=np.int64)
+    array = np.asarray(values)
+    return 'array', array.dtype.str, array, None
+
+class TranscriptStore:
+    def __init__(self, path, meta):
+        self.path = Path(path)
+        self.meta = meta
+
+    @classmethod
+    def create(cls, name, media=None):
+        """Starts an empty store, replacing an older one of the same name."""
+        path = store_dir / name
+        if path.exists():
+            shutil.rmtree(path)
+        os.makedirs(path)
+        store = cls(path, {'version': STORE_VERSION, 'media': str(media) if media else None, 'tables': {}, 'exports': {}})
+        store.save_meta()
+        return store
+
+    @classmethod
+    def open(cls, name):
+        """Opens an existing store, or returns None."""
+        try:
+            with open(store_dir / name / 'meta.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != STORE_VERSION:
+            return None
+        return cls(store_dir / name, meta)
+
+    def save_meta(self):
+        write_json_atomic(self.path / 'meta.json', self.meta)
+
+    def has_table(self, table):
+        return table in self.meta['tables']
+
+    def rows(self, table):
+        return self.meta['tables'][table]['rows']
+
+    def column_names(self, table):
+        return list(self.meta['tables'][table]['columns'])
+
+    def table_dir(self, table):
+        return self.path / self.meta['tables'][table]['dir']
+
+    # Function to write the values of one column to files in a table directory
+    def _write_column(self, directory, column, values, mode='wb', offset=0):
+        kind, dtype, flat, ends = encode_column(values)
+        with open(directory / f"{column}.bin", mode) as f:
+            np.ascontiguousarray(flat).tofile(f)
+        if ends is not None:
+            with open(directory / f"{column}.ends", mode) as f:
+                (ends + offset).tofile(f)
+        return {'kind': kind, 'dtype': dtype}
+
+    def write_table(self, table, columns):
+        """Replaces a table by new columns of equal length. The old table stays readable until meta.json is replaced."""
+        old = self.meta['tables'].get(table)
+        generation = old['generation'] + 1 if old else 0
+        directory_name = f"{table}.{generation}"
+        directory = self.path / directory_name
+        if directory.exists():
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+
+        rows = None
+        schema = {}
+        for column, values in columns.items():
+            count = len(values)
+            if rows is not None and count != rows:
+                raise ValueError(f"column {column} of {table} has {count} rows, expected {rows}")
+            rows = count
+            schema[column] = self._write_column(directory, column, values)
+
+        self.meta['tables'][table] = {'dir': directory_name, 'generation': generation, 'rows': rows or 0, 'columns': schema}
+        self.save_meta()
+        if old:
+            shutil.rmtree(self.path / old['dir'], ignore_errors=True)
+
+    def _truncate(self, table):
+        """Cuts the column files of a table back to the rows meta.json counts (left over by a crashed append)."""
+        info = self.meta['tables'][table]
+        directory = self.table_dir(table)
+        for column, schema in info['columns'].items():
+            itemsize = np.dtype(schema['dtype']).itemsize
+            if schema['kind'] in variable_kinds:
+                ends = np.fromfile(directory / f"{column}.ends", dtype=np.int64, count=info['rows'])
+                os.truncate(directory / f"{column}.ends", info['rows'] * 8)
+                os.truncate(directory / f"{column}.bin", (int(ends[-1]) if len(ends) else 0) * itemsize)
+            else:
+                os.truncate(directory / f"{column}.bin", info['rows'] * itemsize)
+
+    def append(self, table, columns):
+        """Appends rows to a table (creating it on first use). Every column of the table must be given."""
+        if not self.has_table(table):
+            self.write_table(table, columns)
+            return
+        info = self.meta['tables'][table]
+        if set(columns) != set(info['columns']):
+            raise ValueError(f"append to {table} needs the columns {sorted(info['columns'])}")
+        self._truncate(table)
+        directory = self.table_dir(table)
+        counts = {len(values) for values in columns.values()}
+        if len(counts) != 1:
+            raise ValueError(f"the columns appended to {table} differ in length")
+        for column, values in columns.items():
+            offset = 0
+            if info['columns'][column]['kind'] == 'array':
+                values = np.asarray(values, dtype=info['columns'][column]['dtype'])
+            if info['columns'][column]['kind'] in variable_kinds and info['rows']:
+                offset = int(np.fromfile(directory / f"{column}.ends", dtype=np.int64, offset=(info['rows'] - 1) * 8, count=1)[0])
+            self._write_column(directory, column, values, mode='ab', offset=offset)
+        info['rows'] += counts.pop()
+        self.save_meta()
+
+    def set_column(self, table, column, values):
+        """Adds or replaces one column of an existing table, e.g. the verbalized text of the blocks."""
+        info = self.meta['tables'][table]
+        if len(values) != info['rows']:
+            raise ValueError(f"column {column} has {len(values)} rows, {table} has {info['rows']}")
+        directory = self.table_dir(table)
+        # Written under temporary names and moved into place, so the old column stays readable until then
+        temporary = directory / '.part'
+        os.makedirs(temporary, exist_ok=True)
+        schema = self._write_column(temporary, column, values)
+        for suffix in ('.bin', '.ends'):
+            if (temporary / f"{column}{suffix}").exists():
+                os.replace(temporary / f"{column}{suffix}", directory / f"{column}{suffix}")
+        os.rmdir(temporary)
+        info['columns'][column] = schema
+        self.save_meta()
+
+    def read(self, table, column):
+        """Reads one column: a NumPy array, or a list of strings or token lists."""
+        info = self.meta['tables'][table]
+        schema = info['columns'][column]
+        directory = self.table_dir(table)
+        rows = info['rows']
+        if schema['kind'] not in variable_kinds:
+            return np.fromfile(directory / f"{column}.bin", dtype=schema['dtype'], count=rows)
+        ends = np.fromfile(directory / f"{column}.ends", dtype=np.int64, count=rows)
+        starts = np.concatenate(([0], ends[:-1])) if rows else ends
+        values = np.fromfile(directory / f"{column}.bin", dtype=schema['dtype'], count=int(ends[-1]) if rows else 0)
+        if schema['kind'] == 'text':
+            blob = values.tobytes()
+            return [blob[start:end].decode('utf-8') for start, end in zip(starts.tolist(), ends.tolist())]
+        return [values[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+    # Exports
+
+    def record_export(self, path, table, column):
+        self.meta['exports'][relative_key(path)] = dict(file_signature(path), table=table, column=column)
+        self.save_meta()
+
+    def export_srt(self, path, column, table='blocks'):
+        """Writes a text column of the blocks as an SRT file."""
+        starts = self.read(table, 'start_ms').tolist()
+        ends = self.read(table, 'end_ms').tolist()
+        srt_engine.write_srt(path, zip(starts, ends, self.read(table, column)))
+        self.record_export(path, table, column)
+
+    def export_txt(self, path, column='text', table='segments'):
+        """Writes a text column as plain text, as Whisper joins its segments."""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(''.join(self.read(table, column)))
+        self.record_export(path, table, column)
+
+    def export_json(self, path, table):
+        """Writes a table as a list of rows, e.g. to inspect the segment metadata."""
+        columns = {column: self.read(table, column) for column in self.column_names(table)}
+        rows = [{column: (values[i].tolist() if hasattr(values[i], 'tolist') else values[i]) for column, values in columns.items()}
+                for i in range(self.rows(table))]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=1)
+
+    def exported_column(self, path):
+        """The blocks column an SRT file was exported from, or None if the file was changed since."""
+        entry = self.meta['exports'].get(relative_key(path))
+        if not entry or entry['table'] != 'blocks' or not os.path.exists(path):
+            return None
+        if file_signature(path) != {'size': entry['size'], 'mtime_ns': entry['mtime_ns']}:
+            return None
+        if entry['column'] not in self.meta['tables'].get('blocks', {}).get('columns', {}):
+            return None
+        return entry['column']
+
+    # Views for the stages
+
+    def srt_table(self, column):
+        """The blocks as an srt_engine.SrtTable, as read_srt would return it for the exported file."""
+        texts = self.read('blocks', column)
+        words = []
+        word_counts = []
+        for text in texts:
+            block_words = text.split()
+            word_counts.append(len(block_words))
+            words.extend(block_words)
+        return srt_engine.SrtTable(self.read('blocks', 'start_ms'), self.read('blocks', 'end_ms'),
+                                   np.array(word_counts, dtype=np.int64), words)
+
+    def subrip(self, column):
+        """The blocks as a pysrt.SubRipFile, for the stages that edit the text of every block."""
+        starts = self.read('blocks', 'start_ms').tolist()
+        ends = self.read('blocks', 'end_ms').tolist()
+        items = [pysrt.SubRipItem(index + 1, start=pysrt.SubRipTime.from_ordinal(start),
+                                  end=pysrt.SubRipTime.from_ordinal(end), text=text)
+                 for index, (start, end, text) in enumerate(zip(starts, ends, self.read('blocks', column)))]
+        return pysrt.SubRipFile(items=items)
+
+def open_for_srt(srt_path):
+    """(store, column) if the SRT file is still the export of a blocks column of its store, else (None, None)."""
+    store = TranscriptStore.open(store_name(srt_path))
+    column = store.exported_column(srt_path) if store else None
+    return (store, column) if column else (None, None)
+
+# Main function to export a column on demand
+def main():
+    parser = argparse.ArgumentParser(description="Show a transcript store or export one of its columns as SRT, TXT or JSON.")
+    parser.add_argument("name", help="Store name (the SRT file name without extension)")
+    parser.add_argument("--column", help="Text column to export, e.g. raw, verbalized, translated_uk")
+    parser.add_argument("--table", default=None, help="Table to export (default: blocks for SRT, segments for TXT and JSON)")
+    parser.add_argument("--output", help="Output file; the format follows its extension (.srt, .txt, .json)")
+    args = parser.parse_args()
+
+    store = TranscriptStore.open(args.name)
+    if store is None:
+        parser.error(f"no transcript store named {args.name} in {store_dir}")
+
+    if not args.output:
+        for table, info in store.meta['tables'].items():
+            print(f"{table}: {info['rows']} rows, columns {', '.join(info['columns'])}")
+        for path, entry in store.meta['exports'].items():
+            print(f"export {path} <- {entry['table']}.{entry['column']}")
+        return
+
+    extension = os.path.splitext(args.output)[1].lower()
+    if extension == '.srt':
+        store.export_srt(args.output, args.column or 'raw', table=args.table or 'blocks')
+    elif extension == '.txt':
+        store.export_txt(args.output, args.column or 'text', table=args.table or 'segments')
+    elif extension == '.json':
+        store.export_json(args.output, args.table or 'segments')
+    else:
+        parser.error("the output must end with .srt, .txt or .json")
+    print(f"Exported {args.output}")
+
+if __name__ == "__main__":
+    main()
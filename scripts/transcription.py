@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Transcription helpers shared by 02_transcribe.py and transcribe_worker.py
+import multiprocessing
+import os
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+
+import cpu_backend
+import metrics
+import pcm_audio
+import transcript_store
+import vad
+
+# Paths to directories
+base_dir = Path(__file__).resolve().parent.parent
+audio_dir = base_dir / 'data' / 'input'
+srt_dir = base_dir / 'data' / 'output'
+txt_dir = base_dir / 'data' / 'output'
+
+# Whisper model
+# You can choose "tiny", "base", "small", "medium", "large" based on your needs for version 2
+# For version 3 use large-v3
+model_name = "large"
+
+#context = (
+#    "Мы будем траскрибировать лекции по математике (алгебра и геометрия старших классов)."
+#)
+
+# List all audio files (handling multiple extensions)
+supported_extensions = ('.wav', '.mp3', '.m4a', '.flac', '.ogg', '.aac', f".{pcm_audio.PCM_EXTENSION}")  # Add other supported formats as needed
+# Video files that the direct mode decodes without an intermediate audio file
+video_extensions = ('.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm')
+# Target languages of 05_translate.py. Its translations, <name>_<language>.srt, live next to their sources,
+# and 03, 04 and 05 must not take them for sources
+translation_languages = ('uk', 'en', 'de', 'fr', 'es', 'it', 'pl', 'pt', 'be', 'kk')
+translated_suffixes = tuple(f"_{language}.srt" for language in translation_languages)
+
+def list_media_files(directory, extensions):
+    """Returns the files in a directory that end with one of the given extensions, sorted by name."""
+    return sorted(f for f in os.listdir(directory) if f.lower().endswith(extensions))
+
+# Function to load the Whisper model. Returns the model and the seconds it took.
+# whisper (and with it torch) is imported in cpu_backend.py so that thin clients never pay for it.
+def load_model(name=model_name, backend=cpu_backend.default_backend, threads=None):
+    return cpu_backend.load_model(name, backend=backend, threads=threads)
+
+# Function to generate a unique filename
+def get_unique_filename(base_name, extension, directory):
+    counter = 1
+    unique_name = f"{base_name}.{extension}"
+    while os.path.exists(os.path.join(directory, unique_name)):
+        unique_name = f"{base_name}_v{counter}.{extension}"
+        counter += 1
+    return unique_name
+
+# Function to put a Whisper result into a new transcript store: the segments with their metadata, the word
+# times if there are any, and the subtitle blocks with the adjusted start time of the first segment
+def build_store(result, name, media, initial_shift=6):
+    segments = result['segments']
+    store = transcript_store.TranscriptStore.create(name, media)
+
+    def segment_values(key, default=np.nan):
+        return np.array([segment.get(key, default) for segment in segments], dtype=np.float32)
+
+    starts = np.array([segment['start'] for segment in segments], dtype=np.float64)
+    ends = np.array([segment['end'] for segment in segments], dtype=np.float64)
+    store.write_table('segments', {
+        'start': starts,
+        'end': ends,
+        'avg_logprob': segment_values('avg_logprob'),
+        'no_speech_prob': segment_values('no_speech_prob'),
+        'compression_ratio': segment_values('compression_ratio'),
+        'temperature': segment_values('temperature'),
+        'tokens': [segment.get('tokens', []) for segment in segments],
+        'text': [segment['text'] for segment in segments],
+    })
+
+    words = [(index, word) for index, segment in enumerate(segments) for word in segment.get('words') or []]
+    if words:
+        store.write_table('words', {
+            'start': np.array([word['start'] for _, word in words], dtype=np.float64),
+            'end': np.array([word['end'] for _, word in words], dtype=np.float64),
+            'probability': np.array([word.get('probability', 1.0) for _, word in words], dtype=np.float32),
+            'segment': np.array([index for index, _ in words], dtype=np.int32),
+            'text': [word['word'] for _, word in words],
+        })
+
+    # Shift only the start time of the first segment
+    block_starts = starts.copy()
+    if len(block_starts):
+        block_starts[0] += initial_shift
+    store.write_table('blocks', {
+        'start_ms': np.rint(block_starts * 1000).astype(np.int64),
+        'end_ms': np.rint(ends * 1000).astype(np.int64),
+        'raw': [segment['text'].strip() for segment in segments],
+    })
+    return store
+
+# Decoding settings, with explicit Russian language setting
+decode_options = dict(
+    language="ru",
+#    initial_prompt=context,
+    task="transcribe",
+    beam_size=5,
+    best_of=5,
+    temperature=0.1,
+    fp16=True,
+    condition_on_previous_text=False,
+)
+
+# Function to run Whisper on a decoded audio array. word_timestamps adds the time of every word to the segments.
+# options replaces decode_options, e.g. for the greedy first pass of the cascade.
+def transcribe_audio(model, audio, verbose=True, word_timestamps=False, options=None):
+    return model.transcribe(audio, verbose=verbose, word_timestamps=word_timestamps,
+                            **cpu_backend.decode_options_for(model, options or decode_options))
+
+# Function to describe everything that changes the transcript, for the incremental mode
+def stage_params(name=model_name, use_vad=False, word_timestamps=False, backend=cpu_backend.default_backend,
+                 cascade_params=None, repair_params=None):
+    return {'model': name, 'options': decode_options, 'vad': use_vad, 'word_timestamps': word_timestamps,
+            'backend': backend, 'cascade': cascade_params, 'repair': repair_params}
+
+# ----- Sharded transcription -----
+# Long files are cut at pauses and the shards are decoded by a pool of forked processes.
+# The model is loaded once in the parent; after fork the children read its weights from shared pages.
+_shard_model = None
+_shard_audio = None
+_shard_word_timestamps = False
+boundary_segments = 3  # Segments at the end of a shard compared with the start of the next
+
+def _init_shard_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+def _transcribe_shard(bounds):
+    start, end = bounds
+    return transcribe_audio(_shard_model, _shard_audio[start:end], verbose=False, word_timestamps=_shard_word_timestamps)
+
+def _normalized_text(text):
+    return re.sub(r'\W+', ' ', text).strip().lower()
+
+def _is_boundary_duplicate(tail, segment):
+    # The same words decoded at the end of one shard (its last segments, tail) and the start of the next
+    if segment['end'] <= tail[-1]['end']:
+        return True
+    return any(segment['start'] < previous['end'] + 1.0 and _normalized_text(segment['text']) == _normalized_text(previous['text'])
+               for previous in tail)
+
+def shift_segment(segment, offset):
+    """A copy of a segment with its times, and the times of its words, moved by offset seconds."""
+    segment = dict(segment)
+    segment['start'] += offset
+    segment['end'] += offset
+    if segment.get('words'):
+        segment['words'] = [dict(word, start=word['start'] + offset, end=word['end'] + offset) for word in segment['words']]
+    return segment
+
+def merge_shard_results(shard_results, shard_offsets):
+    """Joins the results of the shards into one result, shifting times by the shard offsets and dropping boundary duplicates."""
+    segments = []
+    for result, offset in zip(shard_results, shard_offsets):
+        # Only the first segments of a shard can repeat the previous one; segments inside a shard are kept as decoded
+        tail = segments[-boundary_segments:]
+        at_boundary = bool(tail)
+        for segment in result['segments']:
+            segment = shift_segment(segment, offset)
+            if at_boundary and _is_boundary_duplicate(tail, segment):
+                continue
+            at_boundary = False
+            segments.append(segment)
+
+    for index, segment in enumerate(segments):
+        segment['id'] = index
+    language = shard_results[0].get('language') if shard_results else None
+    return {'text': ''.join(segment['text'] for segment in segments), 'segments': segments, 'language': language}
+
+def transcribe_sharded(model, audio, n_shards, verbose=True, word_timestamps=False):
+    """Transcribes the audio in n_shards processes and merges the results. Falls back to one process where fork is unavailable."""
+    global _shard_model, _shard_audio, _shard_word_timestamps
+
+    shards = vad.plan_shards(audio, n_shards)
+    if len(shards) == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return transcribe_audio(model, audio, verbose=verbose, word_timestamps=word_timestamps)
+
+    lengths = ', '.join(f"{(end - start) / pcm_audio.SAMPLE_RATE / 60:.1f}" for start, end in shards)
+    print(f"Transcribing {len(shards)} shards in parallel (minutes: {lengths})")
+
+    _shard_model, _shard_audio, _shard_word_timestamps = model, audio, word_timestamps
+    threads = max(1, (os.cpu_count() or 1) // len(shards))
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes=len(shards), initializer=_init_shard_worker, initargs=(threads,)) as pool:
+            shard_results = pool.map(_transcribe_shard, shards)
+    finally:
+        _shard_model, _shard_audio = None, None
+
+    offsets = [start / pcm_audio.SAMPLE_RATE for start, _ in shards]
+    return merge_shard_results(shard_results, offsets)
+
+# Function to run the serial or the sharded decoder
+def run_decoder(model, audio, verbose=True, shards=1, word_timestamps=False):
+    if shards > 1:
+        return transcribe_sharded(model, audio, shards, verbose=verbose, word_timestamps=word_timestamps)
+    return transcribe_audio(model, audio, verbose=verbose, word_timestamps=word_timestamps)
+
+# Function to save the TXT and SRT outputs of one transcription. Returns the names of the written files.
+# output_names maps an extension to the name to overwrite, so incremental re-runs do not create _v1 copies.
+# With time codes both files are exports of the transcript store, which is named after the SRT file.
+def save_outputs(result, filename, initial_shift=6, output_names=None):
+    base_name = os.path.splitext(filename)[0]
+    output_names = output_names or {}
+    outputs = []
+
+    raw_text_filename = output_names.get('txt') or get_unique_filename(base_name, 'txt', txt_dir)
+    if 'segments' not in result:
+        # Without time codes there is nothing but the raw text
+        with open(os.path.join(txt_dir, raw_text_filename), 'w', encoding='utf-8') as raw_text_file:
+            raw_text_file.write(result['text'])
+        print(f"Saved raw text file: {raw_text_filename}")
+        return [raw_text_filename]
+
+    output_filename = output_names.get('srt') or get_unique_filename(base_name, 'srt', srt_dir)
+    store = build_store(result, transcript_store.store_name(output_filename), filename, initial_shift=initial_shift)
+    print(f"Saved transcript store: {store.path.name} ({store.rows('segments')} segments"
+          + (f", {store.rows('words')} words" if store.has_table('words') else "") + ")")
+
+    # Save the raw text output before any further processing
+    store.export_txt(os.path.join(txt_dir, raw_text_filename))
+    print(f"Saved raw text file: {raw_text_filename}")
+    outputs.append(raw_text_filename)
+
+    store.export_srt(os.path.join(srt_dir, output_filename), 'raw')
+    print(f"Saved SRT file: {output_filename}")
+    outputs.append(output_filename)
+
+    return outputs
+
+# Function to transcribe only the speech regions of the audio, with timestamps on the original timeline
+def transcribe_speech_regions(model, audio, verbose=True, shards=1, word_timestamps=False):
+    regions = vad.detect_speech(audio)
+    speech_audio, timeline = vad.compact_audio(audio, regions)
+    if len(speech_audio) == 0:
+        return {'text': '', 'segments': [], 'language': 'ru'}, timeline
+
+    result = run_decoder(model, speech_audio, verbose=verbose, shards=shards, word_timestamps=word_timestamps)
+    timeline.remap_result(result)
+    return result, timeline
+
+# Function to decode and transcribe one media file and write its outputs.
+# Returns the names of the written files and a dict of timings.
+def transcribe_file(model, audio_path, verbose=True, use_vad=False, shards=1, output_names=None, word_timestamps=False,
+                    repair=False):
+    with metrics.span('transcribe.file', file=os.path.basename(audio_path), vad=use_vad, shards=shards) as span:
+        outputs, stats = _transcribe_file(model, audio_path, verbose, use_vad, shards, output_names, word_timestamps, repair)
+        span.set(**stats)
+    metrics.observe('transcribe_audio_seconds', stats['audio_seconds'])
+    return outputs, stats
+
+def _transcribe_file(model, audio_path, verbose, use_vad, shards, output_names, word_timestamps, repair):
+    # Decode (or memory-map) the audio once, at the sample rate the model expects
+    decode_start = time.time()
+    with metrics.span('transcribe.load_audio'):
+        audio = pcm_audio.load_audio_array(audio_path)
+    decode_seconds = time.time() - decode_start
+    audio_seconds = pcm_audio.duration_seconds(audio)
+    print(f"Loaded {audio_seconds / 60:.1f} min of audio in {decode_seconds:.2f} s")
+
+    transcribe_start = time.time()
+    with metrics.span('transcribe.decode') as span:
+        if use_vad:
+            result, timeline = transcribe_speech_regions(model, audio, verbose=verbose, shards=shards, word_timestamps=word_timestamps)
+            speech_seconds = timeline.speech_seconds
+            # The silent intro is no longer decoded, so the first segment needs no manual shift
+            initial_shift = 0
+        else:
+            result = run_decoder(model, audio, verbose=verbose, shards=shards, word_timestamps=word_timestamps)
+            speech_seconds = audio_seconds
+            initial_shift = 6
+        span.set(speech_seconds=speech_seconds, segments=len(result.get('segments', [])))
+    transcribe_seconds = time.time() - transcribe_start
+
+    repair_stats = {}
+    if repair:
+        # Imported here: hallucination.py builds on this module
+        import hallucination
+        repair_start = time.time()
+        with metrics.span('transcribe.repair') as span:
+            result, repair_stats = hallucination.repair(model, audio, result, word_timestamps=word_timestamps)
+            span.set(**repair_stats)
+        repair_stats['repair_seconds'] = time.time() - repair_start
+
+    if use_vad and audio_seconds > 0:
+        print(f"VAD: decoded {speech_seconds / 60:.1f} of {audio_seconds / 60:.1f} min, "
+              f"skipped {1 - speech_seconds / audio_seconds:.1%} of the audio")
+
+    with metrics.span('transcribe.save_outputs'):
+        outputs = save_outputs(result, os.path.basename(audio_path), initial_shift=initial_shift, output_names=output_names)
+    stats = {
+        'audio_seconds': audio_seconds,
+        'speech_seconds': speech_seconds,
+        'decode_seconds': decode_seconds,
+        'transcribe_seconds': transcribe_seconds,
+        **repair_stats,
+    }
+    return outputs, stats
+
+# Function to pick the output names of a previous run of the same input
+def previous_output_names(cache, audio_path):
+    previous = cache.previous_outputs(audio_path) or []
+    return {path.suffix.lstrip('.'): path.name for path in previous}
+
+# Function to turn the names returned by save_outputs into full paths
+def output_paths(names):
+    return [(txt_dir if name.endswith('.txt') else srt_dir) / name for name in names]
+
+# Function to print the totals of a transcription run
+def print_run_report(stats_list, use_vad=False):
+    audio_seconds = sum(stats['audio_seconds'] for stats in stats_list)
+    speech_seconds = sum(stats['speech_seconds'] for stats in stats_list)
+    transcribe_seconds = sum(stats['transcribe_seconds'] for stats in stats_list)
+    if audio_seconds <= 0:
+        return
+    print(f"Transcribed {audio_seconds / 60:.1f} min of audio in {transcribe_seconds:.2f} s "
+          f"(real-time factor {transcribe_seconds / audio_seconds:.3f})")
+    if use_vad and speech_seconds > 0:
+        # Decoding time grows with the decoded duration, so this is the expected gain over the full-length path
+        print(f"VAD skipped {1 - speech_seconds / audio_seconds:.1%} of the audio, "
+              f"estimated speedup x{audio_seconds / speech_seconds:.2f} over decoding everything")
+    repaired = [stats for stats in stats_list if 'repair_seconds' in stats]
+    if repaired:
+        repaired_seconds = sum(stats['repaired_seconds'] for stats in repaired)
+        print(f"Repair: {sum(stats['flagged_segments'] for stats in repaired)} segments flagged, "
+              f"re-decoded {repaired_seconds:.1f} s of audio ({repaired_seconds / audio_seconds:.1%}) "
+              f"in {sum(stats['repair_seconds'] for stats in repaired):.2f} s")
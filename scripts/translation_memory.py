@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Persistent translation memory for the LLM stages (04_verbalize.py, 05_translate.py).
+#
+# Answers are stored in SQLite, keyed by the normalized source text and a namespace hash of
+# everything else that shapes the answer (task, model, prompt, language pair). Entries exist at
+# two granularities: whole batches (the exact request that was sent) and single blocks (each
+# part of a batch reply). Recurring intros, definitions and re-recorded sessions are then served
+# locally, and a re-run after a crash does not pay for the batches that already came back.
+# The database is kept under a size limit by evicting the least recently used entries.
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from stage_cache import params_hash
+
+# Paths
+base_dir = Path(__file__).resolve().parent.parent
+memory_path = base_dir / 'data' / 'translation_memory.sqlite'
+
+# Size limit of the stored texts; the oldest entries are evicted down to 90% of it
+max_bytes = 200 * 1024 * 1024
+
+def normalize(text):
+    """Whitespace differences do not change a translation."""
+    return re.sub(r'\s+', ' ', text).strip()
+
+class TranslationMemory:
+    def __init__(self, namespace_params, path=memory_path, size_limit=max_bytes):
+        self.namespace = params_hash(namespace_params)
+        self.size_limit = size_limit
+        self.lock = threading.Lock()
+        self.hits = {'batch': 0, 'block': 0}
+        self.misses = {'batch': 0, 'block': 0}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One connection shared by the threads of this process; WAL lets other processes read while we write
+        self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self.db.commit()
+
+    def key(self, kind, text):
+        return hashlib.sha256(f"{self.namespace}\x00{kind}\x00{normalize(text)}".encode('utf-8')).hexdigest()
+
+    def lookup(self, kind, text):
+        key = self.key(kind, text)
+        with self.lock:
+            row = self.db.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses[kind] += 1
+                return None
+            self.db.execute('UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            self.hits[kind] += 1
+            return row[0]
+
+    def store(self, kind, text, value):
+        size = len(text.encode('utf-8')) + len(value.encode('utf-8'))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries (key, kind, value, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                            (self.key(kind, text), kind, value, size, time.time()))
+            self.db.commit()
+
+    # ----- Block and batch granularity -----
+
+    def get_block(self, text):
+        return self.lookup('block', text)
+
+    def put_block(self, text, value):
+        self.store('block', text, value)
+
+    def get_batch(self, texts, separator):
+        """Returns the stored replies of a whole batch as a list, or None."""
+        value = self.lookup('batch', separator.join(texts))
+        if value is None:
+            return None
+        parts = value.split(separator)
+        return parts if len(parts) == len(texts) else None
+
+    def put_batch(self, texts, values, separator):
+        """Stores a batch reply and each of its blocks."""
+        self.store('batch', separator.join(texts), separator.join(values))
+        for text, value in zip(texts, values):
+            self.store('block', text, value)
+
+    def get_blocks(self, texts, separator):
+        """Returns a list with the stored reply of every block, or None where a block is unknown. A stored batch answers all of them at once."""
+        batch = self.get_batch(texts, separator)
+        if batch is not None:
+            return batch
+        return [self.get_block(text) for text in texts]
+
+    # ----- Housekeeping -----
+
+    def evict(self):
+        """Deletes the least recently used entries until the stored texts fit in 90% of the size limit."""
+        with self.lock:
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.size_limit:
+                return 0
+            target = total - int(self.size_limit * 0.9)
+            evicted = 0
+            freed = 0
+            for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+                if freed >= target:
+                    break
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                freed += size
+                evicted += 1
+            self.db.commit()
+        print(f"Translation memory: evicted {evicted} least recently used entries")
+        return evicted
+
+    def summary(self):
+        return (f"Translation memory so far: {self.hits['block']} block hits, {self.misses['block']} block misses, "
+                f"{self.hits['batch']} batch hits, {self.misses['batch']} batch misses")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Energy-based voice activity detection on 16 kHz float32 audio.
+# Silence and board-writing pauses are cut out before decoding and the timestamps are mapped back afterwards.
+from bisect import bisect_right
+
+import numpy as np
+
+from pcm_audio import SAMPLE_RATE
+
+# Frame size for the energy measurement
+FRAME_MS = 30
+
+# A frame counts as speech when it is this many dB above the noise floor
+# (estimated as a low percentile of all frame energies), and above an absolute floor
+SPEECH_MARGIN_DB = 12.0
+NOISE_FLOOR_PERCENTILE = 10
+ABSOLUTE_FLOOR_DB = -60.0
+
+# Smoothing of the speech/non-speech decisions
+MIN_SPEECH_MS = 250   # Shorter bursts (clicks, chalk) are dropped
+MIN_SILENCE_MS = 800  # Shorter pauses stay inside the surrounding speech region
+PAD_MS = 200          # Context kept on both sides of every region
+
+# Silence inserted between regions in the compacted audio, so Whisper still hears a boundary
+GAP_SECONDS = 0.3
+
+def frame_energies_db(audio, frame_length):
+    """Returns the RMS energy of each full frame in dBFS, computed in one pass over a (frames, samples) view."""
+    n_frames = len(audio) // frame_length
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = np.asarray(audio[:n_frames * frame_length], dtype=np.float32).reshape(n_frames, frame_length)
+    power = np.einsum('ij,ij->i', frames, frames) / frame_length
+    return 10.0 * np.log10(power + 1e-10)
+
+def runs_of_true(mask):
+    """Returns (starts, ends) of the runs of True values in a boolean array, ends exclusive."""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def detect_speech(audio, sample_rate=SAMPLE_RATE, margin_db=SPEECH_MARGIN_DB,
+                  min_speech_ms=MIN_SPEECH_MS, min_silence_ms=MIN_SILENCE_MS, pad_ms=PAD_MS):
+    """Returns the speech regions of the audio as a list of (start_sample, end_sample) tuples."""
+    frame_length = int(sample_rate * FRAME_MS / 1000)
+    energies = frame_energies_db(audio, frame_length)
+    if len(energies) == 0:
+        return []
+
+    noise_floor = np.percentile(energies, NOISE_FLOOR_PERCENTILE)
+    threshold = max(noise_floor + margin_db, ABSOLUTE_FLOOR_DB)
+    speech = energies > threshold
+
+    # Close pauses shorter than min_silence_ms
+    starts, ends = runs_of_true(~speech)
+    min_silence_frames = min_silence_ms // FRAME_MS
+    for start, end in zip(starts, ends):
+        # Leading and trailing silence is never speech, whatever its length
+        if start > 0 and end < len(speech) and end - start < min_silence_frames:
+            speech[start:end] = True
+
+    # Drop bursts shorter than min_speech_ms
+    starts, ends = runs_of_true(speech)
+    keep = (ends - starts) >= max(1, min_speech_ms // FRAME_MS)
+    starts, ends = starts[keep], ends[keep]
+
+    # Pad every region and merge the ones that now touch
+    pad_frames = pad_ms // FRAME_MS
+    regions = []
+    for start, end in zip(starts - pad_frames, ends + pad_frames):
+        start_sample = max(0, int(start) * frame_length)
+        end_sample = min(len(audio), int(end) * frame_length)
+        if regions and start_sample <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], end_sample))
+        else:
+            regions.append((start_sample, end_sample))
+    return regions
+
+class SpeechTimeline:
+    """Maps times in the compacted (speech only) audio back to the original recording."""
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.compact_starts = []  # seconds
+        self.original_starts = []  # seconds
+        self.durations = []  # seconds
+
+    def add_region(self, compact_start_sample, original_start_sample, length_samples):
+        self.compact_starts.append(compact_start_sample / self.sample_rate)
+        self.original_starts.append(original_start_sample / self.sample_rate)
+        self.durations.append(length_samples / self.sample_rate)
+
+    @property
+    def speech_seconds(self):
+        return sum(self.durations)
+
+    def remap(self, t):
+        """Returns the original time of a time in the compacted audio. Times inside an inserted gap stick to the end of the previous region."""
+        if not self.compact_starts:
+            return t
+        index = max(0, bisect_right(self.compact_starts, t) - 1)
+        offset = min(max(t - self.compact_starts[index], 0.0), self.durations[index])
+        return self.original_starts[index] + offset
+
+    def remap_result(self, result):
+        """Moves the segments (and words, if any) of a Whisper result onto the original timeline, in place."""
+        for segment in result.get('segments', []):
+            segment['start'] = self.remap(segment['start'])
+            segment['end'] = max(segment['start'], self.remap(segment['end']))
+            for word in segment.get('words', []) or []:
+                word['start'] = self.remap(word['start'])
+                word['end'] = max(word['start'], self.remap(word['end']))
+        return result
+
+def compact_audio(audio, regions, sample_rate=SAMPLE_RATE, gap_seconds=GAP_SECONDS):
+    """Concatenates the speech regions with short silent gaps. Returns the new audio and its SpeechTimeline."""
+    timeline = SpeechTimeline(sample_rate)
+    gap = np.zeros(int(gap_seconds * sample_rate), dtype=np.float32)
+
+    pieces = []
+    position = 0
+    for start, end in regions:
+        if pieces:
+            pieces.append(gap)
+            position += len(gap)
+        timeline.add_region(position, start, end - start)
+        pieces.append(np.asarray(audio[start:end], dtype=np.float32))
+        position += end - start
+
+    if not pieces:
+        return np.zeros(0, dtype=np.float32), timeline
+    return np.concatenate(pieces), timeline
+
+def plan_shards(audio, n_shards, sample_rate=SAMPLE_RATE):
+    """Splits the audio into up to n_shards contiguous (start_sample, end_sample) ranges, cutting in the middle of pauses."""
+    total = len(audio)
+    if n_shards <= 1 or total == 0:
+        return [(0, total)]
+
+    # Candidate cut points: the middle of every pause between two speech regions
+    regions = detect_speech(audio, sample_rate=sample_rate)
+    candidates = np.array([(end + next_start) // 2 for (_, end), (next_start, _) in zip(regions, regions[1:])], dtype=np.int64)
+
+    cuts = []
+    for k in range(1, n_shards):
+        target = total * k // n_shards
+        if len(candidates):
+            # The pause closest to the ideal cut; a cut inside speech is used only when there is no pause at all
+            cut = int(candidates[np.argmin(np.abs(candidates - target))])
+        else:
+            cut = target
+        if (not cuts or cut > cuts[-1]) and 0 < cut < total:
+            cuts.append(cut)
+
+    bounds = [0] + cuts + [total]
+    return list(zip(bounds[:-1], bounds[1:]))
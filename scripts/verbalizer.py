@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Rule-based Russian verbalizer for 04_verbalize.py.
+#
+# Most of what the verbalization prompt asks for is mechanical: numbers, variables ('x' -> 'икс'),
+# Greek letters, point labels ('ABCD' -> 'А-Б-Ц-Д'), operators and function names. This module does
+# those locally, with the case of a number following the word in front of it ('больше нуля',
+# 'косинус двух икс', 'от пяти до десяти', 'между тремя и четырьмя'). A block is resolved only if nothing
+# is left that the rules are unsure about (ordinals, words in Latin script, numbers whose gender depends on
+# an unknown noun, numbers whose case the words in front of them do not tell, ...); everything else still
+# goes to the LLM.
+import re
+from functools import lru_cache
+
+from num2words import num2words
+
+# Bump when the rules change, so the incremental mode verbalizes the files again
+rules_version = 2
+
+# Lowercase Latin letters used as variables
+latin_variables = {
+    'a': 'а', 'b': 'бэ', 'c': 'цэ', 'd': 'дэ', 'e': 'е', 'f': 'эф', 'g': 'жэ', 'h': 'аш', 'i': 'и',
+    'j': 'йот', 'k': 'ка', 'l': 'эль', 'm': 'эм', 'n': 'эн', 'o': 'о', 'p': 'пэ', 'q': 'ку', 'r': 'эр',
+    's': 'эс', 't': 'тэ', 'u': 'у', 'v': 'вэ', 'w': 'дубль-вэ', 'x': 'икс', 'y': 'игрек', 'z': 'зет',
+}
+
+# Uppercase Latin letters of point labels, written as uppercase Cyrillic letters
+latin_labels = {
+    'A': 'А', 'B': 'Б', 'C': 'Ц', 'D': 'Д', 'E': 'Е', 'F': 'Ф', 'G': 'Г', 'H': 'Х', 'I': 'И',
+    'J': 'Й', 'K': 'К', 'L': 'Л', 'M': 'М', 'N': 'Н', 'O': 'О', 'P': 'П', 'Q': 'К', 'R': 'Р',
+    'S': 'С', 'T': 'Т', 'U': 'У', 'V': 'В', 'W': 'В', 'X': 'Х', 'Y': 'У', 'Z': 'З',
+}
+max_label_length = 6
+
+greek_letters = {
+    'α': 'альфа', 'β': 'бета', 'γ': 'гамма', 'δ': 'дельта', 'ε': 'эпсилон', 'ζ': 'дзета', 'η': 'эта',
+    'θ': 'тэта', 'ι': 'йота', 'κ': 'каппа', 'λ': 'лямбда', 'μ': 'мю', 'ν': 'ню', 'ξ': 'кси', 'π': 'пи',
+    'ρ': 'ро', 'σ': 'сигма', 'ς': 'сигма', 'τ': 'тау', 'υ': 'ипсилон', 'φ': 'фи', 'χ': 'хи', 'ψ': 'пси',
+    'ω': 'омега', 'Γ': 'гамма', 'Δ': 'дельта', 'Θ': 'тэта', 'Λ': 'лямбда', 'Ξ': 'кси', 'Π': 'пи',
+    'Σ': 'сигма', 'Φ': 'фи', 'Ψ': 'пси', 'Ω': 'омега',
+}
+
+# Function names; a number after them is read in the genitive ('cos 2x' -> 'косинус двух икс')
+function_names = {
+    'sin': 'синус', 'cos': 'косинус', 'tg': 'тангенс', 'tan': 'тангенс', 'ctg': 'котангенс', 'cot': 'котангенс',
+    'arcsin': 'арксинус', 'arccos': 'арккосинус', 'arctg': 'арктангенс', 'arcctg': 'арккотангенс',
+    'log': 'логарифм', 'ln': 'натуральный логарифм', 'lg': 'десятичный логарифм', 'sqrt': 'корень из',
+    'lim': 'предел', 'max': 'максимум', 'min': 'минимум',
+}
+
+# Operators between operands, and the case of a number after them
+operators = {
+    '+': ('плюс', 'nominative'),
+    '−': ('минус', 'nominative'),
+    '-': ('минус', 'nominative'),
+    '*': ('умножить на', 'nominative'),
+    '×': ('умножить на', 'nominative'),
+    '·': ('умножить на', 'nominative'),
+    '/': ('делить на', 'nominative'),
+    ':': ('делить на', 'nominative'),
+    '=': ('равно', 'nominative'),
+    '≠': ('не равно', 'dative'),
+    '!=': ('не равно', 'dative'),
+    '>': ('больше', 'genitive'),
+    '<': ('меньше', 'genitive'),
+    '≥': ('больше или равно', 'dative'),
+    '>=': ('больше или равно', 'dative'),
+    '≤': ('меньше или равно', 'dative'),
+    '<=': ('меньше или равно', 'dative'),
+    '^': ('в степени', 'nominative'),
+}
+# Operators that are also punctuation or hyphens, and only count as operators between operands
+binary_only = {'-', ':', '/', '*'}
+
+# Words that set the case of a following number
+case_words = {
+    'genitive': {'от', 'до', 'из', 'без', 'около', 'больше', 'меньше', 'более', 'менее', 'кроме', 'после', 'для', 'у',
+                 'синус', 'косинус', 'тангенс', 'котангенс', 'логарифм', 'корень', 'квадрат', 'куб'},
+    'dative': {'к', 'равен', 'равна', 'равно', 'равны', 'равняется', 'равняются', 'кратно', 'кратен', 'пропорционально'},
+    'instrumental': {'с', 'со', 'между', 'над', 'под', 'перед'},
+    'prepositional': {'о', 'об', 'при'},
+}
+word_cases = {word: case for case, words in case_words.items() for word in words}
+
+# Gender of nouns that commonly follow a number, needed for 1 and 2 ('одна точка', 'две стороны')
+feminine_nouns = {'точк', 'сторон', 'прям', 'вершин', 'задач', 'формул', 'минут', 'секунд', 'степен', 'част',
+                  'недел', 'функци', 'плоскост', 'окружност', 'диагонал', 'медиан', 'высот', 'биссектрис',
+                  'хорд', 'дуг', 'тысяч', 'скобк', 'клетк', 'единиц', 'цифр', 'ошибк', 'строк', 'тетрад',
+                  'лекци', 'теорем', 'аксиом', 'грань', 'гран', 'плоскост', 'ноч'}
+masculine_nouns = {'угол', 'угла', 'углов', 'отрез', 'треугольник', 'пример', 'корен', 'корн', 'вариант',
+                   'случа', 'метр', 'сантиметр', 'миллиметр', 'километр', 'градус', 'член', 'множител',
+                   'квадрат', 'ответ', 'вектор', 'ромб', 'параграф', 'урок', 'рубл', 'балл', 'процент',
+                   'миллион', 'миллиард', 'икс', 'игрек'}
+# Short masculine words that would match feminine words as stems ('раз' and 'разность')
+masculine_words = {'раз', 'раза', 'час', 'часа', 'часов', 'шаг', 'шага', 'шагов', 'луч', 'луча', 'лучей', 'куб', 'куба', 'кубов'}
+neuter_nouns = {'числ', 'уравнени', 'решени', 'неравенств', 'слагаем', 'значени', 'услови', 'свойств', 'упражнени',
+                'задани', 'действи', 'деление', 'множеств', 'выражени', 'утверждени', 'следстви', 'правил'}
+
+# Words after a number that make it an ordinal or a date, which the rules do not handle
+ordinal_hints = {'год', 'года', 'году', 'годе', 'годах', 'века', 'веке', 'класс', 'класса', 'классе',
+                 'номер', 'номером', 'числа', 'января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля',
+                 'августа', 'сентября', 'октября', 'ноября', 'декабря', 'страница', 'странице', 'задачу',
+                 'параграфе', 'пункт', 'пункте', 'глава', 'главе', 'урок', 'уроке', 'билет', 'вариант'}
+
+# Words and punctuation after which the next number takes the case of the number before them ('между 3 и 4')
+list_separators = {'и', 'или', ','}
+
+zero_words = {'nominative': 'ноль', 'genitive': 'нуля', 'dative': 'нулю', 'instrumental': 'нулём', 'prepositional': 'нуле'}
+
+token_pattern = re.compile(r"""
+    (?P<number>\d{1,3}(?:[ \u00a0\u202f]\d{3})+(?![.,]?\d)|\d+(?:[.,]\d+)?(?![.,]?\d))
+  | (?P<latin>[A-Za-z]+)
+  | (?P<greek>[Ͱ-Ͽ])
+  | (?P<op>>=|<=|!=|[≥≤≠+\-−*/×·:=<>^])
+  | (?P<word>[А-Яа-яЁё]+)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Anything still written with these after the rules ran needs the LLM
+leftover_pattern = re.compile(r'[A-Za-z0-9Ͱ-Ͽ+*/=<>^√×·≥≤≠−%]')
+
+@lru_cache(maxsize=4096)
+def number_words(number, case='nominative', gender='m'):
+    """num2words in Russian, memoized; None if the case is not supported for this number."""
+    if number == 0:
+        return zero_words.get(case)
+    try:
+        return num2words(number, lang='ru', case=case, gender=gender)
+    except (NotImplementedError, TypeError, ValueError):
+        return None
+
+def noun_gender(word):
+    """'f', 'n' or 'm' for known nouns, else None."""
+    word = word.lower()
+    if word in masculine_words:
+        return 'm'
+    for stems, gender in ((feminine_nouns, 'f'), (neuter_nouns, 'n'), (masculine_nouns, 'm')):
+        if any(word.startswith(stem) for stem in stems):
+            return gender
+    return None
+
+def needs_gender(number):
+    """1 and 2 (and 21, 32, ... but not 11, 12) change with the gender of their noun."""
+    return number % 10 in (1, 2) and number % 100 not in (11, 12)
+
+class Verbalizer:
+    """Verbalizes one block of text; `resolved` tells whether the result can be used without the LLM."""
+
+    def __init__(self, text):
+        self.tokens = [(match.lastgroup, match.group()) for match in token_pattern.finditer(text)]
+        self.output = []
+        self.resolved = True
+        # Case of the next number; None when the words in front of it do not tell. A block starts a sentence.
+        self.next_case = 'nominative'
+        self.number_case = None  # Case of the last number, for the next one of a list
+        self.need_space = False
+
+    def neighbour(self, i, step):
+        """The nearest token that is not whitespace, and whether whitespace was skipped to reach it."""
+        j = i + step
+        spaced = False
+        while 0 <= j < len(self.tokens) and self.tokens[j][0] == 'space':
+            j += step
+            spaced = True
+        if 0 <= j < len(self.tokens):
+            return self.tokens[j][0], self.tokens[j][1], spaced
+        return None, '', spaced
+
+    def is_operand(self, kind, value):
+        return kind in ('number', 'greek') or (kind == 'latin' and value in latin_variables) or (kind == 'latin' and value.isupper())
+
+    def emit_words(self, words):
+        if self.output and (self.output[-1][-1:].isalnum() or self.output[-1][-1:] in ')]'):
+            self.output.append(' ')
+        self.output.append(words)
+        self.need_space = True
+
+    def emit_raw(self, value):
+        if self.need_space and (value[:1].isalnum() or value[:1] in '(['):
+            self.output.append(' ')
+        self.output.append(value)
+        self.need_space = False
+
+    def number(self, i, value):
+        next_kind, next_value, spaced = self.neighbour(i, 1)
+        if next_kind == 'word' and not spaced:
+            self.resolved = False  # '5см', units glued to the number
+        if next_kind == 'op' and next_value == '-' and not spaced:
+            after_kind, _, after_spaced = self.neighbour(i + 1, 1)
+            if after_kind == 'word' and not after_spaced:
+                self.resolved = False  # '5-й', '2-го': ordinals
+        if next_kind == 'word' and next_value.lower() in ordinal_hints:
+            self.resolved = False
+        if next_kind == 'number':
+            self.resolved = False  # '12 34': digit groups that are not thousands
+        value = re.sub(r'\s', '', value)  # '1 000 000'
+
+        case = self.next_case
+        if case is None:
+            self.resolved = False  # 'в 1 точке': the case depends on a word the rules do not know
+            case = 'nominative'
+        elif case == 'instrumental' and next_kind == 'word' and next_value.lower() == 'до':
+            self.resolved = False  # 'с 5 до 10' is 'с пяти', not 'с пятью'
+        if ',' in value or '.' in value:
+            words = number_words(float(value.replace(',', '.')), 'nominative')
+            if case != 'nominative':
+                self.resolved = False  # num2words has no cases for fractions
+        else:
+            number = int(value)
+            gender = 'm'
+            if needs_gender(number) and next_kind == 'word':
+                gender = noun_gender(next_value)
+                if gender is None:
+                    self.resolved = False
+                    gender = 'm'
+            words = number_words(number, case, gender)
+            if words is None:
+                self.resolved = False
+                words = number_words(number)
+        self.emit_words(words if words is not None else value)
+        if next_kind == 'latin' and not spaced and next_value not in latin_variables:
+            self.resolved = False  # '2xy', '3sin'
+        self.number_case = case
+        self.next_case = None
+
+    def latin(self, i, value):
+        prev_kind, _, prev_spaced = self.neighbour(i, -1)
+        next_kind, _, next_spaced = self.neighbour(i, 1)
+        if next_kind == 'number' and not next_spaced:
+            self.resolved = False  # Indices like 'x1' or 'A1'
+        if value.lower() in function_names:
+            self.emit_words(function_names[value.lower()])
+            self.next_case = 'genitive'
+            return
+        if value in latin_variables:
+            self.emit_words(latin_variables[value])
+        elif len(value) > 1 and set(value) <= set('IVX'):
+            self.resolved = False  # Roman numerals
+            self.emit_raw(value)
+        elif value.isupper() and len(value) <= max_label_length:
+            self.emit_words('-'.join(latin_labels[letter] for letter in value))
+        else:
+            self.resolved = False  # Words in Latin script
+            self.emit_raw(value)
+        self.next_case = None
+
+    def operator(self, i, value):
+        prev_kind, prev_value, prev_spaced = self.neighbour(i, -1)
+        next_kind, next_value, next_spaced = self.neighbour(i, 1)
+        between_operands = self.is_operand(prev_kind, prev_value) and self.is_operand(next_kind, next_value)
+        if value in binary_only and not between_operands:
+            if value == '-' and next_kind == 'number' and not next_spaced and (prev_kind in (None, 'op') or prev_spaced or prev_value in '(['):
+                self.emit_words('минус')  # Unary minus: '-5', '= -5', '(-5'; the number keeps its case
+                return
+            if value in ('*', '/') or (value == '-' and next_kind == 'number' and not next_spaced):
+                self.resolved = False
+            self.emit_raw(value)  # Hyphens, dashes and colons in text
+            if value == ':':
+                self.next_case = 'nominative'  # 'Ответ: 5'
+            return
+        if not prev_spaced and not next_spaced:
+            if value == '-' and prev_kind == 'latin' and next_kind == 'latin' and prev_value.isupper() and next_value.isupper():
+                self.emit_raw(value)  # 'A-B' is a label written with a hyphen
+                return
+            if value in ('-', ':', '/') and prev_kind == 'number' and next_kind == 'number':
+                self.resolved = False  # Ranges '5-10', times '10:30' and fractions '1/2'
+        words, case = operators[value]
+        self.emit_words(words)
+        self.next_case = case
+
+    def case_after(self, i, value):
+        """Case of a number after the word or punctuation at i: that of the list it continues, that the word
+        asks for, or None."""
+        if value in list_separators and self.neighbour(i, -1)[0] == 'number':
+            return self.number_case
+        return word_cases.get(value)
+
+    def run(self):
+        for i, (kind, value) in enumerate(self.tokens):
+            if kind == 'number':
+                self.number(i, value)
+            elif kind == 'latin':
+                self.latin(i, value)
+            elif kind == 'greek':
+                if value in greek_letters:
+                    self.emit_words(greek_letters[value])
+                else:
+                    self.resolved = False
+                    self.emit_raw(value)
+                self.next_case = None
+            elif kind == 'op':
+                self.operator(i, value)
+            elif kind == 'word':
+                self.emit_raw(value)
+                self.next_case = self.case_after(i, value.lower())
+            elif kind == 'space':
+                self.output.append(value)
+                self.need_space = False
+            else:
+                self.emit_raw(value)
+                if value in '.!?':
+                    self.next_case = 'nominative'  # A new sentence
+                elif value not in '()[]"\'«»':
+                    self.next_case = self.case_after(i, value)
+        text = ''.join(self.output)
+        if leftover_pattern.search(text):
+            self.resolved = False
+        return text, self.resolved
+
+def verbalize(text):
+    """Returns (verbalized text, resolved). Unresolved blocks should be sent to the LLM as they were."""
+    return Verbalizer(text).run()
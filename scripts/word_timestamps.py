@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Word-level timestamps recorded by 02_transcribe.py --word_timestamps, for 03_reblock.py.
+#
+# The words are the 'words' table of the transcript store (transcript_store.py): text (Whisper words keep
+# their leading space), start and end in seconds on the same timeline as the SRT, and Whisper's probability.
+import numpy as np
+
+class WordTimes:
+    def __init__(self, texts, starts, ends, probabilities):
+        self.texts = texts
+        self.starts = starts
+        self.ends = ends
+        self.probabilities = probabilities
+
+    def __len__(self):
+        return len(self.texts)
+
+def load_words(store):
+    """The words of a transcript store, or None if it was transcribed without word timestamps."""
+    if not store.has_table('words'):
+        return None
+    return WordTimes(store.read('words', 'text'), store.read('words', 'start'), store.read('words', 'end'),
+                     store.read('words', 'probability').astype(np.float64))
+
+def load_matching(store, srt_words):
+    """Loads the words of a store if they are still the words of the subtitles.
+    After a step that rewrites the text (04_verbalize.py) the word times no longer apply."""
+    words = load_words(store)
+    if words is None:
+        return None
+    if ''.join(words.texts).split() != list(srt_words):
+        print(f"Word timestamps in {store.path.name} do not match the subtitles any more; spreading times evenly")
+        return None
+    return words